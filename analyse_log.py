@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Structure of all genomes of an evolution log.
+
+Every genome is split in blocks, dead branches and empty blocks are removed and
+chains are merged, like analyser.py does for one genome. Genomes with the same
+canonical form are analysed once. Per-record metrics are written as columns
+to a numpy .npz file:
+  generation, dist, evals, steps, size - from the log
+  blocks       - number of code and condition blocks in the optimized structure
+  instructions - number of instructions
+  live         - fraction of the instructions, executed in the test runs
+  loops        - number of loops (back edges) of the control flow graph
+"""
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import machinedef
+from binlog import is_binlog, BinaryLogReader, FITNESS_COLUMNS
+from hash_mappings import hashes_compatible
+from disassembler import canonicalize, code_maps
+from analyser import parse_structure, count_loops, StartBlock
+
+METRICS = ('blocks', 'instructions', 'live', 'loops')
+
+def log_records(logfile):
+    """Iterate (generation, fitness, genome) of the log records, JSON or binary"""
+    expected_hash = machinedef.command_system_hash()
+    if is_binlog(logfile):
+        log = BinaryLogReader(logfile)
+        cshash = log.meta.get('command_system_hash')
+        if cshash and not hashes_compatible(expected_hash, cshash):
+            print(f"Warning! log {logfile} has code system {cshash}, while expected is {expected_hash}", file=sys.stderr)
+        generation = log.columns['generation']
+        fitness = np.stack([log.columns[name] for name in FITNESS_COLUMNS], axis=1)
+        for i in range(len(log)):
+            yield int(generation[i]), fitness[i], log.genome(i)
+        return
+    with open(logfile) as hfile:
+        for line in hfile:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if 'hexcode' not in data: continue
+            cshash = data.get('command_system_hash')
+            if cshash and not hashes_compatible(expected_hash, cshash): continue
+            yield data.get('generation', -1), data['fitness'], bytes.fromhex(data['hexcode'])
+
+def genome_metrics(code):
+    """Tuple of METRICS of one genome"""
+    instructions = len(code)//2
+    if instructions == 0:
+        return (0, 0, 0.0, 0)
+    maps = code_maps(code)
+    blocks = parse_structure(code, show_dead_code=False, maps=maps)
+    nblocks = sum(1 for b in blocks if not isinstance(b, StartBlock))
+    live = sum(maps[1])/instructions
+    return (nblocks, instructions, live, count_loops(blocks))
+
+def analyse_log(logfiles, processes=None, chunksize=16):
+    """Dictionary of columns: log values and METRICS for every record"""
+    columns = {name: [] for name in ('generation',)+FITNESS_COLUMNS}
+    keys = []
+    #content hash of the canonical code -> code
+    unique = {}
+    for logfile in logfiles:
+        for generation, fitness, genome in log_records(logfile):
+            code = canonicalize(genome)
+            key = hashlib.sha1(code).digest()
+            if key not in unique:
+                unique[key] = code
+            keys.append(key)
+            columns['generation'].append(generation)
+            for name, value in zip(FITNESS_COLUMNS, fitness):
+                columns[name].append(value)
+    print(f"{len(keys)} records, {len(unique)} distinct genomes", file=sys.stderr)
+
+    with ProcessPoolExecutor(processes) as executor:
+        metrics = dict(zip(unique.keys(),
+                           executor.map(genome_metrics, unique.values(), chunksize=chunksize)))
+    result = {'generation': np.array(columns['generation'], dtype=np.int64)}
+    for name in FITNESS_COLUMNS:
+        result[name] = np.array(columns[name], dtype=np.float64)
+    for i, name in enumerate(METRICS):
+        result[name] = np.array([metrics[key][i] for key in keys],
+                                dtype=np.float64 if name == 'live' else np.int64)
+    return result
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("logfile", nargs="+",
+                        help="Evolution logs, JSON or binary")
+    parser.add_argument("-o", "--output", default="structure.npz",
+                        help="Output file with the metric columns")
+    parser.add_argument("-j", "--processes", type=int,
+                        help="Number of worker processes, default is number of CPUs")
+    args = parser.parse_args()
+
+    columns = analyse_log(args.logfile, args.processes)
+    np.savez(args.output, **columns)
+    print(f"Written {len(columns['generation'])} records to {args.output}", file=sys.stderr)
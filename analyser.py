@@ -6,7 +6,7 @@ import os
 import subprocess
 import shutil
 import machinedef
-from disassembler import decompile_instruction, map_jumps, map_live_code
+from disassembler import decompile_instruction, code_maps
 
 class BaseBlock():
     def __init__(self, name, next):
@@ -31,11 +31,12 @@ class CondOp(BaseBlock):
         self.jump = jump
     def __str__(self):
         return "{}:[if {}: ->{} else: ->{}]".format(self.name, self.iftrue, self.jump, self.next)
-def parse_structure(code, optimize=True, show_address=False, show_dead_code=True):
-    """Decompile code and show its structure in graphwiz"""
-    jumpmap = map_jumps(code)
-    if show_dead_code:
-        live_code_map = map_live_code(code)
+def parse_structure(code, optimize=True, show_address=False, show_dead_code=True, maps=None):
+    """Decompile code and show its structure in graphwiz.
+    maps are jump map and live code map of the code, as returned by code_maps"""
+    if maps is None:
+        maps = code_maps(code, live=show_dead_code)
+    jumpmap, live_code_map = maps
 
     label = machinedef.name2cmd['label'].code
     uncond_jumps = tuple( c.code for c in machinedef.commands
@@ -146,13 +147,14 @@ def _detect_dead_branches(blocks, name_first):
             raise TypeError(block)
     #Graph is built!!!
     #now find vertices, reachable from the state (block_start, False)
+    #iterative walk: recursion limit is reached on big looping programs
     reachable = set()
-    def walk( graphnode ):
-        if graphnode in reachable: return
+    stack = [(blocks[name_first], False)]
+    while stack:
+        graphnode = stack.pop()
+        if graphnode in reachable: continue
         reachable.add(graphnode)
-        for child in graph.get(graphnode,()):
-            walk(child)
-    walk((blocks[name_first], False))
+        stack.extend(graph.get(graphnode,()))
     del graph
     #good. Now merge the values for reachable blocks
     block2flags = defaultdict(set)
@@ -258,6 +260,34 @@ def _merge_block_chains(blocks):
             else:
                 break
         
+def block_successors(block):
+    if isinstance(block, CondOp):
+        return (block.next, block.jump)
+    return (block.next,)
+
+def count_loops(blocks):
+    """Number of back edges of the depth-first walk from the start block:
+    each loop of the control flow graph has at least one"""
+    blocks = {b.name: b for b in blocks}
+    start = next(b.name for b in blocks.values() if isinstance(b, StartBlock))
+    #0 - in the walk stack, 1 - done
+    state = {start: 0}
+    stack = [(start, iter(block_successors(blocks[start])))]
+    loops = 0
+    while stack:
+        name, successors = stack[-1]
+        for child in successors:
+            if child not in state:
+                state[child] = 0
+                stack.append((child, iter(block_successors(blocks[child]))))
+                break
+            if state[child] == 0:
+                loops += 1
+        else:
+            state[name] = 1
+            stack.pop()
+    return loops
+
 def _dotescape(s):
     return '"' + s.replace('"','\\"').replace("\n","\\n") + '"'
 def render_structure_dot(blocks):
@@ -0,0 +1,51 @@
+//Benchmark of the interpreter loops: fast loop of runto against the instrumented one
+#include <chrono>
+#include <cstdio>
+#include "machine.hpp"
+
+//runs all programs with all initial states, returns seconds and total number of steps
+static double run_all(const std::vector<std::vector<i8> > &programs, bool instrumented,
+		      size_t attempts, size_t &total_steps)
+{
+  FunctionTable f(0);
+  vec target;
+  target.coord[0] = target.coord[1] = 1.0;
+  random_engine rng(1);
+  Machine m;
+  m.rng = &rng;
+  m.set_function(f);
+  m.set_trace_live_code(instrumented);
+  total_steps = 0;
+  auto start = std::chrono::steady_clock::now();
+  for(const std::vector<i8> &program: programs){
+    m.load_code(&program[0], program.size());
+    for(size_t a=0; a!=attempts; ++a){
+      m.reset();
+      m.runto(10000, 1000, target, 1e-5);
+      total_steps += m.nsteps;
+    }
+  }
+  std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - start;
+  return elapsed.count();
+}
+
+int main()
+{
+  const size_t nprograms = 300, size = 200, attempts = 20;
+  random_engine rng(2);
+  std::vector<std::vector<i8> > programs(nprograms, std::vector<i8>(size));
+  for(std::vector<i8> &program: programs)
+    for(i8 &byte: program) byte = static_cast<i8>(rng());
+
+  size_t fast_steps, instrumented_steps;
+  double fast = run_all(programs, false, attempts, fast_steps);
+  double instrumented = run_all(programs, true, attempts, instrumented_steps);
+  printf("fast:         %8.3f s, %6.1f Msteps/s\n", fast, fast_steps/fast*1e-6);
+  printf("instrumented: %8.3f s, %6.1f Msteps/s\n", instrumented, instrumented_steps/instrumented*1e-6);
+  printf("speedup:      %8.2f\n", instrumented/fast);
+  if (fast_steps != instrumented_steps){
+    printf("Error: loops made different number of steps: %zu != %zu\n", fast_steps, instrumented_steps);
+    return 1;
+  }
+  return 0;
+}
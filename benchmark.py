@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""Benchmarks of the interpreter, fitness and GA hot paths.
+
+All inputs are generated from fixed seeds. Results are written as JSON;
+if a baseline file is given, results are compared with it and the script
+fails when some benchmark is slower by more than the tolerance.
+Baseline is a results file of an earlier run on the same computer.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import platform
+import numpy as np
+import machinedef
+from machine import Machine, FunctionTable, command_system_hash, INITIAL_STATE_SIZE
+import genetic_optim
+from genetic_optim import Fitness, mutate, crossover
+import utils
+import analyser
+import nmead
+
+seed = 1
+#each benchmark is repeated, the best time is taken
+repeats = 5
+#relative slowdown, reported as regression
+tolerance = 0.25
+
+BENCHMARKS = []
+def benchmark(unit):
+    """Register benchmark function. It gets the prepared inputs and returns (amount of work, seconds)"""
+    def register(func):
+        BENCHMARKS.append((func.__name__, unit, func))
+        return func
+    return register
+
+def random_genome(size):
+    return bytes(random.randrange(256) for _ in range(size))
+
+def initial_states(count):
+    return np.random.uniform(-1.0, 1.0, size=count*INITIAL_STATE_SIZE)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def run_genomes(genomes, states, maxsteps):
+    func = FunctionTable(0)
+    m = Machine()
+    m.set_function(func)
+    steps = 0
+    start = time.perf_counter()
+    for genome in genomes:
+        m.load_code(genome)
+        m.set_initial_states(states)
+        for _ in range(len(states)//INITIAL_STATE_SIZE):
+            m.reset()
+            m.runto(maxsteps, 1000, (1.0, 1.0), 1e-5)
+            steps += m.nsteps
+    return steps, time.perf_counter()-start
+
+@benchmark("steps/s")
+def step_nmead(data):
+    m = Machine()
+    func = FunctionTable(0)
+    m.set_function(func)
+    m.load_code(nmead.nmead_code)
+    m.set_initial_states(data['states'])
+    m.reset()
+    n = 20000
+    return n, timed(lambda: [m.step() for _ in range(n)])
+
+@benchmark("steps/s")
+def runto_nmead(data):
+    return run_genomes([nmead.nmead_code]*20, data['states'], 10000)
+
+@benchmark("steps/s")
+def runto_random(data):
+    return run_genomes(data['genomes'][:100], data['states'], 10000)
+
+@benchmark("calls/s")
+def fitness_call(data):
+    fitness = Fitness(initial_states=data['states'])
+    genomes = [nmead.nmead_code] + data['genomes'][:19]
+    return len(genomes), timed(lambda: [fitness(g, 0, (1.0, 1.0)) for g in genomes])
+
+@benchmark("mutations/s")
+def mutation(data):
+    genomes = data['genomes']
+    return len(genomes), timed(lambda: [mutate(g) for g in genomes])
+
+@benchmark("crossovers/s")
+def crossovers(data):
+    pairs = list(zip(data['genomes'][0::2], data['genomes'][1::2]))*4
+    return len(pairs), timed(lambda: [crossover(a, b) for a, b in pairs])
+
+@benchmark("loads/s")
+def load_code(data):
+    m = Machine()
+    genomes = data['genomes']*4
+    return len(genomes), timed(lambda: [m.load_code(g) for g in genomes])
+
+@benchmark("lines/s")
+def load_index(data):
+    log = data['log']
+    index = log+".index"
+    def build():
+        if os.path.exists(index): os.remove(index)
+        utils.load_index(log, verbose=False)
+    return data['log_lines'], timed(build)
+
+@benchmark("lines/s")
+def load_json_line(data):
+    log = data['log']
+    utils.load_index(log, verbose=False)
+    lines = [random.randrange(data['log_lines']) for _ in range(2000)]
+    return len(lines), timed(lambda: [utils.load_json_line(log, i) for i in lines])
+
+@benchmark("genomes/s")
+def parse_structure(data):
+    genomes = [nmead.nmead_code] + data['genomes'][:49]
+    return len(genomes), timed(lambda: [analyser.parse_structure(g) for g in genomes])
+
+def prepare(tmpdir, log_lines=100000):
+    """Inputs of the benchmarks"""
+    random.seed(seed)
+    np.random.seed(seed)
+    genomes = [random_genome(random.randrange(50, 1500)//2*2) for _ in range(1000)]
+    log = os.path.join(tmpdir, "log.jsons")
+    cshash = machinedef.command_system_hash()
+    with open(log, "w") as hfile:
+        for i in range(log_lines):
+            genome = genomes[i % len(genomes)]
+            hfile.write(json.dumps({'generation': i//genetic_optim.topsize,
+                                    'fitness': [random.random(), 100.0, 1000.0, len(genome)],
+                                    'hexcode': genome.hex(),
+                                    'command_system_hash': cshash}))
+            hfile.write("\n")
+    return {'genomes': genomes,
+            'states': initial_states(10),
+            'log': log,
+            'log_lines': log_lines}
+
+def run(names=None):
+    """Dictionary of the benchmark results: name -> {value, unit}. Value is the rate, higher is better"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = prepare(tmpdir)
+        for name, unit, func in BENCHMARKS:
+            if names and name not in names: continue
+            best = None
+            for _ in range(repeats):
+                #every repeat gets the same random inputs
+                random.seed(seed)
+                np.random.seed(seed)
+                work, seconds = func(data)
+                rate = work/seconds
+                best = rate if best is None else max(best, rate)
+            results[name] = {'value': best, 'unit': unit}
+            print(f"{name:16s} {best:14.1f} {unit}", file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    """List of the names of the benchmarks, that are slower than in the baseline"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline: continue
+        ratio = result['value']/baseline[name]['value']
+        mark = ""
+        if ratio < 1.0-tolerance:
+            mark = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:16s} {ratio:6.2f}x baseline{mark}")
+    return regressions
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="File to write the results")
+    parser.add_argument("-b", "--baseline",
+                        help="Results file to compare with")
+    parser.add_argument("-t", "--tolerance", type=float, default=tolerance,
+                        help="Allowed relative slowdown")
+    parser.add_argument("benchmark", nargs="*",
+                        help="Benchmarks to run, default is all: " +
+                        ", ".join(name for name, _, _ in BENCHMARKS))
+    args = parser.parse_args()
+
+    results = run(args.benchmark)
+    with open(args.output, "w") as hfile:
+        json.dump({'command_system_hash': command_system_hash(),
+                   'platform': platform.platform(),
+                   'python': platform.python_version(),
+                   'seed': seed,
+                   'results': results}, hfile, indent=1)
+    if args.baseline:
+        with open(args.baseline) as hfile:
+            baseline = json.load(hfile)
+        if baseline.get('command_system_hash') != command_system_hash():
+            print("Warning! baseline was made with another command system", file=sys.stderr)
+        if compare(results, baseline['results'], args.tolerance):
+            sys.exit(1)
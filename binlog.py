@@ -0,0 +1,129 @@
+"""Binary evolution log.
+
+Log is a directory with fixed-width columns, one file per column,
+that can be memory-mapped, and the genomes blob:
+  meta.json         - experiment parameters and command system hash
+  generation.i8     - generation numbers, int64
+  dist.f8, evals.f8, steps.f8, size.f8  - fitness values, float64
+  genome_ends.i8    - end offset of each genome in the blob, int64
+  genomes.bin       - genomes, one after another
+Records are only appended, so the log can be read while it is written.
+Record, partially written by an interrupted writer, is dropped when the log is opened for appending.
+"""
+import os
+import json
+import numpy as np
+
+FORMAT = "genprog-binlog-1"
+FITNESS_COLUMNS = ('dist', 'evals', 'steps', 'size')
+_columns = [('generation', np.int64)] + [(name, np.float64) for name in FITNESS_COLUMNS] + [('genome_ends', np.int64)]
+
+def _column_file(path, name, dtype):
+    return os.path.join(path, f"{name}.{np.dtype(dtype).kind}{np.dtype(dtype).itemsize}")
+
+def is_binlog(path):
+    return os.path.isfile(os.path.join(path, "meta.json"))
+
+class BinaryLogWriter:
+    def __init__(self, path, experiment=None, command_system_hash=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_file = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_file):
+            with open(meta_file, "w") as hmeta:
+                json.dump({'format': FORMAT,
+                           'experiment': experiment,
+                           'command_system_hash': command_system_hash}, hmeta)
+        self._truncate_partial_record()
+        self.files = {name: open(_column_file(path, name, dtype), "ab")
+                      for name, dtype in _columns}
+        self.genomes = open(os.path.join(path, "genomes.bin"), "ab")
+        self.genomes_size = self.genomes.tell()
+
+    def _truncate_partial_record(self):
+        """If the writer was interrupted in the middle of a record, columns have different lengths.
+        Drop the partial record, so the appended records stay aligned"""
+        count = None
+        for name, dtype in _columns:
+            fname = _column_file(self.path, name, dtype)
+            size = os.path.getsize(fname) if os.path.exists(fname) else 0
+            records = size // np.dtype(dtype).itemsize
+            count = records if count is None else min(count, records)
+        for name, dtype in _columns:
+            fname = _column_file(self.path, name, dtype)
+            if os.path.exists(fname) and os.path.getsize(fname) != count*np.dtype(dtype).itemsize:
+                os.truncate(fname, count*np.dtype(dtype).itemsize)
+        #genomes of the complete records
+        genomes_size = 0
+        if count:
+            ends = _map(_column_file(self.path, 'genome_ends', np.int64), np.int64)
+            genomes_size = int(ends[count-1])
+            del ends
+        blob = os.path.join(self.path, "genomes.bin")
+        if os.path.exists(blob) and os.path.getsize(blob) > genomes_size:
+            os.truncate(blob, genomes_size)
+
+    def write(self, generation, fitness, genome):
+        self.genomes.write(genome)
+        self.genomes_size += len(genome)
+        values = dict(zip(FITNESS_COLUMNS, fitness))
+        values['generation'] = generation
+        values['genome_ends'] = self.genomes_size
+        #genome is written first: reader never sees a record without the genome
+        self.genomes.flush()
+        for name, dtype in _columns:
+            self.files[name].write(np.array(values[name], dtype=dtype).tobytes())
+            self.files[name].flush()
+
+    def write_record(self, record):
+        """Write record in the format of the JSON log line"""
+        self.write(record['generation'], record['fitness'], bytes.fromhex(record['hexcode']))
+
+    def close(self):
+        for hfile in self.files.values():
+            hfile.close()
+        self.genomes.close()
+
+def _map(fname, dtype):
+    if not os.path.exists(fname) or os.path.getsize(fname) < np.dtype(dtype).itemsize:
+        return np.zeros(0, dtype=dtype)
+    count = os.path.getsize(fname) // np.dtype(dtype).itemsize
+    return np.memmap(fname, dtype=dtype, mode="r", shape=(count,))
+
+class BinaryLogReader:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as hmeta:
+            self.meta = json.load(hmeta)
+        if self.meta.get('format') != FORMAT:
+            raise ValueError(f"Log {path} has unknown format {self.meta.get('format')}")
+        columns = {name: _map(_column_file(path, name, dtype), dtype)
+                   for name, dtype in _columns}
+        #writer may be in the middle of the record
+        size = min(len(c) for c in columns.values())
+        self.columns = {name: c[:size] for name, c in columns.items()}
+        self.blob = _map(os.path.join(path, "genomes.bin"), np.uint8)
+
+    def __len__(self):
+        return len(self.columns['generation'])
+
+    def fitness(self):
+        """Dictionary of fitness columns"""
+        return {name: self.columns[name] for name in FITNESS_COLUMNS}
+
+    def genome(self, i):
+        ends = self.columns['genome_ends']
+        if i < 0: i += len(ends)
+        if not 0 <= i < len(ends):
+            raise IndexError(i)
+        start = ends[i-1] if i > 0 else 0
+        return self.blob[start:ends[i]].tobytes()
+
+    def record(self, i):
+        """Record in the format of the JSON log line"""
+        fitness = [float(self.columns[name][i]) for name in FITNESS_COLUMNS]
+        fitness[-1] = int(fitness[-1])
+        return {'generation': int(self.columns['generation'][i]),
+                'fitness': fitness,
+                'hexcode': self.genome(i).hex(),
+                'command_system_hash': self.meta.get('command_system_hash')}
@@ -0,0 +1,153 @@
+"""Checkpoints of the running evolution.
+
+Checkpoint is a binary file: magic, length of the JSON header, header and data sections.
+Header describes the sections and holds scalar state;
+sections are aligned to 8 bytes and are read from the memory-mapped file without parsing.
+Module does not depend on genetic_optim, which usually runs as a script:
+evolution and its fitness are created by the caller and filled from the checkpoint.
+"""
+import os
+import json
+import mmap
+import random
+import struct
+import numpy as np
+from machine import seed_random
+
+MAGIC = b"GPCKPT01"
+_header_len = struct.Struct("<Q")
+
+def _align(n):
+    return (n+7)//8*8
+
+def _pack_genomes(genomes):
+    offsets = np.zeros(len(genomes)+1, dtype=np.int64)
+    np.cumsum([len(g) for g in genomes], out=offsets[1:])
+    return np.frombuffer(b"".join(genomes), dtype=np.uint8), offsets
+
+def _unpack_genomes(data, offsets):
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+def save_checkpoint(path, evolution, experiment):
+    """Save full state of the evolution and of the random generators.
+    experiment is a dict of experiment parameters, must have 'function' and 'expected' keys.
+    Fixed initial states of the fitness are saved too, if it has them"""
+    np_name, np_keys, np_pos, np_has_gauss, np_gauss = np.random.get_state()
+    #state of the C rand() can not be read, so it is reseeded with the stored seed
+    c_seed = int.from_bytes(os.urandom(4), 'little')
+    seed_random(c_seed)
+
+    cache_genomes = list(evolution.cache.memory.keys())
+    genomes_data, genomes_offsets = _pack_genomes(evolution.genomes)
+    cache_data, cache_offsets = _pack_genomes(cache_genomes)
+    arrays = {
+        'genomes': genomes_data,
+        'genome_offsets': genomes_offsets,
+        'survivor_fitness': np.array([f for f, g in evolution.survivors], dtype=np.float64).reshape(-1, 4),
+        'cache_genomes': cache_data,
+        'cache_offsets': cache_offsets,
+        'cache_fitness': np.array(list(evolution.cache.memory.values()), dtype=np.float64).reshape(-1, 4),
+        'numpy_random_keys': np.asarray(np_keys, dtype=np.uint32),
+    }
+    if evolution.fitness.initial_states is not None:
+        arrays['initial_states'] = np.array(evolution.fitness.initial_states, dtype=np.float64)
+    header = {
+        'generation': evolution.generation,
+        'experiment': experiment,
+        'python_random_state': random.getstate(),
+        'numpy_random_state': [np_name, int(np_pos), int(np_has_gauss), float(np_gauss)],
+        'c_random_seed': c_seed,
+        'cache_stats': evolution.cache.stats(),
+        'sections': {}
+    }
+    #header has to know offsets of sections, which depend on the header length.
+    #offsets are relative to the end of the header
+    offset = 0
+    for name, arr in arrays.items():
+        header['sections'][name] = [offset, arr.dtype.str, list(arr.shape)]
+        offset = _align(offset + arr.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(MAGIC) + _header_len.size + len(header_bytes))
+    total = data_start + offset
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w+b") as hfile:
+        hfile.truncate(max(total, 1))
+        with mmap.mmap(hfile.fileno(), total) as mm:
+            mm[0:len(MAGIC)] = MAGIC
+            pos = len(MAGIC)
+            mm[pos:pos+_header_len.size] = _header_len.pack(len(header_bytes))
+            pos += _header_len.size
+            mm[pos:pos+len(header_bytes)] = header_bytes
+            for name, arr in arrays.items():
+                start = data_start + header['sections'][name][0]
+                mm[start:start+arr.nbytes] = arr.tobytes()
+            mm.flush()
+    os.replace(tmp_path, path)
+
+class Checkpoint:
+    """Checkpoint, loaded from file. Arrays are views of the memory-mapped file"""
+    def __init__(self, path):
+        with open(path, "rb") as hfile:
+            self.mm = mmap.mmap(hfile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[0:len(MAGIC)] != MAGIC:
+            raise ValueError(f"File {path} is not a checkpoint")
+        pos = len(MAGIC)
+        (header_len,) = _header_len.unpack_from(self.mm, pos)
+        pos += _header_len.size
+        self.header = json.loads(self.mm[pos:pos+header_len].decode("utf-8"))
+        data_start = _align(pos+header_len)
+        self.arrays = {}
+        for name, (offset, dtype, shape) in self.header['sections'].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            self.arrays[name] = np.frombuffer(self.mm, dtype=dtype, count=count,
+                                              offset=data_start+offset).reshape(shape)
+        self.generation = self.header['generation']
+        self.experiment = self.header['experiment']
+
+    def genomes(self):
+        return _unpack_genomes(self.arrays['genomes'], self.arrays['genome_offsets'])
+
+    def survivors(self):
+        genomes = self.genomes()
+        return [((dist, evals, steps, int(size)), g)
+                for (dist, evals, steps, size), g in zip(self.arrays['survivor_fitness'].tolist(), genomes)]
+
+    def cached_fitness(self):
+        genomes = _unpack_genomes(self.arrays['cache_genomes'], self.arrays['cache_offsets'])
+        return [(g, (dist, evals, steps, int(size)))
+                for g, (dist, evals, steps, size) in zip(genomes, self.arrays['cache_fitness'].tolist())]
+
+    def restore_random(self):
+        """Set states of all random generators to the saved ones"""
+        version, state, gauss = self.header['python_random_state']
+        random.setstate((version, tuple(state), gauss))
+        name, pos, has_gauss, cached_gaussian = self.header['numpy_random_state']
+        np.random.set_state((name, self.arrays['numpy_random_keys'].copy(), pos, has_gauss, cached_gaussian))
+        seed_random(self.header['c_random_seed'])
+
+    def initial_states(self):
+        """Fixed initial states of the fitness, or None if it used random ones"""
+        states = self.arrays.get('initial_states')
+        return None if states is None else states.copy()
+
+    def restore_evolution(self, evolution):
+        """Put the saved state to the evolution, created with the saved genomes and experiment.
+        Random generators are restored too"""
+        for genome, value in self.cached_fitness():
+            evolution.cache.memory[genome] = value
+        for counter, value in self.header['cache_stats'].items():
+            setattr(evolution.cache, counter, value)
+        evolution.generation = self.generation
+        evolution.survivors = self.survivors()
+        self.restore_random()
+
+    def close(self):
+        self.arrays = {}
+        self.mm.close()
+
+def load_checkpoint(path):
+    return Checkpoint(path)
@@ -31,30 +31,75 @@ def decompile_instruction(opcode, arg):
         code = "#" + code
     return code
 
+def _canonical_tables():
+    """Tables for canonicalize: canonical opcode for each opcode byte,
+    and argument translation table for each opcode byte"""
+    nop = machinedef.name2cmd['nop'].code
+    zero_args = bytes(256)
+    identity_args = bytes(range(256))
+    opcodes = bytearray()
+    arg_tables = []
+    for opcode in range(256):
+        command = machinedef.commands[opcode % len(machinedef.commands)]
+        if not command.enabled or command.argtype == machinedef.ArgType.NO:
+            #disabled commands are the same as nop
+            opcodes.append(command.code if command.enabled else nop)
+            arg_tables.append(zero_args)
+            continue
+        opcodes.append(command.code)
+        if command.argtype == machinedef.ArgType.VREG:
+            arg_tables.append(bytes(a%machinedef.NVECREG for a in range(256)))
+        elif command.argtype == machinedef.ArgType.FREG:
+            arg_tables.append(bytes(a%machinedef.NFLOATREG for a in range(256)))
+        elif command.argtype in (machinedef.ArgType.FVAL, machinedef.ArgType.LABEL):
+            arg_tables.append(identity_args)
+        else:
+            raise ValueError("Bad command code: {}".format(opcode))
+    return bytes(opcodes), arg_tables
+_canonical_opcodes, _canonical_args = _canonical_tables()
+
+def canonicalize(bincode):
+    """Normal form of the code: genomes, that are loaded to the same machine code,
+    have the same canonical form."""
+    ops = bincode[0:len(bincode)//2*2:2]
+    args = bincode[1::2]
+    canonical = bytearray(len(ops)*2)
+    canonical[0::2] = ops.translate(_canonical_opcodes)
+    canonical[1::2] = bytes(_canonical_args[op][arg] for op, arg in zip(ops, args))
+    return bytes(canonical)
+
 def decompile(bincode):    
     return "\n".join(filter(bool, (decompile_instruction(oc, arg)
                             for oc, arg in zip(bincode[::2],bincode[1::2]))))
 def map_jumps(code):
-    from machine import Machine, command_system_hash
+    return code_maps(code, live=False)[0]
+
+def code_maps(bincode, live=True, func_index=0, steps=10000, attempts=10):
+    """Jump map and live code map of the program, from one loaded machine.
+    Live code map is found by running the program several times, it is None if live is False"""
+    from machine import Machine, command_system_hash, FunctionTable
     assert command_system_hash() == machinedef.command_system_hash()
     m = Machine()
-    m.load_code(code)
+    m.load_code(bincode)
     jmap = {}
-    for i in range(0, len(code)-1, 2):
-        target = m.get_jump_index(i//2)*2
-        if target == -2: continue
+    for i, target in enumerate(m.jump_table()):
+        if target == -1: continue
+        i, target = i*2, target*2
         if target != i:
             #successfully found jump target
             jmap[i] = target
         else:
             #jump to self - special case. move to the next instruction
-            jmap[i] = (target + 2)%len(code)
-    return jmap
+            jmap[i] = (target + 2)%len(bincode)
+    live_code_map = None
+    if live:
+        func = FunctionTable(func_index)
+        m.set_function(func)
+        live_code_map = m.live_mask(attempts, steps)
+    return jmap, live_code_map
 
 def listing(bincode, ofile, show_dead_code=True):
-    jumpmap = map_jumps(bincode)
-    if show_dead_code:
-        live_code_map = map_live_code(bincode)
+    jumpmap, live_code_map = code_maps(bincode, live=show_dead_code)
     for i in range(0, len(bincode)-1,2):
         line = decompile_instruction(bincode[i],bincode[i+1])
         if i in jumpmap:
@@ -65,17 +110,7 @@ def listing(bincode, ofile, show_dead_code=True):
 
 def map_live_code(bincode, func_index=0, steps=10000, attempts = 10):
     """Run the program several times to get live code map"""
-    from machine import Machine, command_system_hash, FunctionTable
-    assert command_system_hash() == machinedef.command_system_hash()
-    m = Machine()
-    m.load_code(bincode)
-    m.set_trace_live_code(True)
-    m.set_function(FunctionTable(func_index))
-    for i in range(attempts):
-        if i != 0: m.reset()
-        m.steps(steps)
-    #now map is ready
-    return [m.is_instruction_live(i) for i in range(len(bincode)//2)]
+    return code_maps(bincode, True, func_index, steps, attempts)[1]
         
 if __name__=="__main__":
     from utils import load_code
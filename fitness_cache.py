@@ -0,0 +1,110 @@
+import hashlib
+import struct
+import dbm
+from collections import OrderedDict
+from machine import FunctionTable, command_system_hash
+
+def function_key(func):
+    """String, identifying objective function for the cache"""
+    if isinstance(func, int):
+        return f"table:{func}"
+    if isinstance(func, FunctionTable):
+        return f"table:{func.index}"
+    key = getattr(func, 'cache_key', None)
+    if key is None:
+        raise TypeError(f"Function {func!r} has no cache_key, its values can not be cached")
+    return key
+
+class FitnessCache:
+    """Cache of fitness values of genomes.
+
+    Values are kept in the in-memory LRU tier, and, if path is given,
+    in the on-disk database that survives restarts.
+    Cache is valid for the single set of (func, expected, fitness parameters, command system),
+    they are included into the key of the disk tier, so several runs can share one database.
+    """
+    _value_format = struct.Struct("<4d")
+
+    def __init__(self, fitness, func, expected, maxsize=100000, path=None):
+        context = (function_key(func),
+                   tuple(expected),
+                   fitness.maxsteps,
+                   fitness.maxevals,
+                   fitness.tol,
+                   fitness.average_attempts,
+                   command_system_hash())
+        #values of the successive halving differ for the eliminated genomes
+        if getattr(fitness, 'tiers', 1) > 1:
+            context += (fitness.tiers, fitness.eta)
+        #raced values are means of the partial attempts
+        if getattr(fitness, 'supports_racing', False) and fitness.racing_increment:
+            context += ('racing', fitness.racing_increment, fitness.racing_z)
+        #fixed initial states give other values, than random ones
+        if fitness.initial_states is not None:
+            context += (hashlib.sha1(memoryview(fitness.initial_states).cast('B')).hexdigest(),)
+        self.prefix = hashlib.sha1(repr(context).encode("utf-8")).digest()
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.db = dbm.open(path, 'c') if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_key(self, genome):
+        return hashlib.sha1(self.prefix + genome).digest()
+
+    def _remember(self, genome, value):
+        self.memory[genome] = value
+        self.memory.move_to_end(genome)
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def get(self, genome):
+        """Return cached fitness or None, updates hit/miss counters"""
+        value = self.memory.get(genome)
+        if value is not None:
+            self.memory.move_to_end(genome)
+            self.hits += 1
+            return value
+        if self.db is not None:
+            data = self.db.get(self._disk_key(genome))
+            if data is not None:
+                dist, evals, steps, size = self._value_format.unpack(data)
+                value = (dist, evals, steps, int(size))
+                self._remember(genome, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, genome, value):
+        self._remember(genome, tuple(value))
+        if self.db is not None:
+            self.db[self._disk_key(genome)] = self._value_format.pack(*value)
+
+    def evaluate(self, genomes, evaluate_many, cacheable=None):
+        """Return list of fitnesses of the genomes.
+        Only genomes missing in the cache are passed to evaluate_many, each genome once.
+        If cacheable is given, new values for which it returns False are not stored.
+        """
+        values = [self.get(g) for g in genomes]
+        missing = list(OrderedDict.fromkeys(g for g, v in zip(genomes, values) if v is None))
+        if missing:
+            new_values = dict(zip(missing, evaluate_many(missing)))
+            for g, v in new_values.items():
+                if cacheable is None or cacheable(v):
+                    self.put(g, v)
+            values = [new_values[g] if v is None else v
+                      for g, v in zip(genomes, values)]
+        return values
+
+    def stats(self):
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -1,5 +1,49 @@
-from machinedef import commands, NVECREG, NFLOATREG, command_system, command_system_hash
+from machinedef import commands, name2cmd, NVECREG, NFLOATREG, command_system, command_system_hash
 import os
+import re
+import json
+
+#Frequent command sequences, fused into superinstructions.
+#Overridden by the file, written by profile_opcodes.py
+superinstructions_file = "superinstructions.json"
+default_superinstructions = [
+    ["vload", "vless", "iftrue_up"],
+    ["vload", "vless", "iftrue_down"],
+    ["vload", "vless", "iffalse_up"],
+    ["vload", "vless", "iffalse_down"],
+    ["fload", "fless_value"],
+    ["fless_value", "iftrue_up"],
+    ["fless_value", "iffalse_up"],
+    ["vless", "iftrue_up"],
+    ["vless", "iffalse_up"],
+]
+
+def load_superinstructions():
+    """List of command sequences for the superinstructions. Sequences with disabled
+    or unknown commands are skipped, jumps may be only the last command"""
+    if os.path.exists(superinstructions_file):
+        with open(superinstructions_file) as hfile:
+            sequences = json.load(hfile)['superinstructions']
+    else:
+        sequences = default_superinstructions
+    result = []
+    for names in sequences:
+        if len(names) < 2 or not all(n in name2cmd for n in names): continue
+        cmds = [name2cmd[n] for n in names]
+        if not all(c.enabled for c in cmds): continue
+        if any('j' in c.changes for c in cmds[:-1]): continue
+        if cmds not in result: result.append(cmds)
+    #longer sequences are matched first
+    result.sort(key=len, reverse=True)
+    return result
+
+def superinstruction_name(cmds):
+    return "super_" + "__".join(c.name for c in cmds)
+
+def evaluated_points(cmd):
+    """Expressions of points, evaluated by the command"""
+    if not cmd.enabled: return []
+    return re.findall(r"evaluate\((.+?)\);", cmd.cppcode)
 
 def make_header(ofile):
     ofile.write(f"#define NVECREG {NVECREG}\n")
@@ -10,6 +54,13 @@ def make_header(ofile):
         ofile.write(f"    cmd_{cmd.name},{comment}\n")
     ofile.write("};\n")
     ofile.write(f"const command cmd_max=static_cast<command>(cmd_{commands[-1].name}+1);\n")
+    max_pending = max(len(evaluated_points(cmd)) for cmd in commands)
+    ofile.write(f"#define MAX_PENDING_POINTS {max_pending}\n")
+    ofile.write("//superinstructions have codes after the commands\n")
+    ofile.write("enum superinstruction{\n")
+    for k, cmds in enumerate(load_superinstructions()):
+        ofile.write(f"    {superinstruction_name(cmds)} = {len(commands)+k},\n")
+    ofile.write("};\n")
     ofile.write("std::ostream &operator <<(std::ostream &os, command c);\n")
     ofile.write("argument_type get_argument_type(i8 command);\n")
 
@@ -40,6 +91,43 @@ argument_type get_argument_type(i8 command)
 }
 """)
 
+def make_command_body(ofile, cmd, tracing=True):
+    """Code of the command, executed with instr referencing the instruction"""
+    if not cmd.enabled:
+        ofile.write("    /*Command disabled*/\n")
+        return
+    if cmd.condition is not None:
+        ofile.write('    if ({}flag){{\n'.format('' if cmd.condition else '!'))
+    ofile.write(cmd.cppcode)
+    if 'vr' in cmd.changes:
+        ofile.write('    vec_registers_changed[instr.arg_index]=true;\n')
+    if tracing:
+        if "f" in cmd.changes:
+            ofile.write('    MTRACE(" => FLAG="<<flag);\n')
+        if 'va' in cmd.changes:
+            ofile.write('    MTRACE(" => VACC="<<vec_accum);\n')
+        if 'vr' in cmd.changes:
+            ofile.write('    MTRACE(" => VREG["<<instr.arg_index<<"]="<<VEC_REGISTER);\n')
+        if 'fa' in cmd.changes:
+            ofile.write('    MTRACE(" => FACC="<<float_accum);\n')
+        if 'fr' in cmd.changes:
+            ofile.write('    MTRACE(" => FREG["<<instr.arg_index<<"]="<<FLOAT_REGISTER);\n')
+        if 'j' in cmd.changes:
+            ofile.write('    MTRACE(" => JMP to"<<cpr);\n')
+    if cmd.condition is not None:
+        ofile.write('    }\n')
+
+def uses_instruction(cmd):
+    """Code of the command refers to the instruction"""
+    if not cmd.enabled: return False
+    return ('vr' in cmd.changes or
+            re.search(r"\binstr\b|VEC_REGISTER|FLOAT_REGISTER", cmd.cppcode) is not None)
+
+def make_instruction_ref(ofile, cmd):
+    """Reference to the current instruction, only if the command uses it"""
+    if uses_instruction(cmd):
+        ofile.write("    instruction &instr(code[cpr]);\n")
+
 def make_machine_step(ofile):
     ofile.write("""\
 #define VEC_REGISTER (vec_registers[instr.arg_index])
@@ -57,27 +145,7 @@ void Machine::step()
 """)
     for cmd in commands:
         ofile.write(f"    case cmd_{cmd.name}:{{\n")
-        if not cmd.enabled:
-            ofile.write("    /*Command disabled*/\n")
-        else:
-            if cmd.condition is not None:
-                ofile.write('    if ({}flag){{\n'.format('' if cmd.condition else '!'))
-            ofile.write(cmd.cppcode)
-            if "f" in cmd.changes:
-                ofile.write('    MTRACE(" => FLAG="<<flag);\n')
-            if 'va' in cmd.changes:
-                ofile.write('    MTRACE(" => VACC="<<vec_accum);\n')
-            if 'vr' in cmd.changes:
-                ofile.write('    vec_registers_changed[instr.arg_index]=true;\n')
-                ofile.write('    MTRACE(" => VREG["<<instr.arg_index<<"]="<<VEC_REGISTER);\n')
-            if 'fa' in cmd.changes:
-                ofile.write('    MTRACE(" => FACC="<<float_accum);\n')
-            if 'fr' in cmd.changes:
-                ofile.write('    MTRACE(" => FREG["<<instr.arg_index<<"]="<<FLOAT_REGISTER);\n')
-            if 'j' in cmd.changes:
-                ofile.write('    MTRACE(" => JMP to"<<cpr);\n')
-            if cmd.condition is not None:
-                ofile.write('    }\n')
+        make_command_body(ofile, cmd)
         ofile.write(f"    }}break;\n")
     ofile.write("""\
     }
@@ -91,6 +159,127 @@ void Machine::step()
 #undef FLOAT_REGISTER
 """)
 
+def make_fuse_instructions(ofile):
+    sequences = load_superinstructions()
+    ofile.write("""\
+void Machine::fuse_instructions()
+{
+  for(size_t i=0; i!=code.size(); ++i){
+    code[i].dispatch = code[i].cmd;
+""")
+    for cmds in sequences:
+        condition = " && ".join(f"code[i+{k}].cmd==cmd_{c.name}" for k, c in enumerate(cmds))
+        ofile.write(f"    if (i+{len(cmds)} <= code.size() && {condition}){{\n")
+        ofile.write(f"      code[i].dispatch = {superinstruction_name(cmds)};\n")
+        ofile.write( "      continue;\n")
+        ofile.write( "    }\n")
+    ofile.write("""\
+  }
+}
+""")
+
+def make_run_fast(ofile):
+    """Interpreter loop without tracing and live code hooks, with superinstructions.
+    Between the commands of a superinstruction it checks the same conditions as between the steps,
+    so number of steps and evaluations does not change. Without target, change of the register 0
+    does not stop the loop, so it does not interrupt superinstructions either"""
+    ofile.write("""\
+#define VEC_REGISTER (vec_registers[instr.arg_index])
+#define FLOAT_REGISTER (float_registers[instr.arg_index])
+bool Machine::run_fast(size_t maxsteps, size_t maxevals, const vec* target, double tol)
+{
+  while(nsteps < maxsteps && ncalls < maxevals){
+    if (target && vec_registers_changed[0]){
+      vec_registers_changed[0] = false;
+      if (norm(vec_registers[0].x-*target) <= tol){
+        return true;
+      }
+    }
+    if(code.size() ==0){
+      nsteps += 1;
+      continue;
+    }
+    switch(code[cpr].dispatch){
+""")
+    for cmd in commands:
+        ofile.write(f"    case cmd_{cmd.name}:{{\n")
+        make_instruction_ref(ofile, cmd)
+        ofile.write("    nsteps += 1;\n")
+        make_command_body(ofile, cmd, tracing=False)
+        ofile.write("    }break;\n")
+    for cmds in load_superinstructions():
+        ofile.write(f"    case {superinstruction_name(cmds)}:{{\n")
+        for k, cmd in enumerate(cmds):
+            if k != 0:
+                ofile.write("    if (!(nsteps < maxsteps && ncalls < maxevals) || (target && vec_registers_changed[0])) continue;\n")
+            ofile.write("    {\n")
+            make_instruction_ref(ofile, cmd)
+            ofile.write("    nsteps += 1;\n")
+            make_command_body(ofile, cmd, tracing=False)
+            if k != len(cmds)-1:
+                ofile.write("    ++cpr;\n")
+            ofile.write("    }\n")
+        ofile.write("    }break;\n")
+    ofile.write("""\
+    }
+    if (++cpr == code.size()) cpr = 0;
+  }
+  return false;
+}
+#undef VEC_REGISTER
+#undef FLOAT_REGISTER
+""")
+
+def make_run_instrumented(ofile):
+    """Interpreter loop with tracing and live code hooks: steps one by one"""
+    ofile.write("""\
+bool Machine::run_instrumented(size_t maxsteps, size_t maxevals, const vec* target, double tol)
+{
+  while(nsteps < maxsteps && ncalls < maxevals){
+    if (target && vec_registers_changed[0]){
+      vec_registers_changed[0] = false;
+      if (norm(vec_registers[0].x-*target) <= tol){
+        return true;
+      }
+    }
+    step();
+  }
+  return false;
+}
+""")
+
+def make_pending_points(ofile):
+    ofile.write("""\
+#define VEC_REGISTER (vec_registers[instr.arg_index])
+size_t Machine::pending_points(point **pending)
+{
+  size_t n = 0;
+  if(code.size() ==0) return 0;
+  instruction &instr(code[cpr]);
+  switch(instr.cmd){
+""")
+    for cmd in commands:
+        points = evaluated_points(cmd)
+        if not points: continue
+        ofile.write(f"    case cmd_{cmd.name}:\n")
+        indent = "      "
+        if cmd.condition is not None:
+            ofile.write('      if ({}flag){{\n'.format('' if cmd.condition else '!'))
+            indent += "  "
+        for p in points:
+            ofile.write(f"{indent}if (!{p}.evaluated) pending[n++] = &{p};\n")
+        if cmd.condition is not None:
+            ofile.write('      }\n')
+        ofile.write("      break;\n")
+    ofile.write("""\
+    default:
+      break;
+  }
+  return n;
+}
+#undef VEC_REGISTER
+""")
+
 def make_cpp(ofile):
     ofile.write( "const char *command_system_hash(){\n"
                 f'  return "{command_system_hash()}";\n'
@@ -98,6 +287,10 @@ def make_cpp(ofile):
     make_cmd2str(ofile)
     make_get_argument_type(ofile)
     make_machine_step(ofile)
+    make_fuse_instructions(ofile)
+    make_run_fast(ofile)
+    make_run_instrumented(ofile)
+    make_pending_points(ofile)
 import hashlib
 
 def store_hash():
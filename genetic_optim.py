@@ -1,9 +1,18 @@
 #!/usr/bin/env python
 import random
 import json
+import threading
+import math
+from itertools import cycle, islice
+import numpy as np
 from numpy.random import exponential
-from machine import randomize, Machine, FunctionTable, command_system_hash
+from machine import randomize, Machine, FunctionTable, command_system_hash, evaluate_population, race_population, random_initial_states
+from disassembler import canonicalize
+from fitness_cache import FitnessCache
+from utils import load_code
 
+poolsize = 1000
+topsize = 300
 initial_genome_range = (50, 1500)
 mutate_percent = 0.05
 maxgenome = 500
@@ -12,35 +21,82 @@ mutate_percent = 0.05
 average_duplication_len = 10
 crossover_signature_len = 6
 crossover_search_radius = 12
+#Evaluate generation in the native thread pool instead of the process pool
+native_evaluator = True
+#0 means use all hardware threads
+evaluator_threads = 0
+#Path of the on-disk fitness cache. None to use only in-memory cache
+fitness_cache_path = None
+fitness_cache_size = 100000
+#Racing: genomes that surely can not enter the top are evaluated with fewer attempts.
+#Attempts are made in increments, evaluation stops when mean+racing_z*stddev/sqrt(n) of the distance is below the top cutoff.
+#0 disables racing. These are the defaults of the Fitness parameters
+racing_increment = 5
+racing_z = 2.0
+#Successive halving: number of budget tiers (1 disables it) and reduction factor between the tiers
+halving_tiers = 1
+halving_eta = 3
 
 def create_individual():
     genomelen = random.randint(*initial_genome_range)
     return bytes([random.randint(0, 255) for _ in range(genomelen//2*2)])
 
+_thread_state = threading.local()
+def worker_machine():
+    """Machine, reused by all evaluations in the current thread"""
+    m = getattr(_thread_state, 'machine', None)
+    if m is None:
+        m = _thread_state.machine = Machine()
+    return m
+
 class Fitness:
+    #Evolution can race genomes against the top cutoff
+    supports_racing = True
     def __init__(self,
                  maxsteps=10000,
                  maxevals=1000,
                  tol=1e-5,
-                 average_attempts=100):
-        
+                 average_attempts=100,
+                 initial_states=None,
+                 racing_increment=racing_increment,
+                 racing_z=racing_z):
+        """initial_states: optional buffer of initial states for the attempts (see random_initial_states).
+        If not given, random states are generated for every genome.
+        racing_increment, racing_z: parameters of racing (see race)"""
         self.maxsteps = maxsteps
         self.maxevals = maxevals
         self.tol = tol
         self.average_attempts = average_attempts
+        self.initial_states = initial_states
+        self.racing_increment = racing_increment
+        self.racing_z = racing_z
         
     def __call__(self, genome, func, expected):
+        return self.race(genome, func, expected)[0]
+
+    def race(self, genome, func, expected, threshold=None):
+        """Evaluate fitness of the genome, return pair (fitness, number of attempts).
+        If threshold is given and racing is enabled, attempts are made in increments of self.racing_increment,
+        and evaluation stops when the upper confidence bound of the mean distance,
+        mean + self.racing_z*stddev/sqrt(n), is below the threshold: genome can not enter the top"""
         assert isinstance(genome, bytes)
         norms = 0.0
+        norms2 = 0.0
         evals = 0.0
         steps = 0.0
+        increment = self.racing_increment if threshold is not None else None
+        i = 0
 
-        m = Machine()
+        m = worker_machine()
         m.set_function(func)
         m.load_code(genome)
+        if self.initial_states is not None:
+            m.set_initial_states(self.initial_states)
+        else:
+            m.set_initial_states(random_initial_states(self.average_attempts))
 
-        for i in range(self.average_attempts):
-            if i != 0: m.reset()
+        for i in range(1, self.average_attempts+1):
+            m.reset()
             reached = m.runto(maxsteps=self.maxsteps,
                               maxevals=self.maxevals,
                               target=expected,
@@ -54,13 +110,121 @@ class Fitness:
             if m.ncalls < 10:
                 main -= 10.0 * (10-m.ncalls)
             norms += main
+            norms2 += main*main
+            if increment and i % increment == 0 and i < self.average_attempts and i > 1:
+                mean = norms / i
+                std = math.sqrt(max(0.0, (norms2 - i*mean*mean)/(i-1)))
+                if mean + self.racing_z*std/math.sqrt(i) < threshold:
+                    break
 
-        return ( norms / self.average_attempts,
-                 -evals/ self.average_attempts,
-                 -steps/ self.average_attempts,
-                 -len(genome) ) #allow 100 bytes for free
+        n = max(i, 1)
+        fitness = ( norms / n,
+                    -evals/ n,
+                    -steps/ n,
+                    -len(genome) ) #allow 100 bytes for free
+        return fitness, i
+    def cacheable(self, value):
+        """Value does not depend on the other genomes, evaluated together"""
+        return True
     def callstar(self, gfe):
         return self(*gfe)
+    def racestar(self, gfet):
+        return self.race(*gfet)
+    def evaluate_population(self, genomes, func, expected, executor=None, threads=0):
+        """Evaluate list of genomes, return list of fitness tuples.
+        If executor is given, genomes are evaluated by it, otherwise by the native thread pool"""
+        if executor is not None:
+            return list(executor.map(self.callstar,
+                                     [(g, func, expected) for g in genomes]))
+        values = evaluate_population(genomes, func, expected,
+                                     maxsteps=self.maxsteps,
+                                     maxevals=self.maxevals,
+                                     tol=self.tol,
+                                     attempts=self.average_attempts,
+                                     threads=threads,
+                                     initial_states=self.initial_states)
+        return [(values[i], values[i+1], values[i+2], int(values[i+3]))
+                for i in range(0, len(values), 4)]
+    def race_population(self, genomes, func, expected, threshold, executor=None, threads=0):
+        """Like evaluate_population, but with racing against the threshold (see race).
+        Returns pair: list of fitness tuples and list of numbers of attempts"""
+        if executor is not None:
+            raced = list(executor.map(self.racestar,
+                                      [(g, func, expected, threshold) for g in genomes]))
+            return [f for f, n in raced], [n for f, n in raced]
+        values, used = race_population(genomes, func, expected,
+                                       maxsteps=self.maxsteps,
+                                       maxevals=self.maxevals,
+                                       tol=self.tol,
+                                       attempts=self.average_attempts,
+                                       threshold=threshold,
+                                       increment=self.racing_increment,
+                                       z=self.racing_z,
+                                       threads=threads,
+                                       initial_states=self.initial_states)
+        return ([(values[i], values[i+1], values[i+2], int(values[i+3]))
+                 for i in range(0, len(values), 4)],
+                list(used))
+
+class SuccessiveHalving(Fitness):
+    """Fitness, evaluated in budget tiers, like successive halving of Hyperband.
+    All genomes are evaluated with the smallest budget: maxsteps, maxevals and attempts divided by eta**(tiers-1).
+    The best 1/eta of them are promoted to the next tier with eta times larger budget,
+    and so on up to the full budget in the last tier.
+    Genomes, eliminated at the lower tiers, get distance -inf and evaluations/steps of their last tier;
+    these values are not cached, because they depend on the other genomes of the generation.
+    """
+    supports_racing = False
+    def __init__(self,
+                 maxsteps=10000,
+                 maxevals=1000,
+                 tol=1e-5,
+                 average_attempts=100,
+                 initial_states=None,
+                 tiers=3,
+                 eta=3):
+        super().__init__(maxsteps, maxevals, tol, average_attempts, initial_states)
+        self.tiers = tiers
+        self.eta = eta
+        #budget, spent at each tier by the last evaluate_population
+        self.budget = []
+
+    def cacheable(self, value):
+        #distance of the eliminated genomes depends on the genomes they competed with
+        return value[0] != -math.inf
+
+    def tier_fitness(self, tier):
+        scale = self.eta ** (self.tiers-1-tier)
+        return Fitness(maxsteps = max(1, self.maxsteps//scale),
+                       maxevals = max(1, self.maxevals//scale),
+                       tol = self.tol,
+                       average_attempts = max(1, self.average_attempts//scale),
+                       initial_states = self.initial_states)
+
+    def evaluate_population(self, genomes, func, expected, executor=None, threads=0):
+        values = [None]*len(genomes)
+        active = list(range(len(genomes)))
+        self.budget = []
+        for tier in range(self.tiers):
+            fitness = self.tier_fitness(tier)
+            tier_values = fitness.evaluate_population([genomes[i] for i in active], func, expected,
+                                                      executor=executor, threads=threads)
+            self.budget.append({'maxsteps': fitness.maxsteps,
+                                'maxevals': fitness.maxevals,
+                                'attempts': fitness.average_attempts,
+                                'genomes': len(active),
+                                'steps': -sum(v[2] for v in tier_values)*fitness.average_attempts})
+            for i, v in zip(active, tier_values):
+                values[i] = v
+            if tier == self.tiers-1 or not active:
+                break
+            order = sorted(range(len(active)), key=lambda k: tier_values[k], reverse=True)
+            keep = -(-len(active)//self.eta)
+            for k in order[keep:]:
+                values[active[k]] = (-math.inf,) + tuple(tier_values[k][1:])
+            active = sorted(active[k] for k in order[:keep])
+        return values
+
 def crossover(parent_1, parent_2):
     """Crossover (mate) two parents to produce two children.
 
@@ -69,25 +233,7 @@ def crossover(parent_1, parent_2):
     :returns: tuple containing two children
 
     """
-    index1 = random.randrange(0, len(parent_1)) if parent_1 else 0
-
-    def similarity(bytes1, bytes2):
-        return sum(abs(b1-b2) for b1,b2 in zip(bytes1, bytes2))/min(len(bytes1),len(bytes2))
-
-    crossover_signature = parent_1[index1:index1+crossover_signature_len]
-
-    search_range = range(max(0, index1-crossover_search_radius),
-                       min(len(parent_2), index1+crossover_search_radius))
-    if len(search_range) == 0:
-        index2 = random.randint(0,len(parent_2)-1)
-    else:
-        index2 = min(search_range,
-                     key = lambda idx: similarity(crossover_signature,
-                                                  parent_2[idx:idx+crossover_signature_len]))
-    
-    child_1 = parent_1[:index1] + parent_2[index2:]
-    child_2 = parent_2[:index1] + parent_1[index2:]
-    return child_1, child_2
+    return crossover_batch([parent_1], [parent_2])[0]
 
 
 def mutate(individual):
@@ -128,17 +274,177 @@ def mutate(individual):
     return bytes(individual)
 
 
-def makenew():
-    key = random.randint(0,10)
-    if key == 0:
-        return (create_individual(),)
-    elif 1<=key<=5:
-        return (mutate(random.choice(fgenome)[1]),)
-    elif 6<=key<=10:
-        return crossover(random.choice(fgenome)[1],
-                         random.choice(fgenome)[1])
-    else:
-        raise ValueError(key)
+def unique_canonical(genomes, known=()):
+    """Genomes, whose canonical forms are not in known and do not repeat, in the original order.
+    Genomes are kept as they are: neutral bytes take part in the mutations and crossovers"""
+    seen = set(known)
+    unique = []
+    for g in genomes:
+        key = canonicalize(g)
+        if key not in seen:
+            seen.add(key)
+            unique.append(g)
+    return unique
+
+class GenomeBatch:
+    """Many genomes, stored in one uint8 buffer.
+    i'th genome is data[offsets[i]:offsets[i+1]]"""
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+    @classmethod
+    def from_genomes(cls, genomes):
+        offsets = np.zeros(len(genomes)+1, dtype=np.int64)
+        np.cumsum([len(g) for g in genomes], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(genomes), dtype=np.uint8), offsets)
+    @classmethod
+    def concatenate(cls, batches):
+        data = np.concatenate([b.data for b in batches])
+        sizes = np.concatenate([np.diff(b.offsets) for b in batches])
+        offsets = np.zeros(len(sizes)+1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        return cls(data, offsets)
+    def __len__(self):
+        return len(self.offsets)-1
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes()
+    def view(self, i):
+        """Genome i as uint8 array, sharing the memory of the batch. Machine.load_code accepts it"""
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+    def genomes(self):
+        """List of genomes as bytes"""
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        return [data[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+def random_individuals(count):
+    """Batch version of create_individual"""
+    lengths = np.random.randint(initial_genome_range[0], initial_genome_range[1]+1, count)//2*2
+    offsets = np.zeros(count+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return GenomeBatch(np.random.randint(0, 256, offsets[-1], dtype=np.uint8), offsets)
+
+def _even_rand(avg, size):
+    return np.rint(np.random.exponential(avg/2, size)).astype(np.int64)*2+2
+def _any_rand(avg, size):
+    return np.rint(np.random.exponential(avg, size)).astype(np.int64)+1
+
+def mutate_batch(genomes):
+    """Batch version of mutate, with the same distribution of mutations.
+    All random values are drawn at once, then mutations are applied to the genomes.
+    Returns GenomeBatch"""
+    lengths = np.fromiter(map(len, genomes), dtype=np.int64, count=len(genomes))
+    num_mutations = np.rint(exponential(lengths*mutate_percent)).astype(np.int64)+1
+    total = int(num_mutations.sum())
+    #mutation type: insert/replace/delete/duplicate
+    mut_types = np.random.randint(0, 4, total)
+    mut_lengths = np.where(mut_types == 1,
+                           _any_rand(average_mutation_len, total),
+                           _even_rand(average_mutation_len, total))
+    is_duplicate = mut_types == 3
+    mut_lengths[is_duplicate] = _even_rand(average_duplication_len, total)[is_duplicate]
+    #random data for insertions and replacements
+    payload_lengths = np.where(mut_types <= 1, mut_lengths, 0)
+    payload_offsets = np.zeros(total+1, dtype=np.int64)
+    np.cumsum(payload_lengths, out=payload_offsets[1:])
+    payload = np.random.randint(0, 256, payload_offsets[-1], dtype=np.uint8).tobytes()
+    #positions are drawn as fractions of the current genome length
+    positions = np.random.random_sample(total).tolist()
+    sources = np.random.random_sample(total).tolist()
+
+    mut_types = mut_types.tolist()
+    mut_lengths = mut_lengths.tolist()
+    payload_offsets = payload_offsets.tolist()
+    children = []
+    start = 0
+    for genome, n in zip(genomes, num_mutations.tolist()):
+        values = bytearray(genome)
+        for j in range(start, start+n):
+            mut_type, mut_length = mut_types[j], mut_lengths[j]
+            if mut_type <= 2:
+                mut_position = int(positions[j]*(len(values)+1))
+                if mut_type == 0:
+                    values[mut_position:mut_position] = payload[payload_offsets[j]:payload_offsets[j+1]]
+                elif mut_type == 1:
+                    values[mut_position:mut_position+mut_length] = payload[payload_offsets[j]:payload_offsets[j+1]]
+                else:
+                    del values[mut_position:mut_position+mut_length]
+            else:
+                source_pos = int(sources[j]*(len(values)//2+1))*2
+                insert_pos = int(positions[j]*(len(values)//2+1))*2
+                values[insert_pos:insert_pos] = values[source_pos:source_pos+mut_length]
+        start += n
+        children.append(values)
+    return GenomeBatch.from_genomes(children)
+
+def _gather(batch, positions, valid):
+    """Bytes batch[i][positions[i,...]] as int16 array, 0 where not valid"""
+    data = np.append(batch.data, np.uint8(0))
+    flat = batch.offsets[:-1].reshape((-1,)+(1,)*(positions.ndim-1)) + positions
+    return np.where(valid, data[np.clip(flat, 0, len(data)-1)], 0).astype(np.int16)
+
+def crossover_batch(parents_1, parents_2):
+    """Crossover of many pairs of parents at once, same as crossover.
+    Crossover point in the second parent is the most similar to the signature at the crossover point
+    in the first parent; similarity of all candidate windows of all pairs is calculated at once.
+    Returns list of pairs of children
+    """
+    batch_1 = GenomeBatch.from_genomes(parents_1)
+    batch_2 = GenomeBatch.from_genomes(parents_2)
+    len_1 = np.diff(batch_1.offsets)
+    len_2 = np.diff(batch_2.offsets)
+    npairs = len(len_1)
+    index1 = (np.random.random_sample(npairs)*len_1).astype(np.int64)
+
+    shifts = np.arange(crossover_signature_len)
+    signature_pos = index1[:,None] + shifts
+    signature_valid = signature_pos < len_1[:,None]
+    signature = _gather(batch_1, signature_pos, signature_valid)
+
+    candidates = index1[:,None] + np.arange(-crossover_search_radius, crossover_search_radius)
+    candidate_valid = (candidates >= 0) & (candidates < len_2[:,None])
+    window_pos = candidates[:,:,None] + shifts
+    #window byte is compared, if both signature and window have it
+    valid = (candidate_valid[:,:,None] & signature_valid[:,None,:]
+             & (window_pos < len_2[:,None,None]))
+    windows = _gather(batch_2, window_pos, valid)
+    distance = (np.abs(windows - signature[:,None,:])*valid).sum(axis=2)
+    similarity = np.where(candidate_valid,
+                          distance/np.maximum(valid.sum(axis=2), 1),
+                          np.inf)
+    index2 = candidates[np.arange(npairs), similarity.argmin(axis=1)]
+    #no candidates in the search range: random crossover point
+    no_candidates = ~candidate_valid.any(axis=1)
+    index2[no_candidates] = (np.random.random_sample(no_candidates.sum())
+                             *np.maximum(len_2[no_candidates], 1)).astype(np.int64)
+
+    children = []
+    for parent_1, parent_2, i1, i2 in zip(parents_1, parents_2, index1.tolist(), index2.tolist()):
+        children.append((parent_1[:i1] + parent_2[i2:],
+                         parent_2[:i1] + parent_1[i2:]))
+    return children
+
+def breed_generation(parents, count):
+    """Create at least count children of the parents.
+    Like the single individual operators: 1/11 of children are new random individuals,
+    5/11 are mutants, 5/11 are crossovers, producing 2 children each.
+    Returns GenomeBatch"""
+    if count <= 0:
+        return GenomeBatch.from_genomes([])
+    keys = np.random.randint(0, 11, count)
+    produced = np.cumsum(np.where(keys >= 6, 2, 1))
+    keys = keys[:int(np.searchsorted(produced, count))+1]
+    n_new = int((keys == 0).sum())
+    n_mutants = int(((keys >= 1) & (keys <= 5)).sum())
+    n_pairs = int((keys >= 6).sum())
+    chosen = np.random.randint(0, len(parents), n_mutants + 2*n_pairs).tolist()
+    crossed = []
+    for children in crossover_batch([parents[i] for i in chosen[n_mutants::2]],
+                                    [parents[i] for i in chosen[n_mutants+1::2]]):
+        crossed.extend(children)
+    return GenomeBatch.concatenate([random_individuals(n_new),
+                                   mutate_batch([parents[i] for i in chosen[:n_mutants]]),
+                                   GenomeBatch.from_genomes(crossed)])
 
 class IndividualBase(object):
     def __init__(self, genome):
@@ -151,37 +457,27 @@ class Individual(IndividualBase):
         self.machine = Machine()
         self.machine.load_code(genome)
         
-if __name__=="__main__":
-    from itertools import cycle, islice
-    from utils import load_code
-    poolsize = 1000
-    topsize = 300
-
-    #initial = ["nmead.json"]
-    initial = []
-    
+def initial_population(initial, poolsize):
+    """Random population, or copies of the genomes from the initial files"""
     if not initial:
         #random initilization
-        genome = [create_individual() for _ in range(poolsize)]
-    else:
-        #non-random init
-        initial_genomes = [load_code(fname) for fname in initial]
-        genome = list(islice(cycle(initial_genomes), poolsize))
-        
-    randomize()
-    
-    fitness = Fitness(maxsteps = 10000,
-                      maxevals = 1000,
-                      tol = 1e-5)
-    func, expected  = (0), (1.0,1.0)
+        return random_individuals(poolsize).genomes()
+    #non-random init
+    initial_genomes = [load_code(fname) for fname in initial]
+    return list(islice(cycle(initial_genomes), poolsize))
 
-    print(json.dumps({'experiment':{
+def experiment_parameters(fitness, poolsize, topsize, initial):
+    return {
         'poolsize': poolsize,
         'topsize': topsize,
         'maxsteps': fitness.maxsteps,
         'maxevals': fitness.maxevals,
         'tol': fitness.tol,
         'average_attempts': fitness.average_attempts,
+        'racing_increment': fitness.racing_increment,
+        'racing_z': fitness.racing_z,
+        'halving_tiers': getattr(fitness, 'tiers', 1),
+        'halving_eta': getattr(fitness, 'eta', None),
         'initial_population': initial,
         'initial_genome_range': initial_genome_range,
         'mutate_percent': mutate_percent,
@@ -192,36 +488,184 @@ if __name__=="__main__":
         'crossover_signature_len': crossover_signature_len,
         'crossover_search_radius': crossover_search_radius,
         'command_system_hash': command_system_hash()
-    }}))
-        
-    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
-    #executor = ThreadPoolExecutor()
-    executor = ProcessPoolExecutor()
-    gen = 0
-    while True:
-        gen += 1
-        #fgenome = [(fitness(g, func, expected),g) for g in genome]
-        #fgenome = list(executor.map((lambda g: (fitness(g, func, expected),g)),
-        #                       genome))
-        ffs = (executor.map(fitness.callstar,
-                            [(g, func, expected) for g in genome]))
-        fgenome = list(zip(ffs, genome))
-
-        #print(fgenome)
-        #exit(1)
+    }
+
+def fitness_from_parameters(experiment, initial_states=None):
+    """Fitness, described by the experiment parameters (see experiment_parameters)"""
+    e = experiment
+    parameters = dict(maxsteps=e['maxsteps'],
+                      maxevals=e['maxevals'],
+                      tol=e['tol'],
+                      average_attempts=e['average_attempts'],
+                      initial_states=initial_states)
+    if e.get('halving_tiers', 1) > 1:
+        return SuccessiveHalving(tiers=e['halving_tiers'], eta=e['halving_eta'], **parameters)
+    return Fitness(racing_increment=e.get('racing_increment', racing_increment),
+                   racing_z=e.get('racing_z', racing_z),
+                   **parameters)
+
+class Evolution:
+    """Population, evolving by evaluation, selection of the top individuals and breeding"""
+    def __init__(self, genomes, fitness, func, expected, poolsize, topsize,
+                 cache=None, executor=None, threads=0):
+        #equivalent programs are evaluated only once
+        self.genomes = unique_canonical(genomes)
+        self.fitness = fitness
+        self.func = func
+        self.expected = expected
+        self.poolsize = poolsize
+        self.topsize = topsize
+        self.cache = cache if cache is not None else FitnessCache(fitness, func, expected)
+        self.executor = executor
+        self.threads = threads
+        self.generation = 0
+        #sorted list of pairs (fitness, genome)
+        self.survivors = []
+        #number of attempts, made in the last generation
+        self.attempts = 0
+        #budget tiers of the last generation, if fitness is SuccessiveHalving
+        self.budget = None
+
+    def threshold(self):
+        """Distance of the worst individual of the top, or None if the top is not full yet"""
+        if not self.fitness.supports_racing or not self.fitness.racing_increment or len(self.survivors) < self.topsize:
+            return None
+        return self.survivors[-1][0][0]
+
+    def evaluate(self, genomes):
+        threshold = self.threshold()
+        def evaluate_many(missing):
+            if threshold is None:
+                values = self.fitness.evaluate_population(missing, self.func, self.expected,
+                                                          executor=self.executor,
+                                                          threads=self.threads)
+                self.budget = getattr(self.fitness, 'budget', None)
+                if self.budget is not None:
+                    self.attempts += sum(tier['genomes']*tier['attempts'] for tier in self.budget)
+                else:
+                    self.attempts += len(missing)*self.fitness.average_attempts
+                return values
+            values, used = self.fitness.race_population(missing, self.func, self.expected, threshold,
+                                                        executor=self.executor,
+                                                        threads=self.threads)
+            self.attempts += sum(used)
+            return values
+        self.attempts = 0
+        self.budget = None
+        #equivalent programs have the same fitness, cache is keyed by the canonical form
+        return self.cache.evaluate(list(map(canonicalize, genomes)), evaluate_many,
+                                   cacheable=self.fitness.cacheable)
+    def select(self):
+        fgenome = list(zip(self.evaluate(self.genomes), self.genomes))
         fgenome.sort(key = lambda ab:ab[0], reverse=True)
-        fgenome = fgenome[:topsize]
-        #if gen%100 == 0:
-        #print(gen,"\t",fgenome[0])
-        f, genome = fgenome[0]
-        print(json.dumps({
-            'generation': gen,
+        self.survivors = fgenome[:self.topsize]
+
+    def breed(self):
+        parents = [g for f,g in self.survivors]
+        genome = list(parents)
+        known = set(map(canonicalize, genome))
+        while len(genome) < self.poolsize:
+            for new in breed_generation(parents, self.poolsize-len(genome)).genomes():
+                new = new[:maxgenome]
+                key = canonicalize(new)
+                if key not in known:
+                    known.add(key)
+                    genome.append(new)
+        self.genomes = genome
+
+    def step(self):
+        """Make one generation, return its log record"""
+        self.generation += 1
+        self.select()
+        f, genome = self.survivors[0]
+        self.breed()
+        return {
+            'generation': self.generation,
             'fitness': f,
             'hexcode': genome.hex(),
-            'command_system_hash': command_system_hash()
-        }))
+            'command_system_hash': command_system_hash(),
+            'cache': self.cache.stats(),
+            'attempts': self.attempts,
+            'budget': self.budget
+        }
+
+    def best(self, count):
+        return [g for f,g in self.survivors[:count]]
+
+    def immigrate(self, genomes):
+        """Put foreign genomes to the population instead of the youngest children"""
+        migrants = unique_canonical(genomes, known=map(canonicalize, self.genomes))
+        migrants = migrants[:max(0, self.poolsize-len(self.survivors))]
+        self.genomes = self.genomes[:self.poolsize-len(migrants)] + migrants
+
+if __name__=="__main__":
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from checkpoint import save_checkpoint, load_checkpoint
+    from binlog import BinaryLogWriter
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", help="Continue evolution from the checkpoint file")
+    parser.add_argument("--checkpoint", default="evolution.checkpoint",
+                        help="Checkpoint file to write")
+    parser.add_argument("--checkpoint-interval", type=int, default=100,
+                        help="Write checkpoint every this number of generations, 0 to disable")
+    parser.add_argument("--binlog", help="Also write the log in binary format to this directory")
+    args = parser.parse_args()
 
-        genome = [g for f,g in fgenome]
-        while len(genome) < poolsize:
-            for new in makenew():
-                genome.append(new[:maxgenome])
+    #executor = ThreadPoolExecutor()
+    executor = None if native_evaluator else ProcessPoolExecutor()
+    if args.resume:
+        saved = load_checkpoint(args.resume)
+        experiment = saved.experiment
+        fitness = fitness_from_parameters(experiment, saved.initial_states())
+        func, expected = experiment['function'], tuple(experiment['expected'])
+        cache = FitnessCache(fitness, func, expected,
+                             maxsize=fitness_cache_size,
+                             path=fitness_cache_path)
+        evolution = Evolution(saved.genomes(), fitness, func, expected,
+                              experiment['poolsize'], experiment['topsize'],
+                              cache=cache,
+                              executor=executor,
+                              threads=evaluator_threads)
+        saved.restore_evolution(evolution)
+        saved.close()
+        print(json.dumps({'experiment':experiment,
+                          'resumed_generation': evolution.generation}))
+    else:
+        #initial = ["nmead.json"]
+        initial = []
+        genome = initial_population(initial, poolsize)
+        randomize()
+
+        if halving_tiers > 1:
+            fitness = SuccessiveHalving(maxsteps = 10000,
+                                        maxevals = 1000,
+                                        tol = 1e-5,
+                                        tiers = halving_tiers,
+                                        eta = halving_eta)
+        else:
+            fitness = Fitness(maxsteps = 10000,
+                              maxevals = 1000,
+                              tol = 1e-5)
+        func, expected  = (0), (1.0,1.0)
+        experiment = experiment_parameters(fitness, poolsize, topsize, initial)
+        experiment.update({'function': func, 'expected': expected})
+        print(json.dumps({'experiment':experiment}))
+
+        cache = FitnessCache(fitness, func, expected,
+                             maxsize=fitness_cache_size,
+                             path=fitness_cache_path)
+        evolution = Evolution(genome, fitness, func, expected, poolsize, topsize,
+                              cache=cache,
+                              executor=executor,
+                              threads=evaluator_threads)
+    binlog = None
+    if args.binlog:
+        binlog = BinaryLogWriter(args.binlog, experiment, command_system_hash())
+    while True:
+        record = evolution.step()
+        print(json.dumps(record), flush=True)
+        if binlog is not None:
+            binlog.write_record(record)
+        if args.checkpoint_interval and evolution.generation % args.checkpoint_interval == 0:
+            save_checkpoint(args.checkpoint, evolution, experiment)
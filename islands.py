@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""Island model: several populations evolve independently, each in its own process,
+and periodically send their best individuals to the next island in the ring."""
+import os
+import sys
+import json
+import random
+import queue
+import threading
+import argparse
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from machine import seed_random
+import genetic_optim
+from genetic_optim import Fitness, Evolution, initial_population, experiment_parameters
+
+class PipeTransport:
+    """Islands, connected in a ring by pipes. Only for islands on one host"""
+    def __init__(self, nislands):
+        #i'th pipe sends from island i to island i+1
+        pipes = [Pipe(duplex=False) for _ in range(nislands)]
+        self.connections = [c for pipe in pipes for c in pipe]
+        self.endpoints = [PipeEndpoint(sender=pipes[i][1], receiver=pipes[i-1][0],
+                                       inherited=self.connections)
+                          for i in range(nislands)]
+    def endpoint(self, index):
+        return self.endpoints[index]
+    def close(self):
+        """Close the pipes in the parent process, after the islands are started.
+        Then island, that has finished, closes the last copy of its receiver,
+        and the sender upstream gets an error instead of blocking on a full pipe"""
+        for connection in self.connections:
+            connection.close()
+
+class PipeEndpoint:
+    #migrations, waiting for the sender thread; newer ones are dropped if it is busy
+    queue_size = 2
+    def __init__(self, sender, receiver, inherited=()):
+        self.sender = sender
+        self.receiver = receiver
+        self.inherited = inherited
+    def open(self):
+        """Must be called in the process of the island"""
+        #copies of the pipes of other islands, inherited by the process
+        for connection in self.inherited:
+            if connection is not self.sender and connection is not self.receiver:
+                connection.close()
+        self.outbox = queue.Queue(self.queue_size)
+        self.sender_thread = threading.Thread(target=self._send, daemon=True)
+        self.sender_thread.start()
+    def _send(self):
+        while True:
+            genomes = self.outbox.get()
+            if genomes is None: break
+            try:
+                self.sender.send(genomes)
+            except OSError:
+                #next island has finished
+                break
+        self.sender.close()
+    def send(self, genomes):
+        """Does not wait: if the next island does not read migrants, they are dropped"""
+        try:
+            self.outbox.put_nowait(genomes)
+        except queue.Full:
+            pass
+    def receive(self):
+        """Return all genomes received so far, does not wait"""
+        migrants = []
+        try:
+            while not self.receiver.closed and self.receiver.poll():
+                migrants.extend(self.receiver.recv())
+        except EOFError:
+            #previous island has finished
+            self.receiver.close()
+        return migrants
+    def close(self):
+        if not self.receiver.closed:
+            self.receiver.close()
+        try:
+            self.outbox.put_nowait(None)
+        except queue.Full:
+            #sender thread is blocked by the next island, process exit closes the pipe
+            pass
+
+class SocketTransport:
+    """Islands, connected in a ring by TCP sockets. Addresses are (host, port) pairs,
+    islands may run on different nodes"""
+    def __init__(self, addresses, authkey=b"genprog"):
+        self.addresses = addresses
+        self.authkey = authkey
+    @classmethod
+    def loopback(cls, nislands, port=17300, authkey=b"genprog"):
+        return cls([('127.0.0.1', port+i) for i in range(nislands)], authkey)
+    def endpoint(self, index):
+        return SocketEndpoint(self.addresses[index],
+                              self.addresses[(index+1) % len(self.addresses)],
+                              self.authkey)
+    def close(self):
+        pass
+
+class SocketEndpoint:
+    def __init__(self, address, target, authkey):
+        self.address = address
+        self.target = target
+        self.authkey = authkey
+        self.connection = None
+
+    def open(self):
+        """Start listening. Must be called in the process of the island"""
+        self.inbox = queue.Queue()
+        self.listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _read(self, connection):
+        with connection:
+            while True:
+                try:
+                    self.inbox.put(connection.recv())
+                except (EOFError, OSError):
+                    return
+
+    def send(self, genomes):
+        """Does not raise if the next island is not started yet or has exited: migrants are dropped"""
+        try:
+            if self.connection is None:
+                self.connection = Client(self.target, authkey=self.authkey)
+            self.connection.send(genomes)
+        except (OSError, EOFError):
+            #refused, reset or broken connection; reconnect at the next migration
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def receive(self):
+        migrants = []
+        while True:
+            try:
+                migrants.extend(self.inbox.get_nowait())
+            except queue.Empty:
+                return migrants
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.listener.close()
+
+def run_island(index, endpoint, args):
+    #forked islands share random states, they must be seeded independently
+    seed = int.from_bytes(os.urandom(4), 'little')
+    random.seed(seed)
+    np.random.seed(seed)
+    seed_random(seed)
+
+    fitness = Fitness(maxsteps = args.maxsteps,
+                      maxevals = args.maxevals,
+                      tol = 1e-5)
+    func, expected = args.function, (1.0, 1.0)
+    evolution = Evolution(initial_population([], args.poolsize),
+                          fitness, func, expected,
+                          args.poolsize, args.topsize,
+                          threads=args.threads)
+    endpoint.open()
+    logfile = f"{args.output}{index}.jsons"
+    with open(logfile, "w") as log:
+        experiment = experiment_parameters(fitness, args.poolsize, args.topsize, [])
+        experiment.update({'island': index,
+                           'migration_interval': args.interval,
+                           'migrants': args.migrants})
+        log.write(json.dumps({'experiment': experiment})+"\n")
+        while args.generations is None or evolution.generation < args.generations:
+            record = evolution.step()
+            migrants = endpoint.receive()
+            evolution.immigrate(migrants)
+            record['immigrants'] = len(migrants)
+            if evolution.generation % args.interval == 0:
+                endpoint.send(evolution.best(args.migrants))
+            log.write(json.dumps(record)+"\n")
+            log.flush()
+    endpoint.close()
+
+def parse_address(s):
+    host, port = s.rsplit(':', 1)
+    return host, int(port)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--islands", type=int, default=4,
+                        help="Number of islands to run on this host")
+    parser.add_argument("-k", "--interval", type=int, default=10,
+                        help="Migration interval, generations")
+    parser.add_argument("-m", "--migrants", type=int, default=10,
+                        help="Number of best individuals, sent on migration")
+    parser.add_argument("-g", "--generations", type=int,
+                        help="Stop after this number of generations (default is run forever)")
+    parser.add_argument("-t", "--transport", choices=["pipe", "socket"], default="pipe")
+    parser.add_argument("--addresses",
+                        help="Comma-separated host:port list of all islands of the ring, for the socket transport")
+    parser.add_argument("--index", type=int,
+                        help="Run only the island with this index from the address list")
+    parser.add_argument("-o", "--output", default="island",
+                        help="Prefix of the island log files")
+    parser.add_argument("--poolsize", type=int, default=genetic_optim.poolsize)
+    parser.add_argument("--topsize", type=int, default=genetic_optim.topsize)
+    parser.add_argument("--maxsteps", type=int, default=10000)
+    parser.add_argument("--maxevals", type=int, default=1000)
+    parser.add_argument("--function", type=int, default=0,
+                        help="Index of the objective in the function table")
+    parser.add_argument("--threads", type=int,
+                        help="Evaluator threads per island (default is CPU count divided by islands)")
+    args = parser.parse_args()
+
+    if args.addresses:
+        transport = SocketTransport([parse_address(a) for a in args.addresses.split(",")])
+        nislands = len(transport.addresses)
+    elif args.transport == "socket":
+        transport = SocketTransport.loopback(args.islands)
+        nislands = args.islands
+    else:
+        transport = PipeTransport(args.islands)
+        nislands = args.islands
+    indices = [args.index] if args.index is not None else range(nislands)
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1)//len(indices))
+
+    islands = [Process(target=run_island, args=(i, transport.endpoint(i), args))
+               for i in indices]
+    for island in islands:
+        island.start()
+    transport.close()
+    for island in islands:
+        island.join()
+    sys.exit(max(island.exitcode for island in islands))
@@ -1,4 +1,14 @@
 #include "machine.hpp"
+#include <thread>
+#include <atomic>
+#include <exception>
+#include <mutex>
+#include <memory>
+#include <stdexcept>
+#include <cstring>
+#include <cctype>
+#include <bitset>
+#include <cstdint>
 
 
 #define TRACE(x) {std::cerr<<x;}
@@ -67,18 +77,30 @@ double random_float()
 {
   return 2.0*(float(rand())/RAND_MAX)-1.0;
 }
+double random_float(random_engine &rng)
+{
+  return 2.0*(float(rng()-random_engine::min())/(random_engine::max()-random_engine::min()))-1.0;
+}
 void random_vec(vec&v)
 {
   FOR2(i){v.coord[i] = random_float();};
 }
-void random_point(point&p)
+void random_vec(vec&v, random_engine &rng)
 {
-  random_vec(p.x);
+  FOR2(i){v.coord[i] = random_float(rng);};
+}
+//use own generator if machine has it, global rand() otherwise
+void random_point(point&p, random_engine *rng)
+{
+  if (rng) random_vec(p.x, *rng);
+  else random_vec(p.x);
   p.evaluated =false;
 }
 
 Machine::Machine()
   :objective(NULL)
+  ,rng(NULL)
+  ,next_initial_state(0)
   ,tracing(false)
   ,tracing_live_code(false)
 {
@@ -91,15 +113,131 @@ void Machine::reset()
   cpr = 0;
   nsteps = 0;
   ncalls = 0;    
-  random_point(vec_accum);
-  for(size_t i=0;i<NVECREG;++i){
-    random_point(vec_registers[i]);
-    vec_registers_changed[i]=true;
+  if (initial_states.empty()){
+    random_point(vec_accum, rng);
+    for(size_t i=0;i<NVECREG;++i)
+      random_point(vec_registers[i], rng);
+  }else{
+    const double *state = &initial_states[next_initial_state*INITIAL_STATE_SIZE];
+    next_initial_state = (next_initial_state+1) % (initial_states.size()/INITIAL_STATE_SIZE);
+    FOR2(j){ vec_accum.x.coord[j] = state[j]; }
+    vec_accum.evaluated = false;
+    for(size_t i=0;i<NVECREG;++i){
+      FOR2(j){ vec_registers[i].x.coord[j] = state[(i+1)*DIMENSION+j]; }
+      vec_registers[i].evaluated = false;
+    }
   }
+  for(size_t i=0;i<NVECREG;++i)
+    vec_registers_changed[i]=true;
   for(size_t i=0;i<NFLOATREG;++i)
     float_registers[i] = 0;
 }
 
+void random_initial_states(double *states, size_t length)
+{
+  for(size_t i=0; i!=length; ++i)
+    states[i] = random_float();
+}
+
+void Machine::set_initial_states(const double *states, size_t length)
+{
+  if (length % INITIAL_STATE_SIZE != 0)
+    throw std::invalid_argument("Initial states must have " + std::to_string(INITIAL_STATE_SIZE) + " values each");
+  initial_states.assign(states, states+length);
+  next_initial_state = 0;
+}
+
+static double *store_point(double *state, const point &p)
+{
+  FOR2(j){ *state++ = p.x.coord[j]; }
+  *state++ = p.f;
+  *state++ = p.evaluated;
+  return state;
+}
+static const double *load_point(const double *state, point &p)
+{
+  FOR2(j){ p.x.coord[j] = *state++; }
+  p.f = *state++;
+  p.evaluated = (*state++ != 0.0);
+  return state;
+}
+
+void Machine::snapshot(double *state, size_t length)const
+{
+  if (length != SNAPSHOT_SIZE)
+    throw std::invalid_argument("Snapshot must have " + std::to_string(SNAPSHOT_SIZE) + " values");
+  *state++ = float_accum;
+  *state++ = flag;
+  *state++ = cpr;
+  *state++ = nsteps;
+  *state++ = ncalls;
+  state = store_point(state, vec_accum);
+  for(size_t i=0;i<NVECREG;++i) state = store_point(state, vec_registers[i]);
+  for(size_t i=0;i<NVECREG;++i) *state++ = vec_registers_changed[i];
+  for(size_t i=0;i<NFLOATREG;++i) *state++ = float_registers[i];
+}
+
+void Machine::restore(const double *state, size_t length)
+{
+  if (length != SNAPSHOT_SIZE)
+    throw std::invalid_argument("Snapshot must have " + std::to_string(SNAPSHOT_SIZE) + " values");
+  if (state[2] < 0 || static_cast<size_t>(state[2]) >= std::max(code.size(), size_t(1)))
+    throw std::invalid_argument("Snapshot command pointer is out of the code");
+  float_accum = *state++;
+  flag = (*state++ != 0.0);
+  cpr = static_cast<size_t>(*state++);
+  nsteps = static_cast<size_t>(*state++);
+  ncalls = static_cast<size_t>(*state++);
+  state = load_point(state, vec_accum);
+  for(size_t i=0;i<NVECREG;++i) state = load_point(state, vec_registers[i]);
+  for(size_t i=0;i<NVECREG;++i) vec_registers_changed[i] = (*state++ != 0.0);
+  for(size_t i=0;i<NFLOATREG;++i) float_registers[i] = *state++;
+}
+
+void Machine::get_state(double *state, size_t length)const
+{
+  if (length != STATE_SIZE)
+    throw std::invalid_argument("State must have " + std::to_string(STATE_SIZE) + " values");
+  *state++ = float_accum;
+  FOR2(j){ *state++ = vec_accum.x.coord[j]; }
+  for(size_t i=0;i<NVECREG;++i){
+    FOR2(j){ *state++ = vec_registers[i].x.coord[j]; }
+  }
+  for(size_t i=0;i<NFLOATREG;++i) *state++ = float_registers[i];
+}
+
+void Machine::set_state(const double *state, size_t length)
+{
+  if (length != STATE_SIZE)
+    throw std::invalid_argument("State must have " + std::to_string(STATE_SIZE) + " values");
+  vec v;
+  float_accum = *state++;
+  FOR2(j){ v.coord[j] = *state++; }
+  vec_accum.set(v);
+  for(size_t i=0;i<NVECREG;++i){
+    FOR2(j){ v.coord[j] = *state++; }
+    vec_registers[i].set(v);
+    vec_registers_changed[i] = true;
+  }
+  for(size_t i=0;i<NFLOATREG;++i) float_registers[i] = *state++;
+}
+
+size_t Machine::record_trace(size_t steps, size_t every, double *trace, size_t length)
+{
+  if (every == 0)
+    throw std::invalid_argument("Trace step must be positive");
+  size_t nrecords = (steps + every - 1) / every;
+  if (length < nrecords*TRACE_RECORD_SIZE)
+    throw std::invalid_argument("Trace buffer must have " + std::to_string(nrecords*TRACE_RECORD_SIZE) + " values");
+  for(size_t r=0; r!=nrecords; ++r){
+    *trace++ = ncalls;
+    *trace++ = cpr;
+    get_state(trace, STATE_SIZE);
+    trace += STATE_SIZE;
+    this->steps(std::min(every, steps - r*every));
+  }
+  return nrecords;
+}
 
 std::ostream &Machine::show(std::ostream &os)const
 {
@@ -180,6 +318,7 @@ void Machine::load_code(const i8* bytes, size_t size)
   }
   //change labels to jump indices in instructions
   prepare_labels();  
+  fuse_instructions();
 }
 
 void print_jump_map(Machine &m, std::ostream&os)
@@ -204,15 +343,6 @@ void print_jump_map(Machine &m, std::ostream&os)
   os<<"}";
 }
 
-void Machine::prepare_labels()
-{
-  for(size_t i=0; i!=code.size(); ++i){
-    if (code[i].cmd==cmd_label){
-      labels.push_back(std::make_pair(i, code[i].arg_label));
-    }
-  }
-}
-
 int get_jump_dir(command cmd){
   switch(cmd){
   case cmd_jump_up:
@@ -228,26 +358,56 @@ int get_jump_dir(command cmd){
     return 0;
  }
 }
-//lazily calculated getter for jump address.
-size_t Machine::get_jump_address(size_t instruction_address)
+void Machine::prepare_labels()
 {
-  //instruction must have jump type, it is not checked!
-  instruction &ins(code[instruction_address]);
-  if (!ins.has_address){
-    //has to update it
-    int jdir = get_jump_dir(ins.cmd);
-    //must be non-zero!
-    ins.arg_address = find_label(instruction_address, ins.arg_label, jdir);
-    ins.has_address = true;
+  //machine may be reused for another code.
+  //labels are sorted by label byte, then by address: counting sort by the byte
+  size_t counts[257] = {0};
+  label_start[0] = 0;
+  for(size_t i=0; i!=code.size(); ++i){
+    if (code[i].cmd==cmd_label)
+      counts[static_cast<unsigned char>(code[i].arg_label)+1] += 1;
+  }
+  for(size_t b=0; b!=256; ++b){
+    label_start[b+1] = label_start[b] + counts[b+1];
+    counts[b+1] = label_start[b];
+  }
+  label_addresses.resize(label_start[256]);
+  for(size_t i=0; i!=code.size(); ++i){
+    if (code[i].cmd==cmd_label)
+      label_addresses[counts[static_cast<unsigned char>(code[i].arg_label)+1]++] = i;
+  }
+  //resolve all jumps at once
+  for(size_t i=0; i!=code.size(); ++i){
+    int jdir = get_jump_dir(code[i].cmd);
+    if (jdir != 0){
+      code[i].arg_address = find_label(i, code[i].arg_label, jdir);
+      code[i].has_address = true;
+    }
   }
-  return ins.arg_address;
 }
+
 bool Machine::is_instruction_live(size_t address)const
 {
   if (address >= code.size()) return false;
   return code[address].alive;
 }
 
+void Machine::live_mask(size_t attempts, size_t steps, i8 *flags, size_t length)
+{
+  if (length != code.size())
+    throw std::invalid_argument("Mask must have " + std::to_string(code.size()) + " values");
+  bool was_tracing = tracing_live_code;
+  tracing_live_code = true;
+  for(instruction &instr: code) instr.alive = false;
+  for(size_t i=0; i!=attempts; ++i){
+    reset();
+    this->steps(steps);
+  }
+  tracing_live_code = was_tracing;
+  for(size_t i=0; i!=code.size(); ++i) flags[i] = code[i].alive;
+}
+
 //python interface
 int Machine::get_jump_index(size_t address)
 {
@@ -258,92 +418,76 @@ int Machine::get_jump_index(size_t address)
     return static_cast<int>(get_jump_address(address));
 }
 
-int label_dist(i8 a, i8 b)
+void Machine::jump_table(long long *table, size_t length)const
 {
-  unsigned char diff = (unsigned char)(a ^ b);
-  int d = 0;
-  while(diff){
-    d += diff % 2;
-    diff /= 2;
-  }
-  return d;
+  if (length != code.size())
+    throw std::invalid_argument("Jump table must have one value per instruction");
+  for(size_t i=0; i!=code.size(); ++i)
+    table[i] = get_jump_dir(code[i].cmd) ? static_cast<long long>(code[i].arg_address) : -1;
 }
 
-/**Calculate fitness of given label instruction to the JUMP instruction
-   returns pair: distance (in jump direction), label matching
- */
-std::pair<int,size_t> label_fitness(const std::pair<size_t, i8> &label, size_t from, i8 jumplabel, bool forward, size_t code_size)
+int label_dist(i8 a, i8 b)
 {
-  //jump distance is
-  //int(label.first) - int(from)
-  int d = static_cast<int>(label.first)-static_cast<int>(from);
-  if (!forward) d = -d;
-  return std::make_pair(label_dist(label.second, jumplabel),
-			static_cast<size_t>((d+code_size)%code_size));
+  return static_cast<int>(std::bitset<8>(static_cast<unsigned char>(a ^ b)).count());
 }
-  
+
+/**Find label for the jump: label with the minimal Hamming distance to the jump label,
+   of them the nearest in the jump direction, cyclically.
+   Returns start if there are no labels.
+ */
 size_t Machine::find_label(size_t start, i8 label, int direction)const{
-  //old code
-  /*
-  size_t i=start;
-  size_t best_i = start;
-  int best_dist = 1000;
-  while (true){
-    i = (i+direction+code.size())%code.size();
-    if (i==start) break;
-    if (code[i].cmd != cmd_label) continue;
-    int dist = label_dist(label, code[i].arg_label);
-    if(dist < best_dist){
-      best_dist = dist;
-      best_i = i;
+  if (label_start[256] == 0) return start;
+  int best_dist = 9;
+  for(size_t b=0; b!=256; ++b){
+    if (label_start[b] != label_start[b+1]){
+      best_dist = std::min(best_dist, label_dist(static_cast<i8>(b), label));
     }
-    if (best_dist == 0)
-      break;
   }
-  return best_i;
-  */
-  //new code
-  std::pair<int,size_t> best_fitness;
-  size_t best_address=start;
-  bool has_best=false;
-  
-  for(size_t i=0; i!=labels.size(); ++i){
-    std::pair<int,size_t> fitness = label_fitness(labels[i], start, label, direction==1, code.size());
-    if (!has_best){
-      has_best=true;
-      best_fitness = fitness;
-      best_address = labels[i].first;
-    }else if(fitness < best_fitness){
-      best_fitness = fitness;
-      best_address = labels[i].first;
+  size_t best_address = start;
+  size_t best_distance = code.size();
+  for(size_t b=0; b!=256; ++b){
+    if (label_start[b] == label_start[b+1] || label_dist(static_cast<i8>(b), label) != best_dist)
+      continue;
+    std::vector<size_t>::const_iterator
+      first = label_addresses.begin()+label_start[b],
+      last = label_addresses.begin()+label_start[b+1];
+    size_t address;
+    if (direction == 1){
+      //first label after the start, or the first one if there are none
+      std::vector<size_t>::const_iterator ilabel = std::upper_bound(first, last, start);
+      address = (ilabel == last) ? *first : *ilabel;
+    }else{
+      //last label before the start, or the last one
+      std::vector<size_t>::const_iterator ilabel = std::lower_bound(first, last, start);
+      address = (ilabel == first) ? *(last-1) : *(ilabel-1);
+    }
+    size_t distance = (direction == 1) ? (address+code.size()-start) % code.size()
+                                       : (start+code.size()-address) % code.size();
+    if (distance < best_distance){
+      best_distance = distance;
+      best_address = address;
     }
   }
-  //std::cout<<"Jump from "<<start<<" label:"<<(int)label<<" to:"<<best_address<<std::endl;
   return best_address;
 }
 
 void Machine::steps(size_t n)
 {
-  for(size_t i=0;i!=n;++i){
-    step();
-  }
+  //loop is chosen once per call
+  if (tracing || tracing_live_code) run_instrumented(nsteps+n, SIZE_MAX, NULL, 0.0);
+  else run_fast(nsteps+n, SIZE_MAX, NULL, 0.0);
 }
 bool Machine::runto(size_t maxsteps, size_t maxevals, const vec& target, double tol)
 {
-  while(nsteps < maxsteps && ncalls < maxevals){
-    if (vec_registers_changed[0]){
-      vec_registers_changed[0] = false;
-      if (norm(vec_registers[0].x-target) <= tol){
-	return true;
-      }
-    }
-    step();
-  }
-  return false;
+  if (tracing || tracing_live_code) return run_instrumented(maxsteps, maxevals, &target, tol);
+  return run_fast(maxsteps, maxevals, &target, tol);
 }
 void randomize(){
   srand(time(NULL));
 }
+void seed_random(unsigned int seed){
+  srand(seed);
+}
 
 
 double FunctionTable::evaluate(const vec&v)const
@@ -363,3 +507,443 @@ double FunctionTable::evaluate(const vec&v)const
   }
   return 0;
 }
+
+//Recursive descent parser of the expressions.
+//  expr  := term (('+'|'-') term)*
+//  term  := unary (('*'|'/') unary)*
+//  unary := ('-'|'+') unary | power
+//  power := atom (('**'|'^') unary)?
+//  atom  := number | x | y | pi | e | name '(' expr ')' | '(' expr ')'
+class ExpressionParser{
+  const std::string &text;
+  size_t pos;
+  std::vector<ExpressionFunction::operation> &code;
+  size_t depth, max_depth;
+  //recursion depth of the parser, limited to protect the C++ stack
+  size_t nesting;
+  static const size_t max_nesting = 256;
+  struct NestingGuard{
+    ExpressionParser &parser;
+    NestingGuard(ExpressionParser &parser_):parser(parser_){
+      if (++parser.nesting > max_nesting) parser.error("Expression is nested too deeply");
+    }
+    ~NestingGuard(){ --parser.nesting; }
+  };
+
+  void error(const std::string &message){
+    std::stringstream ss;
+    ss << message << " at position " << pos << " in expression \"" << text << "\"";
+    throw std::invalid_argument(ss.str());
+  }
+  void skip_spaces(){
+    while(pos < text.size() && isspace(static_cast<unsigned char>(text[pos]))) ++pos;
+  }
+  bool accept(const char *token){
+    skip_spaces();
+    size_t n = strlen(token);
+    if (text.compare(pos, n, token) != 0) return false;
+    pos += n;
+    return true;
+  }
+  void emit(ExpressionFunction::opcode op, double value=0.0){
+    ExpressionFunction::operation o;
+    o.op = op;
+    o.value = value;
+    code.push_back(o);
+    //track stack depth: values push, binary operations pop, functions keep it
+    if (op == ExpressionFunction::op_const || op == ExpressionFunction::op_x || op == ExpressionFunction::op_y){
+      if (++depth > max_depth) max_depth = depth;
+    }else if (op <= ExpressionFunction::op_pow){
+      --depth;
+    }
+  }
+  void expr(){
+    term();
+    while(true){
+      if (accept("+")){ term(); emit(ExpressionFunction::op_add); }
+      else if (accept("-")){ term(); emit(ExpressionFunction::op_sub); }
+      else break;
+    }
+  }
+  void term(){
+    unary();
+    while(true){
+      //"**" is power, not multiplication
+      skip_spaces();
+      if (text.compare(pos, 2, "**") == 0) break;
+      if (accept("*")){ unary(); emit(ExpressionFunction::op_mul); }
+      else if (accept("/")){ unary(); emit(ExpressionFunction::op_div); }
+      else break;
+    }
+  }
+  void unary(){
+    NestingGuard guard(*this);
+    if (accept("-")){ unary(); emit(ExpressionFunction::op_neg); }
+    else if (accept("+")){ unary(); }
+    else power();
+  }
+  void power(){
+    atom();
+    if (accept("**") || accept("^")){
+      unary();
+      emit(ExpressionFunction::op_pow);
+    }
+  }
+  void atom(){
+    NestingGuard guard(*this);
+    skip_spaces();
+    if (pos >= text.size()) error("Unexpected end");
+    char c = text[pos];
+    if (isdigit(static_cast<unsigned char>(c)) || c == '.'){
+      const char *start = text.c_str()+pos;
+      char *end;
+      double value = strtod(start, &end);
+      if (end == start) error("Bad number");
+      pos += end-start;
+      emit(ExpressionFunction::op_const, value);
+      return;
+    }
+    if (accept("(")){
+      expr();
+      if (!accept(")")) error("Expected ')'");
+      return;
+    }
+    size_t start = pos;
+    while(pos < text.size() && (isalnum(static_cast<unsigned char>(text[pos])) || text[pos]=='_')) ++pos;
+    std::string name = text.substr(start, pos-start);
+    if (name.empty()) error("Unexpected symbol");
+    if (name == "x"){ emit(ExpressionFunction::op_x); return; }
+    if (name == "y"){ emit(ExpressionFunction::op_y); return; }
+    if (name == "pi"){ emit(ExpressionFunction::op_const, M_PI); return; }
+    if (name == "e"){ emit(ExpressionFunction::op_const, M_E); return; }
+    static const std::map<std::string, ExpressionFunction::opcode> functions = {
+      {"sin", ExpressionFunction::op_sin}, {"cos", ExpressionFunction::op_cos},
+      {"tan", ExpressionFunction::op_tan}, {"exp", ExpressionFunction::op_exp},
+      {"log", ExpressionFunction::op_log}, {"sqrt", ExpressionFunction::op_sqrt},
+      {"abs", ExpressionFunction::op_abs}, {"tanh", ExpressionFunction::op_tanh},
+      {"atan", ExpressionFunction::op_atan}
+    };
+    auto ifunc = functions.find(name);
+    if (ifunc == functions.end()){
+      pos = start;
+      error("Unknown name \"" + name + "\"");
+    }
+    if (!accept("(")) error("Expected '('");
+    expr();
+    if (!accept(")")) error("Expected ')'");
+    emit(ifunc->second);
+  }
+public:
+  ExpressionParser(const std::string &text_, std::vector<ExpressionFunction::operation> &code_)
+    :text(text_), pos(0), code(code_), depth(0), max_depth(0), nesting(0){};
+  void parse(){
+    expr();
+    skip_spaces();
+    if (pos != text.size()) error("Unexpected symbol");
+    if (max_depth > ExpressionFunction::max_stack) error("Expression is too deep");
+  }
+};
+
+ExpressionFunction::ExpressionFunction(const std::string &expression)
+  :source(expression)
+{
+  ExpressionParser(source, code).parse();
+}
+
+double ExpressionFunction::evaluate(const vec&v)const
+{
+  double stack[max_stack];
+  double *top = stack; //points after the last value
+  for(const operation &o: code){
+    switch(o.op){
+    case op_const: *top++ = o.value; break;
+    case op_x: *top++ = v.coord[0]; break;
+    case op_y: *top++ = v.coord[1]; break;
+    case op_add: --top; top[-1] += top[0]; break;
+    case op_sub: --top; top[-1] -= top[0]; break;
+    case op_mul: --top; top[-1] *= top[0]; break;
+    case op_div: --top; top[-1] /= top[0]; break;
+    case op_pow: --top; top[-1] = pow(top[-1], top[0]); break;
+    case op_neg: top[-1] = -top[-1]; break;
+    case op_sin: top[-1] = sin(top[-1]); break;
+    case op_cos: top[-1] = cos(top[-1]); break;
+    case op_tan: top[-1] = tan(top[-1]); break;
+    case op_exp: top[-1] = exp(top[-1]); break;
+    case op_log: top[-1] = log(top[-1]); break;
+    case op_sqrt: top[-1] = sqrt(top[-1]); break;
+    case op_abs: top[-1] = fabs(top[-1]); break;
+    case op_tanh: top[-1] = tanh(top[-1]); break;
+    case op_atan: top[-1] = atan(top[-1]); break;
+    }
+  }
+  return stack[0];
+}
+NativeFunction::NativeFunction(size_t address)
+  :func(reinterpret_cast<TNativeFunc>(address))
+{
+  if (!address) throw std::invalid_argument("Function address is zero");
+}
+
+void AbstractFunction::evaluate_many(const double *points, size_t n, double *values)const
+{
+  vec x;
+  for(size_t i=0; i!=n; ++i){
+    FOR2(j){ x.coord[j] = points[i*DIMENSION+j]; }
+    values[i] = evaluate(x);
+  }
+}
+
+void run_lockstep(Machine **machines, size_t count,
+		  size_t maxsteps, size_t maxevals, const vec& target, double tol,
+		  AbstractFunction &f, bool *reached)
+{
+  enum{ running, pending, finished };
+  std::vector<char> state(count, running);
+  std::vector<point*> points;
+  std::vector<Machine*> owners;
+  std::vector<double> coords, values;
+  size_t active = count;
+  while(active){
+    points.clear();
+    owners.clear();
+    for(size_t i=0; i!=count; ++i){
+      if (state[i]==finished) continue;
+      Machine &m(*machines[i]);
+      if (state[i]==pending){
+	//points are evaluated now, complete the instruction
+	m.step();
+	state[i] = running;
+      }
+      //same loop as in runto, but stops before the instruction that needs evaluation
+      while(true){
+	if (!(m.nsteps < maxsteps && m.ncalls < maxevals)){
+	  reached[i] = false;
+	  state[i] = finished;
+	  break;
+	}
+	if (m.vec_registers_changed[0]){
+	  m.vec_registers_changed[0] = false;
+	  if (norm(m.vec_registers[0].x-target) <= tol){
+	    reached[i] = true;
+	    state[i] = finished;
+	    break;
+	  }
+	}
+	point *requested[MAX_PENDING_POINTS];
+	size_t n = m.pending_points(requested);
+	if (n){
+	  for(size_t k=0; k!=n; ++k){
+	    points.push_back(requested[k]);
+	    owners.push_back(&m);
+	  }
+	  state[i] = pending;
+	  break;
+	}
+	m.step();
+      }
+      if (state[i]==finished) --active;
+    }
+    if (points.empty()) continue;
+    coords.resize(points.size()*DIMENSION);
+    values.resize(points.size());
+    for(size_t k=0; k!=points.size(); ++k){
+      FOR2(j){ coords[k*DIMENSION+j] = points[k]->x.coord[j]; }
+    }
+    f.evaluate_many(&coords[0], points.size(), &values[0]);
+    for(size_t k=0; k!=points.size(); ++k)
+      owners[k]->provide_value(*points[k], values[k]);
+  }
+}
+
+//sums results of the attempts, like genetic_optim.Fitness
+struct fitness_accumulator{
+  double norms, norms2, evals, steps;
+  size_t attempts;
+  fitness_accumulator():norms(0.0),norms2(0.0),evals(0.0),steps(0.0),attempts(0){};
+  void add(const Machine &m, bool reached, const vec& target){
+    double dist = norm(m.vec_registers[0].x - target);
+    if (dist != dist) dist = 1e100;
+    evals += m.ncalls;
+    steps += m.nsteps;
+    double main = reached ? 0.0 : -dist;
+    if (m.ncalls < 10)
+      main -= 10.0 * (10.0-m.ncalls);
+    norms += main;
+    norms2 += main*main;
+    attempts += 1;
+  };
+  //true if upper confidence bound of the mean distance is below the threshold
+  bool hopeless(double threshold, double z)const{
+    if (attempts < 2) return false;
+    double mean = norms / attempts;
+    double var = std::max(0.0, (norms2 - attempts*mean*mean) / (attempts-1));
+    return mean + z*sqrt(var/attempts) < threshold;
+  };
+  void store(size_t genome_size, double *result)const{
+    result[0] = norms / attempts;
+    result[1] = -evals / attempts;
+    result[2] = -steps / attempts;
+    result[3] = -static_cast<double>(genome_size);
+  };
+};
+
+//true if racing should stop after the given attempt
+static bool race_over(const fitness_accumulator &acc, size_t attempts, double threshold, size_t increment, double z)
+{
+  if (acc.attempts >= attempts) return true;
+  return increment && acc.attempts % increment == 0 && acc.hopeless(threshold, z);
+}
+
+size_t genome_fitness(Machine &m, size_t genome_size, const vec& target,
+		      size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+		      double *result,
+		      double threshold, size_t increment, double z)
+{
+  fitness_accumulator acc;
+  do{
+    m.reset();
+    acc.add(m, m.runto(maxsteps, maxevals, target, tol), target);
+  }while(!race_over(acc, attempts, threshold, increment, z));
+  acc.store(genome_size, result);
+  return acc.attempts;
+}
+
+//fitness of several genomes, run in lockstep
+static void lockstep_fitness(const i8* genomes, const size_t *offsets, size_t first, size_t last,
+			     AbstractFunction &f, const vec& target,
+			     size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+			     double threshold, size_t increment, double z,
+			     const double *states, size_t states_length,
+			     unsigned seed, double *result, size_t *used)
+{
+  size_t n = last-first;
+  if (n==0) return;
+  std::vector<Machine> machines(n);
+  std::vector<random_engine> rngs(n);
+  std::vector<fitness_accumulator> acc(n);
+  std::unique_ptr<bool[]> reached(new bool[n]);
+  //indices of the machines, still racing
+  std::vector<size_t> active;
+  std::vector<Machine*> pointers;
+  for(size_t i=0; i!=n; ++i){
+    rngs[i].seed(seed + static_cast<unsigned>(first+i));
+    machines[i].rng = &rngs[i];
+    machines[i].set_function(f);
+    machines[i].load_code(genomes+offsets[first+i], offsets[first+i+1]-offsets[first+i]);
+    machines[i].set_initial_states(states, states_length);
+    active.push_back(i);
+  }
+  while(!active.empty()){
+    pointers.clear();
+    for(size_t i: active){
+      machines[i].reset();
+      pointers.push_back(&machines[i]);
+    }
+    run_lockstep(&pointers[0], active.size(), maxsteps, maxevals, target, tol, f, reached.get());
+    size_t still_active = 0;
+    for(size_t k=0; k!=active.size(); ++k){
+      size_t i = active[k];
+      acc[i].add(machines[i], reached[k], target);
+      if (!race_over(acc[i], attempts, threshold, increment, z))
+	active[still_active++] = i;
+    }
+    active.resize(still_active);
+  }
+  for(size_t i=0; i!=n; ++i){
+    acc[i].store(offsets[first+i+1]-offsets[first+i], result+4*(first+i));
+    if (used) used[first+i] = acc[i].attempts;
+  }
+}
+
+void evaluate_population(const i8* genomes, size_t genomes_length,
+			 const size_t *offsets, size_t offsets_length,
+			 AbstractFunction &f, const vec& target,
+			 size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+			 size_t threads,
+			 double *result, size_t result_length,
+			 const double *states, size_t states_length)
+{
+  race_population(genomes, genomes_length, offsets, offsets_length,
+		  f, target, maxsteps, maxevals, tol, attempts,
+		  -HUGE_VAL, 0, 0.0, threads,
+		  result, result_length, NULL, 0,
+		  states, states_length);
+}
+
+void race_population(const i8* genomes, size_t genomes_length,
+		     const size_t *offsets, size_t offsets_length,
+		     AbstractFunction &f, const vec& target,
+		     size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+		     double threshold, size_t increment, double z,
+		     size_t threads,
+		     double *result, size_t result_length,
+		     size_t *used, size_t used_length,
+		     const double *states, size_t states_length)
+{
+  if (offsets_length == 0)
+    throw std::invalid_argument("Offsets must have at least one element");
+  size_t count = offsets_length - 1;
+  if (result_length != count*4)
+    throw std::invalid_argument("Result must have 4 values per genome");
+  if (used && used_length != count)
+    throw std::invalid_argument("Used attempts must have 1 value per genome");
+  if (attempts == 0)
+    throw std::invalid_argument("At least one attempt required");
+  if (states_length % INITIAL_STATE_SIZE != 0)
+    throw std::invalid_argument("Initial states must have " + std::to_string(INITIAL_STATE_SIZE) + " values each");
+  for(size_t i=0; i!=count; ++i){
+    if (offsets[i] > offsets[i+1] || offsets[i+1] > genomes_length)
+      throw std::invalid_argument("Bad genome offsets");
+  }
+  if (threads == 0) threads = std::thread::hardware_concurrency();
+  if (threads == 0) threads = 1;
+  if (threads > count) threads = count;
+
+  //generator of each genome is seeded from one value of the global generator and the genome index,
+  //so results do not depend on the number of threads and on which thread gets which genome
+  unsigned seed = static_cast<unsigned>(rand());
+
+  std::atomic<size_t> next_genome(0);
+  std::exception_ptr error;
+  std::mutex error_lock;
+  auto worker = [&](size_t t){
+    try{
+      if (f.prefers_batches()){
+	//genomes of the worker run together, their evaluations are batched
+	lockstep_fitness(genomes, offsets, count*t/threads, count*(t+1)/threads,
+			 f, target, maxsteps, maxevals, tol, attempts,
+			 threshold, increment, z,
+			 states, states_length,
+			 seed, result, used);
+	return;
+      }
+      random_engine rng;
+      Machine m;
+      m.rng = &rng;
+      m.set_function(f);
+      while(true){
+	size_t i = next_genome++;
+	if (i >= count) break;
+	rng.seed(seed + static_cast<unsigned>(i));
+	size_t size = offsets[i+1]-offsets[i];
+	m.load_code(genomes+offsets[i], size);
+	m.set_initial_states(states, states_length);
+	size_t n = genome_fitness(m, size, target, maxsteps, maxevals, tol, attempts, result+4*i,
+				  threshold, increment, z);
+	if (used) used[i] = n;
+      }
+    }catch(...){
+      std::lock_guard<std::mutex> lock(error_lock);
+      if (!error) error = std::current_exception();
+      next_genome = count;
+    }
+  };
+  std::vector<std::thread> pool;
+  for(size_t t=1; t<threads; ++t)
+    pool.push_back(std::thread(worker, t));
+  //calling thread works too
+  if (threads > 0) worker(0);
+  for(size_t t=0; t!=pool.size(); ++t)
+    pool[t].join();
+  if (error) std::rethrow_exception(error);
+}
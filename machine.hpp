@@ -9,6 +9,7 @@
 #include <ctime>
 #include <string>
 #include <sstream>
+#include <random>
 
 #ifdef MSVCPP
 # define GENOPTEXPORT __declspec(dllexport)
@@ -84,6 +85,8 @@ enum argument_type{
 		   arg_label
 };
 typedef signed char i8;
+//random generator, used by machines that must not share global rand() state
+typedef std::minstd_rand random_engine;
 
 //this include defines command type
 #include "machinedef_hpp.inl"
@@ -96,9 +99,11 @@ struct instruction{
     i8 arg_label;
     size_t arg_address;
   };
-  //For jump instruction, True if address is calculated. False if label is stored
+  //For jump instruction, True if address is calculated by load_code. False if label is stored
   bool has_address;
   bool alive;
+  //command or superinstruction, starting at this instruction, set by load_code
+  int dispatch;
 };
 std::ostream &operator <<(std::ostream &os, const instruction &cp);
 
@@ -107,18 +112,49 @@ public:
   AbstractFunction(){};
   virtual ~AbstractFunction(){};
   virtual double evaluate(const vec& x)const=0;
+  //evaluate n points, given as n*DIMENSION coordinates. By default, evaluates them one by one
+  virtual void evaluate_many(const double *points, size_t n, double *values)const;
+  //true if evaluate_many is much faster than evaluating points one by one
+  virtual bool prefers_batches()const{ return false; };
 };
 
 //function pointer type for callback
 typedef double (*TFunc)(double, double, void*);
+//function pointer type for vectorized callback: points, number of points, values
+typedef void (*TBatchFunc)(const double*, size_t, double*, void*);
 class CallbackFunction: public AbstractFunction{
 public:
   TFunc callback;
+  TBatchFunc batch_callback;
   void *userdata;
-  CallbackFunction():callback(0),userdata(0){};
+  CallbackFunction():callback(0),batch_callback(0),userdata(0){};
   virtual ~CallbackFunction(){};
   virtual double evaluate(const vec& x)const{
-    return callback(x.coord[0],x.coord[1],userdata);
+    if (callback) return callback(x.coord[0],x.coord[1],userdata);
+    double value;
+    batch_callback(x.coord, 1, &value, userdata);
+    return value;
+  };
+  virtual void evaluate_many(const double *points, size_t n, double *values)const{
+    if (batch_callback) batch_callback(points, n, values, userdata);
+    else AbstractFunction::evaluate_many(points, n, values);
+  };
+  virtual bool prefers_batches()const{ return batch_callback != 0; };
+};
+
+//function pointer type for native objectives: coordinates and their number
+typedef double (*TNativeFunc)(const double*, size_t);
+//Function, given by pointer to native code, e.g. from the shared library loaded by ctypes
+class NativeFunction: public AbstractFunction{
+public:
+  TNativeFunc func;
+  NativeFunction(TNativeFunc func_):func(func_){};
+  //address of the function, throws std::invalid_argument if it is zero
+  NativeFunction(size_t address);
+  virtual ~NativeFunction(){};
+  virtual double evaluate(const vec& x)const{ return func(x.coord, DIMENSION); };
+  virtual void evaluate_many(const double *points, size_t n, double *values)const{
+    for(size_t i=0; i!=n; ++i) values[i] = func(points+i*DIMENSION, DIMENSION);
   };
 };
 
@@ -130,6 +166,39 @@ public:
   virtual double evaluate(const vec&x)const;
 };
 
+//Function, given by arithmetic expression of x and y, e.g. "(x-10)**2 + (y-20)**2"
+//Expression is compiled once into the stack bytecode
+class ExpressionFunction: public AbstractFunction{
+public:
+  enum opcode{ op_const, op_x, op_y, op_add, op_sub, op_mul, op_div, op_pow, op_neg,
+	       op_sin, op_cos, op_tan, op_exp, op_log, op_sqrt, op_abs, op_tanh, op_atan };
+  struct operation{
+    opcode op;
+    double value;
+  };
+  //maximal depth of the evaluation stack
+  enum{ max_stack=64 };
+  std::string source;
+  std::vector<operation> code;
+  //throws std::invalid_argument if expression can not be parsed
+  ExpressionFunction(const std::string &expression);
+  virtual ~ExpressionFunction(){};
+  virtual double evaluate(const vec&x)const;
+};
+
+//number of values in the initial state of the machine
+#define INITIAL_STATE_SIZE ((NVECREG+1)*DIMENSION)
+//number of values in the machine snapshot
+#define SNAPSHOT_SIZE (5 + (NVECREG+1)*(DIMENSION+2) + NVECREG + NFLOATREG)
+//number of values in the register state: float accumulator, vector accumulator,
+//vector registers, float registers
+#define STATE_SIZE (1 + (NVECREG+1)*DIMENSION + NFLOATREG)
+//number of values in one record of the trace: ncalls, cpr and the register state
+#define TRACE_RECORD_SIZE (2 + STATE_SIZE)
+
+//fill buffer with random initial states, using global rand()
+void random_initial_states(double *states, size_t length);
+
 class Machine{
 public:
   //working registers state
@@ -151,6 +220,12 @@ public:
 
   //number of the test function
   AbstractFunction *objective;
+  //generator for the initial state. If NULL, global rand() is used
+  random_engine *rng;
+  //initial states, that reset() uses one after another instead of random ones.
+  //Each state is the accumulator and the vector registers, INITIAL_STATE_SIZE values
+  std::vector<double> initial_states;
+  size_t next_initial_state;
   bool tracing;
   bool tracing_live_code;
 
@@ -158,39 +233,114 @@ public:
   //load code and prepare it for running
   void load_code(const i8* bytes, size_t size);
   void step();
+  //interpreter loops of runto and steps. If target is NULL, runs until the limits.
+  //Fast loop does not trace and uses superinstructions; instrumented loop calls step()
+  bool run_fast(size_t maxsteps, size_t maxevals, const vec* target, double tol);
+  bool run_instrumented(size_t maxsteps, size_t maxevals, const vec* target, double tol);
   void steps(size_t n);
   bool runto(size_t maxsteps, size_t maxevals, const vec& target, double tol);
   Machine();
   std::ostream &show(std::ostream &os)const;
   void set_function(AbstractFunction &f){ objective = &f; };
   void reset();
+  //use given initial states in reset(), cyclically. Empty list returns to the random states
+  void set_initial_states(const double *states, size_t length);
+  //copy complete state of the registers, accumulators and counters into buffer of SNAPSHOT_SIZE values
+  void snapshot(double *state, size_t length)const;
+  void restore(const double *state, size_t length);
+  //copy accumulators and registers into buffer of STATE_SIZE values, or set them from it.
+  //Set vector values are not evaluated
+  void get_state(double *state, size_t length)const;
+  void set_state(const double *state, size_t length);
+  //make steps, storing the state before every `every`-th step into buffer of TRACE_RECORD_SIZE records.
+  //Returns number of records
+  size_t record_trace(size_t steps, size_t every, double *trace, size_t length);
   //interface for swig mainly
   vec& get_vec_reg(size_t i){ return vec_registers[i%NVECREG].x; };
   void set_vec_reg(size_t i, const vec&v){ vec_registers[i%NVECREG].set(v); };
   double get_float_reg(size_t i)const{ return float_registers[i%NFLOATREG]; };
   void set_float_reg(size_t i, double v){ float_registers[i%NFLOATREG]=v; };
   int get_jump_index(size_t address);
+  size_t code_size()const{ return code.size(); };
+  //jump targets of all instructions, -1 for non-jump instructions
+  void jump_table(long long *table, size_t length)const;
 
   void set_trace_live_code(bool t){tracing_live_code = t;};
   bool get_trace_live_code()const{return tracing_live_code;};
   bool is_instruction_live(size_t address)const;
+  //run the code `attempts` times from reset() for `steps` steps with live code tracing,
+  //and store 1 for every executed instruction, 0 for others. flags must have code_size() values
+  void live_mask(size_t attempts, size_t steps, i8 *flags, size_t length);
+  //points, that current instruction would evaluate and that are not evaluated yet.
+  //pending must have place for MAX_PENDING_POINTS
+  size_t pending_points(point **pending);
+  //set value of the pending point, calculated outside
+  void provide_value(point &p, double value){ p.f = value; p.evaluated = true; ncalls += 1; };
   
 private:
-  //pre-calculated list of labels
-  std::vector<std::pair<size_t, i8> > labels;
+  //addresses of the labels, sorted by label byte and then by address.
+  //Labels with byte b are label_addresses[label_start[b]:label_start[b+1]]
+  std::vector<size_t> label_addresses;
+  size_t label_start[257];
 private:
   double eval_function(const vec &v);
   void evaluate(point &p);
-  size_t get_jump_address(size_t instruction_address);
+  //jump addresses are resolved by load_code
+  size_t get_jump_address(size_t instruction_address)const{ return code[instruction_address].arg_address; };
   void prepare_labels();
+  void fuse_instructions();
   size_t find_label(size_t start, i8 label, int direction)const;
   void trace(const std::string & msg)const;
 };
 
 std::ostream & operator <<(std::ostream &os, const Machine &m);
 
+//Evaluate fitness of the genome, averaged over several runs from random initial state.
+//Writes 4 values to the result: (distance, -evaluations, -steps, -size), same as genetic_optim.Fitness
+//Racing: if increment is not 0, after every increment attempts checks the upper confidence bound
+//mean + z*stddev/sqrt(n) of the distance, and stops if it is below the threshold.
+//Returns number of attempts made.
+size_t genome_fitness(Machine &m, size_t genome_size, const vec& target,
+		      size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+		      double *result,
+		      double threshold=-HUGE_VAL, size_t increment=0, double z=0.0);
+
+//Run machines like runto, but in lockstep: points, requested by all machines
+//are evaluated by one call of f.evaluate_many. Sets reached[i] to the result of runto.
+void run_lockstep(Machine **machines, size_t count,
+		  size_t maxsteps, size_t maxevals, const vec& target, double tol,
+		  AbstractFunction &f, bool *reached);
+
+//Evaluate fitness of many genomes in parallel.
+//Genomes are stored in one buffer, i'th genome is genomes[offsets[i]:offsets[i+1]].
+//Result receives 4 values per genome. If threads is 0, number of hardware threads is used.
+//If function prefers batches, genomes of each thread are run in lockstep.
+//If states are given, attempts of every genome start from them (see Machine::set_initial_states),
+//otherwise from random states. Random states depend only on the global generator (see seed_random)
+//and on the genome index, not on the number of threads.
+void GENOPTEXPORT evaluate_population(const i8* genomes, size_t genomes_length,
+				      const size_t *offsets, size_t offsets_length,
+				      AbstractFunction &f, const vec& target,
+				      size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+				      size_t threads,
+				      double *result, size_t result_length,
+				      const double *states=NULL, size_t states_length=0);
+
+//Same as evaluate_population, but genomes that can not reach the threshold are raced out
+//(see genome_fitness). If used is not NULL, it receives number of attempts made for each genome.
+void GENOPTEXPORT race_population(const i8* genomes, size_t genomes_length,
+				  const size_t *offsets, size_t offsets_length,
+				  AbstractFunction &f, const vec& target,
+				  size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+				  double threshold, size_t increment, double z,
+				  size_t threads,
+				  double *result, size_t result_length,
+				  size_t *used, size_t used_length,
+				  const double *states=NULL, size_t states_length=0);
+
 extern "C"{
   void GENOPTEXPORT randomize();
+  void GENOPTEXPORT seed_random(unsigned int seed);
 }
 
 #endif //GENETIC_OPTIM_INCLUDED
@@ -2,18 +2,158 @@
 %module(threads="1") machine
 %{
 #include "machine.hpp"
+#include <memory>
+#include <stdexcept>
+#include <cstring>
 #define TEXTIFY(s) _TEXTIFY(s)
 #define _TEXTIFY(s) #s
+
+//Holds buffer of a python object, releases it when wrapper returns
+struct BufferView{
+  Py_buffer view;
+  bool acquired;
+  BufferView():acquired(false){};
+  ~BufferView(){ if (acquired) PyBuffer_Release(&view); };
+  bool acquire(PyObject *obj, int flags){
+    acquired = (PyObject_GetBuffer(obj, &view, flags | PyBUF_C_CONTIGUOUS) == 0);
+    return acquired;
+  };
+  //Items of the buffer have one of the given struct formats and the given size.
+  //Buffer must be acquired with PyBUF_FORMAT
+  bool check_format(const char *formats, Py_ssize_t itemsize, const char *message){
+    const char *format = view.format ? view.format : "B";
+    if (*format == '@' || *format == '=') ++format;
+    if (view.itemsize != itemsize || format[0] == 0 || format[1] != 0 || !strchr(formats, format[0])){
+      PyErr_SetString(PyExc_ValueError, message);
+      return false;
+    }
+    return true;
+  };
+};
 %}
 
-%typemap(in) (const i8 *bytes, size_t array_length) {
-    Py_ssize_t len;
-    char * pbuffer;
-    if (-1==PyBytes_AsStringAndSize($input, &pbuffer, &len)){
+%include "exception.i"
+%include "std_string.i"
+%exception {
+  try{
+    $action
+  }catch(const std::exception &e){
+    SWIG_exception(SWIG_ValueError, e.what());
+  }
+}
+
+//Code: any contiguous buffer of bytes, e.g. bytes, bytearray, memoryview or numpy uint8 array.
+//Buffers of wider items are rejected, not reinterpreted.
+//Machine copies it when loading, so no intermediate bytes object is needed
+%typemap(in) (const i8 *bytes, size_t array_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_FORMAT)){
+      return NULL;
+    }
+    if (pybuf.view.itemsize != 1){
+      PyErr_SetString(PyExc_TypeError, "Code must be a buffer of bytes");
+      return NULL;
+    }
+    $1 = reinterpret_cast<i8*>(pybuf.view.buf);
+    $2 = pybuf.view.len;
+ }
+
+//Read-only contiguous buffer of bytes
+%typemap(in) (const i8 *genomes, size_t genomes_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_FORMAT) || !pybuf.check_format("Bbc", 1, "Expected a buffer of bytes")){
+      return NULL;
+    }
+    $1 = reinterpret_cast<i8*>(pybuf.view.buf);
+    $2 = pybuf.view.len;
+ }
+
+//Read-only contiguous buffer of size_t values, e.g. array('Q')
+%typemap(in) (const size_t *offsets, size_t offsets_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_FORMAT) || !pybuf.check_format("QLN", sizeof(size_t), "Expected a buffer of size_t values")){
+      return NULL;
+    }
+    $1 = reinterpret_cast<size_t*>(pybuf.view.buf);
+    $2 = pybuf.view.len / sizeof(size_t);
+ }
+
+//Writable contiguous buffer of doubles, e.g. array('d')
+%typemap(in) (double *result, size_t result_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_WRITABLE | PyBUF_FORMAT) || !pybuf.check_format("d", sizeof(double), "Expected a buffer of doubles")){
+      return NULL;
+    }
+    $1 = reinterpret_cast<double*>(pybuf.view.buf);
+    $2 = pybuf.view.len / sizeof(double);
+ }
+
+//Read-only contiguous buffer of points, DIMENSION doubles per point
+%typemap(in) (const double *points, size_t points_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_FORMAT) || !pybuf.check_format("d", sizeof(double), "Expected a buffer of doubles")){
+      return NULL;
+    }
+    if (pybuf.view.len % (sizeof(double)*DIMENSION) != 0){
+      PyErr_SetString(PyExc_ValueError, "Buffer must have " TEXTIFY(DIMENSION) " doubles per point");
+      return NULL;
+    }
+    $1 = reinterpret_cast<double*>(pybuf.view.buf);
+    $2 = pybuf.view.len / (sizeof(double)*DIMENSION);
+ }
+
+//List of machines
+%typemap(in) (Machine **machines, size_t count) (std::vector<Machine*> pointers) {
+    if (!PySequence_Check($input)){
+      PyErr_SetString(PyExc_TypeError, "expected a sequence of machines.");
+      return NULL;
+    }
+    Py_ssize_t n = PySequence_Size($input);
+    pointers.resize(n);
+    for(Py_ssize_t i=0; i!=n; ++i){
+      PyObject *item = PySequence_GetItem($input, i);
+      int res = SWIG_ConvertPtr(item, (void**)&pointers[i], $descriptor(Machine*), 0);
+      Py_XDECREF(item);
+      if (!SWIG_IsOK(res)){
+	PyErr_SetString(PyExc_TypeError, "expected a sequence of machines.");
+	return NULL;
+      }
+    }
+    $1 = n ? &pointers[0] : NULL;
+    $2 = n;
+ }
+
+//Writable buffer of bytes, e.g. bytearray
+%typemap(in) (i8 *flags, size_t flags_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_WRITABLE | PyBUF_FORMAT) || !pybuf.check_format("Bbc", 1, "Expected a buffer of bytes")){
+      return NULL;
+    }
+    $1 = reinterpret_cast<i8*>(pybuf.view.buf);
+    $2 = pybuf.view.len;
+ }
+
+//Read-only contiguous buffer of doubles, e.g. array('d')
+%typemap(in) (const double *values, size_t values_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_FORMAT) || !pybuf.check_format("d", sizeof(double), "Expected a buffer of doubles")){
+      return NULL;
+    }
+    $1 = reinterpret_cast<double*>(pybuf.view.buf);
+    $2 = pybuf.view.len / sizeof(double);
+ }
+%apply (const double *values, size_t values_length) { (const double *states, size_t length), (const double *state, size_t length), (const double *states, size_t states_length) };
+%apply (double *result, size_t result_length) { (double *state, size_t length), (double *states, size_t length), (double *trace, size_t length) };
+
+//Writable contiguous buffer of size_t values, e.g. array('Q')
+%typemap(in) (size_t *used, size_t used_length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_WRITABLE | PyBUF_FORMAT) || !pybuf.check_format("QLN", sizeof(size_t), "Expected a buffer of size_t values")){
+      return NULL;
+    }
+    $1 = reinterpret_cast<size_t*>(pybuf.view.buf);
+    $2 = pybuf.view.len / sizeof(size_t);
+ }
+
+//Writable contiguous buffer of 64-bit integers, e.g. array('q')
+%typemap(in) (long long *table, size_t length) (BufferView pybuf) {
+    if (!pybuf.acquire($input, PyBUF_WRITABLE | PyBUF_FORMAT) || !pybuf.check_format("ql", sizeof(long long), "Expected a buffer of 64-bit integers")){
       return NULL;
     }
-    $1 = reinterpret_cast<i8*>(pbuffer);
-    $2 = len;
+    $1 = reinterpret_cast<long long*>(pybuf.view.buf);
+    $2 = pybuf.view.len / sizeof(long long);
  }
 
 // Parse vector from tuple
@@ -78,12 +218,23 @@ def point_str(self):
 point.__str__ = point_str
 del point_str
 
-def wrapfunc(func):
+def wrapfunc(func, vectorized=False):
+    """Wrap python function to use it as an objective.
+    If vectorized is True, func receives numpy array of shape (N, DIMENSION)
+    and must return N values; machines can then evaluate their points in batches"""
     if not callable(func): raise ValueError("Function mus be callable")
     f = CallbackFunction()
-    f._set(func)
-    f._function = func	     
-    return f	  
+    if vectorized:
+        import numpy as np
+        def adapter(points, values, n):
+            x = np.frombuffer(points, dtype=np.float64).reshape(n, DIMENSION)
+            np.frombuffer(values, dtype=np.float64)[:] = func(x)
+        f._set_vectorized(adapter)
+        f._function = adapter
+    else:
+        f._set(func)
+        f._function = func
+    return f
 %}
 
 %feature("pythonprepend") Machine::set_function(AbstractFunction &) %{
@@ -128,12 +279,72 @@ public:
     double get_float_reg(size_t i);
     void set_float_reg(size_t i, double v);
     int get_jump_index(size_t address);
+    %rename(_jump_table) jump_table;
+    void jump_table(long long *table, size_t length)const;
+    size_t code_size()const;
     Machine();
     void set_function(AbstractFunction &f);
     
     void set_trace_live_code(bool t);
     void get_trace_live_code()const;
     bool is_instruction_live(size_t address)const;    
+    %rename(_live_mask) live_mask;
+    %thread;
+    void live_mask(size_t attempts, size_t steps, i8 *flags, size_t flags_length);
+    %nothread;
+
+    //initial states, used by reset() one after another. Empty buffer returns to random states
+    void set_initial_states(const double *states, size_t length);
+    %rename(_snapshot) snapshot;
+    void snapshot(double *state, size_t length)const;
+    void restore(const double *state, size_t length);
+    %rename(_get_state) get_state;
+    void get_state(double *state, size_t length)const;
+    void set_state(const double *state, size_t length);
+    %rename(_record_trace) record_trace;
+    %thread;
+    size_t record_trace(size_t steps, size_t every, double *trace, size_t length);
+    %nothread;
+    %pythoncode %{
+    def jump_table(self):
+        """array('q') of jump targets of all instructions, -1 for non-jump instructions"""
+        from array import array
+        table = array('q', bytes(self.code_size()*array('q').itemsize))
+        self._jump_table(table)
+        return table
+    def live_mask(self, attempts=10, steps=10000):
+        """bytearray with 1 for instructions, executed in `attempts` runs of `steps` steps, 0 for dead code"""
+        mask = bytearray(self.code_size())
+        self._live_mask(attempts, steps, mask)
+        return mask
+    def snapshot(self, state=None):
+        """Copy state of registers, accumulators and counters to array('d') of SNAPSHOT_SIZE values.
+        If state buffer is given, it is filled and returned"""
+        if state is None:
+            from array import array
+            state = array('d', bytes(SNAPSHOT_SIZE*array('d').itemsize))
+        self._snapshot(state)
+        return state
+    def get_state(self, state=None):
+        """Accumulators and registers as array('d') of STATE_SIZE values: float accumulator,
+        vector accumulator, vector registers, float registers.
+        If state buffer is given, it is filled and returned"""
+        if state is None:
+            from array import array
+            state = array('d', bytes(STATE_SIZE*array('d').itemsize))
+        self._get_state(state)
+        return state
+    def record_trace(self, steps, every=1, trace=None):
+        """Make steps, recording state before every `every`-th step.
+        Each record has TRACE_RECORD_SIZE values: ncalls, cpr and the state, as in get_state.
+        If trace buffer is given, it is filled, otherwise new array('d') is made. Returns the buffer"""
+        if trace is None:
+            from array import array
+            nrecords = (steps + every - 1) // every if every > 0 else 0
+            trace = array('d', bytes(nrecords*TRACE_RECORD_SIZE*array('d').itemsize))
+        self._record_trace(steps, every, trace)
+        return trace
+    %}
 };
 
 class AbstractFunction{
@@ -141,15 +352,86 @@ class AbstractFunction{
   AbstractFunction();
   virtual ~AbstractFunction();
   virtual double evaluate(const vec& x)const=0;
+  virtual bool prefers_batches()const;
 };
 
+%extend AbstractFunction{
+  %rename(_evaluate_many) evaluate_many;
+  void evaluate_many(const double *points, size_t points_length, double *result, size_t result_length){
+    if (result_length != points_length)
+      throw std::invalid_argument("Result must have one value per point");
+    self->evaluate_many(points, points_length, result);
+  }
+  %pythoncode %{
+    def evaluate_many(self, points):
+        """Values in the points, given as flat buffer of doubles, DIMENSION per point.
+        Returns array('d')"""
+        from array import array
+        points = memoryview(points).cast('B')
+        result = array('d', bytes(len(points)//DIMENSION))
+        self._evaluate_many(points, result)
+        return result
+  %}
+}
+
 class FunctionTable: public AbstractFunction{
 public:
+  size_t index;
   FunctionTable(size_t index_);
   virtual ~FunctionTable();
   virtual double evaluate(const vec&x)const;
 };
 
+//Function, given by expression of x and y, compiled to native bytecode.
+//Evaluation does not need GIL
+class ExpressionFunction: public AbstractFunction{
+public:
+  std::string source;
+  ExpressionFunction(const std::string &expression);
+  virtual ~ExpressionFunction();
+  virtual double evaluate(const vec&x)const;
+};
+
+%extend ExpressionFunction{
+  %pythoncode %{
+    @property
+    def cache_key(self):
+        return "expression:" + self.source
+    def __repr__(self):
+        return f"ExpressionFunction({self.source!r})"
+  %}
+}
+
+//Function, given by address of the native function double f(const double *x, size_t n).
+//Evaluation does not need GIL
+class NativeFunction: public AbstractFunction{
+public:
+  NativeFunction(size_t address);
+  virtual ~NativeFunction();
+  virtual double evaluate(const vec&x)const;
+};
+
+%pythoncode %{
+def nativefunc(func, cache_key=None):
+    """Wrap native function with signature double f(const double *x, size_t n).
+    func is the address, ctypes function pointer or any object convertible to int, e.g. cffi pointer cast to uintptr_t.
+    cache_key is a string, identifying the function for the fitness cache"""
+    if isinstance(func, int):
+        address = func
+    else:
+        import ctypes
+        if isinstance(func, ctypes._CFuncPtr):
+            address = ctypes.cast(func, ctypes.c_void_p).value
+        else:
+            address = int(func)
+    f = NativeFunction(address or 0)
+    #keep the owner of the code (e.g. the loaded library) alive
+    f._function = func
+    if cache_key is not None:
+        f.cache_key = cache_key
+    return f
+%}
+
 //function pointer type for callback
 %{
   static double PythonCallback(double x, double y, void* data)
@@ -169,6 +451,24 @@ public:
     PyGILState_Release(state);
     return dres;
   }
+
+  //calls python function as func(points, values, n) with writable memoryviews
+  static void PythonBatchCallback(const double *points, size_t n, double *values, void* data)
+  {
+    PyGILState_STATE state = PyGILState_Ensure();
+    PyObject* func = (PyObject*)data;
+    PyObject* pts = PyMemoryView_FromMemory((char*)points, n*DIMENSION*sizeof(double), PyBUF_READ);
+    PyObject* out = PyMemoryView_FromMemory((char*)values, n*sizeof(double), PyBUF_WRITE);
+    PyObject* res = PyObject_CallFunction(func, "OOn", pts, out, (Py_ssize_t)n);
+    if (!res){
+      PyErr_Print();
+      for(size_t i=0; i!=n; ++i) values[i] = -1;
+    }
+    Py_XDECREF(res);
+    Py_XDECREF(pts);
+    Py_XDECREF(out);
+    PyGILState_Release(state);
+  }
 %}
 
 typedef double (*TFunc)(double, double, void*);
@@ -179,13 +479,128 @@ public:
   virtual double evaluate(const vec& x)const;
 };
 
-%addmethods CallbackFunction{
+%extend CallbackFunction{
   void _set(PyObject* pyfunc){
     //This method would not increase reference count of the function; it is handled by the wrapfunc function
     self->callback = &PythonCallback;
     self->userdata = (void*)pyfunc;
   }
+  void _set_vectorized(PyObject* pyfunc){
+    self->callback = 0;
+    self->batch_callback = &PythonBatchCallback;
+    self->userdata = (void*)pyfunc;
+  }
 }
 
+%constant int DIMENSION = DIMENSION;
+%constant int SNAPSHOT_SIZE = SNAPSHOT_SIZE;
+%constant int INITIAL_STATE_SIZE = INITIAL_STATE_SIZE;
+%constant int STATE_SIZE = STATE_SIZE;
+%constant int TRACE_RECORD_SIZE = TRACE_RECORD_SIZE;
+
+%rename(_random_initial_states) random_initial_states;
+void random_initial_states(double *states, size_t length);
+%pythoncode %{
+def random_initial_states(count):
+    """array('d') of count random initial states for Machine.set_initial_states"""
+    from array import array
+    states = array('d', bytes(count*INITIAL_STATE_SIZE*array('d').itemsize))
+    _random_initial_states(states)
+    return states
+%}
+
+%thread;
+%inline %{
+  //run_lockstep, flags of reaching the target are written to the bytes buffer
+  void _run_lockstep(Machine **machines, size_t count,
+		     size_t maxsteps, size_t maxevals, const vec& target, double tol,
+		     AbstractFunction &f, i8 *flags, size_t flags_length){
+    if (flags_length != count)
+      throw std::invalid_argument("Must be one flag per machine");
+    std::unique_ptr<bool[]> reached(new bool[count]);
+    run_lockstep(machines, count, maxsteps, maxevals, target, tol, f, reached.get());
+    for(size_t i=0; i!=count; ++i) flags[i] = reached[i];
+  }
+%}
+%nothread;
+
+%pythoncode %{
+def runto_many(machines, maxsteps, maxevals, target, tol, func):
+    """Run machines together, like Machine.runto, evaluating the function
+    in the points, requested by all machines, in one call.
+    Returns list of flags: True if the machine reached the target"""
+    if isinstance(func, int): func = FunctionTable(func)
+    flags = bytearray(len(machines))
+    _run_lockstep(machines, maxsteps, maxevals, target, tol, func, flags)
+    return [bool(f) for f in flags]
+%}
+
 void randomize();
+void seed_random(unsigned int seed);
 const char* command_system_hash();
+
+%rename(_evaluate_population) evaluate_population;
+%thread;
+void evaluate_population(const i8* genomes, size_t genomes_length,
+			 const size_t *offsets, size_t offsets_length,
+			 AbstractFunction &f, const vec& target,
+			 size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+			 size_t threads,
+			 double *result, size_t result_length,
+			 const double *states, size_t states_length);
+%rename(_race_population) race_population;
+void race_population(const i8* genomes, size_t genomes_length,
+		     const size_t *offsets, size_t offsets_length,
+		     AbstractFunction &f, const vec& target,
+		     size_t maxsteps, size_t maxevals, double tol, size_t attempts,
+		     double threshold, size_t increment, double z,
+		     size_t threads,
+		     double *result, size_t result_length,
+		     size_t *used, size_t used_length,
+		     const double *states, size_t states_length);
+%nothread;
+
+%pythoncode %{
+def evaluate_population(genomes, func, target, maxsteps, maxevals, tol, attempts, threads=0,
+                        initial_states=None):
+    """Evaluate fitness of the list of genomes using native threads, without GIL.
+    Returns flat array of doubles, with 4 fitness values per genome,
+    same as genetic_optim.Fitness returns.
+    threads=0 means use all hardware threads.
+    initial_states: optional buffer of initial states, used by the attempts of every genome
+    (see Machine.set_initial_states). If not given, states are random.
+    """
+    from array import array
+    if isinstance(func, int): func = FunctionTable(func)
+    offsets = array('Q', [0])
+    for g in genomes:
+        offsets.append(offsets[-1]+len(g))
+    result = array('d', bytes(4*len(genomes)*array('d').itemsize))
+    if initial_states is None: initial_states = array('d')
+    _evaluate_population(b"".join(genomes), offsets, func, target,
+                         maxsteps, maxevals, tol, attempts, threads,
+                         result, initial_states)
+    return result
+
+def race_population(genomes, func, target, maxsteps, maxevals, tol, attempts,
+                    threshold, increment=5, z=2.0, threads=0, initial_states=None):
+    """Same as evaluate_population, but after every increment attempts
+    genomes whose upper confidence bound of the distance (mean + z*stddev/sqrt(n))
+    is below the threshold are not evaluated anymore.
+    Returns pair: flat array of fitness values, 4 per genome, and array('Q') of attempts made.
+    initial_states are used like in evaluate_population.
+    """
+    from array import array
+    if isinstance(func, int): func = FunctionTable(func)
+    offsets = array('Q', [0])
+    for g in genomes:
+        offsets.append(offsets[-1]+len(g))
+    result = array('d', bytes(4*len(genomes)*array('d').itemsize))
+    used = array('Q', bytes(len(genomes)*array('Q').itemsize))
+    if initial_states is None: initial_states = array('d')
+    _race_population(b"".join(genomes), offsets, func, target,
+                     maxsteps, maxevals, tol, attempts,
+                     threshold, increment, z, threads,
+                     result, used, initial_states)
+    return result, used
+%}
@@ -0,0 +1,291 @@
+"""Pure NumPy interpreter of the machinedef instruction set.
+
+State of many machines is kept as arrays (structure of arrays), all machines
+make their steps together: on every step machines are grouped by the current
+command, and each group is updated by masked array operations.
+Semantics match Machine.step of the native machine, so it can be used
+where the extension can not be built, and as the second population evaluator.
+"""
+import numpy as np
+import machinedef
+from machinedef import ArgType, NVECREG, NFLOATREG
+
+DIMENSION = 2
+#layouts match the native machine: see Machine.set_initial_states and Machine.snapshot
+INITIAL_STATE_SIZE = (NVECREG+1)*DIMENSION
+SNAPSHOT_SIZE = 5 + (NVECREG+1)*(DIMENSION+2) + NVECREG + NFLOATREG
+
+_cmd = {cmd.name: cmd.code for cmd in machinedef.commands}
+_jump_commands = [cmd.code for cmd in machinedef.commands if cmd.jumpdir is not None]
+
+def _rozen(x, y):
+    return x*x + 20*(y+1-(x+1)*(x+1))**2
+
+def table_function(index):
+    """Vectorized version of FunctionTable: takes (N, 2) array of points, returns N values"""
+    index = index % 4
+    def f(points):
+        x, y = points[:, 0], points[:, 1]
+        if index == 0: return _rozen(x-1, y-1)
+        if index == 1: return _rozen(x, y)
+        if index == 2: return _rozen(y-2, x-1)
+        return x*x + y*y
+    return f
+
+def _label_distance():
+    """Hamming distances between label bytes, 256x256"""
+    x = np.arange(256, dtype=np.uint8)
+    return np.unpackbits((x[:, None] ^ x[None, :])[..., None], axis=-1).sum(axis=-1)
+_label_dist = _label_distance()
+
+def decode(genome):
+    """Decode genome like Machine.load_code.
+    Returns arrays of command codes, register indices, float arguments and jump targets"""
+    raw = np.frombuffer(genome, dtype=np.uint8)[:len(genome)//2*2]
+    ops = (raw[0::2] % len(machinedef.commands)).astype(np.int64)
+    args = raw[1::2].astype(np.int64)
+    argtypes = np.array([cmd.argtype for cmd in machinedef.commands], dtype=object)[ops]
+    index = np.zeros(len(ops), dtype=np.int64)
+    fvalue = np.zeros(len(ops), dtype=np.float64)
+    is_freg = argtypes == ArgType.FREG
+    is_vreg = argtypes == ArgType.VREG
+    is_fval = argtypes == ArgType.FVAL
+    index[is_freg] = args[is_freg] % NFLOATREG
+    index[is_vreg] = args[is_vreg] % NVECREG
+    fvalue[is_fval] = args[is_fval].astype(np.int8).astype(np.float64) / 32.0
+    target = resolve_jumps(ops, args)
+    return ops, index, fvalue, target
+
+def resolve_jumps(ops, args):
+    """Jump targets, like Machine.find_label: label with the nearest byte,
+    of them the nearest in the jump direction. -1 for other commands"""
+    size = len(ops)
+    target = np.full(size, -1, dtype=np.int64)
+    labels = np.nonzero(ops == _cmd['label'])[0]
+    for i in np.nonzero(np.isin(ops, _jump_commands))[0]:
+        if len(labels) == 0:
+            target[i] = i
+            continue
+        dist = _label_dist[args[labels], args[i]]
+        if machinedef.commands[ops[i]].jumpdir == "down":
+            offset = (labels - i) % size
+        else:
+            offset = (i - labels) % size
+        #lexicographic minimum of (distance, offset)
+        target[i] = labels[np.lexsort((offset, dist))[0]]
+    return target
+
+class NumpyMachines:
+    """Many machines, running in lockstep. Machine i runs genomes[i]"""
+    def __init__(self, genomes, func):
+        """func takes (N, 2) array of points and returns N values"""
+        self.func = func
+        count = len(genomes)
+        decoded = [decode(g) for g in genomes]
+        self.size = np.array([len(d[0]) for d in decoded], dtype=np.int64)
+        width = max(1, self.size.max() if count else 1)
+        #code, padded with nops
+        self.ops = np.full((count, width), _cmd['nop'], dtype=np.int64)
+        self.arg_index = np.zeros((count, width), dtype=np.int64)
+        self.arg_float = np.zeros((count, width), dtype=np.float64)
+        self.target = np.zeros((count, width), dtype=np.int64)
+        for i, (ops, index, fvalue, target) in enumerate(decoded):
+            n = len(ops)
+            self.ops[i, :n] = ops
+            self.arg_index[i, :n] = index
+            self.arg_float[i, :n] = fvalue
+            self.target[i, :n] = target
+        self.rows = np.arange(count)
+
+        self.vacc_x = np.zeros((count, DIMENSION))
+        self.vacc_f = np.zeros(count)
+        self.vacc_evaluated = np.zeros(count, dtype=bool)
+        self.vreg_x = np.zeros((count, NVECREG, DIMENSION))
+        self.vreg_f = np.zeros((count, NVECREG))
+        self.vreg_evaluated = np.zeros((count, NVECREG), dtype=bool)
+        self.vreg_changed = np.zeros((count, NVECREG), dtype=bool)
+        self.facc = np.zeros(count)
+        self.freg = np.zeros((count, NFLOATREG))
+        self.flag = np.zeros(count, dtype=bool)
+        self.cpr = np.zeros(count, dtype=np.int64)
+        self.nsteps = np.zeros(count, dtype=np.int64)
+        self.ncalls = np.zeros(count, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def reset(self, states=None):
+        """Reset all machines. states is (count, INITIAL_STATE_SIZE) array of initial states;
+        if not given, random states are used"""
+        count = len(self)
+        if states is None:
+            states = np.random.uniform(-1.0, 1.0, size=(count, INITIAL_STATE_SIZE))
+        states = np.asarray(states, dtype=np.float64).reshape(count, NVECREG+1, DIMENSION)
+        self.vacc_x[:] = states[:, 0]
+        self.vreg_x[:] = states[:, 1:]
+        self.vacc_evaluated[:] = False
+        self.vreg_evaluated[:] = False
+        self.vreg_changed[:] = True
+        self.facc[:] = 0.0
+        self.freg[:] = 0.0
+        self.flag[:] = False
+        self.cpr[:] = 0
+        self.nsteps[:] = 0
+        self.ncalls[:] = 0
+
+    def _evaluate_accumulators(self, rows):
+        rows = rows[~self.vacc_evaluated[rows]]
+        if len(rows):
+            self.vacc_f[rows] = self.func(self.vacc_x[rows])
+            self.vacc_evaluated[rows] = True
+            self.ncalls[rows] += 1
+
+    def _evaluate_registers(self, rows, regs):
+        need = ~self.vreg_evaluated[rows, regs]
+        rows, regs = rows[need], regs[need]
+        if len(rows):
+            self.vreg_f[rows, regs] = self.func(self.vreg_x[rows, regs])
+            self.vreg_evaluated[rows, regs] = True
+            self.ncalls[rows] += 1
+
+    def step(self, active=None):
+        """Make one step of the active machines (boolean mask, all by default)"""
+        with np.errstate(all='ignore'):
+            self._step(self.rows if active is None else self.rows[active])
+
+    def _step(self, rows):
+        self.nsteps[rows] += 1
+        rows = rows[self.size[rows] > 0]
+        cpr = self.cpr[rows]
+        ops = self.ops[rows, cpr]
+        for op in np.unique(ops):
+            sel = ops == op
+            r = rows[sel]
+            i = self.arg_index[r, cpr[sel]]
+            self._execute(machinedef.commands[op], r, i, self.arg_float[r, cpr[sel]], cpr[sel])
+        self.cpr[rows] += 1
+        self.cpr[rows] %= self.size[rows]
+
+    def _execute(self, cmd, r, i, value, cpr):
+        name = cmd.name
+        if not cmd.enabled or name in ('nop', 'label'):
+            return
+        if cmd.jumpdir is not None:
+            if cmd.condition is not None:
+                taken = self.flag[r] == cmd.condition
+                r, cpr = r[taken], cpr[taken]
+            self.cpr[r] = self.target[r, cpr]
+        elif name == 'vload':
+            self.vacc_x[r] = self.vreg_x[r, i]
+            self.vacc_f[r] = self.vreg_f[r, i]
+            self.vacc_evaluated[r] = self.vreg_evaluated[r, i]
+        elif name == 'vstore':
+            self.vreg_x[r, i] = self.vacc_x[r]
+            self.vreg_f[r, i] = self.vacc_f[r]
+            self.vreg_evaluated[r, i] = self.vacc_evaluated[r]
+            self.vreg_changed[r, i] = True
+        elif name == 'vmerge':
+            fa = self.facc[r][:, None]
+            x = self.vacc_x[r] * fa
+            x += (1.0-fa) * self.vreg_x[r, i]
+            self.vacc_x[r] = x
+            self.vacc_evaluated[r] = False
+        elif name == 'vswap':
+            x, f, e = self.vacc_x[r].copy(), self.vacc_f[r].copy(), self.vacc_evaluated[r].copy()
+            self.vacc_x[r] = self.vreg_x[r, i]
+            self.vacc_f[r] = self.vreg_f[r, i]
+            self.vacc_evaluated[r] = self.vreg_evaluated[r, i]
+            self.vreg_x[r, i] = x
+            self.vreg_f[r, i] = f
+            self.vreg_evaluated[r, i] = e
+            self.vreg_changed[r, i] = True
+        elif name == 'vless':
+            self._evaluate_accumulators(r)
+            self._evaluate_registers(r, i)
+            self.flag[r] = self.vacc_f[r] < self.vreg_f[r, i]
+        elif name == 'fload':
+            self.facc[r] = self.freg[r, i]
+        elif name == 'fload_value':
+            self.facc[r] = value
+        elif name == 'fstore':
+            self.freg[r, i] = self.facc[r]
+        elif name == 'fadd':
+            self.facc[r] += self.freg[r, i]
+        elif name == 'fadd_value':
+            self.facc[r] += value
+        elif name == 'fmul':
+            self.facc[r] *= self.freg[r, i]
+        elif name == 'fmul_value':
+            self.facc[r] *= value
+        elif name == 'fswap':
+            f = self.facc[r].copy()
+            self.facc[r] = self.freg[r, i]
+            self.freg[r, i] = f
+        elif name == 'fless':
+            self.flag[r] = self.facc[r] < self.freg[r, i]
+        elif name == 'fless_value':
+            self.flag[r] = self.facc[r] < value
+        else:
+            raise NotImplementedError(f"Command {name} is not implemented")
+
+    def steps(self, n):
+        for _ in range(n):
+            self.step()
+
+    def runto(self, maxsteps, maxevals, target, tol):
+        """Run all machines like Machine.runto, returns boolean array: machine reached the target"""
+        target = np.asarray(target, dtype=np.float64)
+        reached = np.zeros(len(self), dtype=bool)
+        running = np.ones(len(self), dtype=bool)
+        while True:
+            running &= (self.nsteps < maxsteps) & (self.ncalls < maxevals)
+            check = running & self.vreg_changed[:, 0]
+            self.vreg_changed[check, 0] = False
+            near = check & (np.abs(self.vreg_x[:, 0] - target).sum(axis=1) <= tol)
+            reached |= near
+            running &= ~near
+            if not running.any():
+                return reached
+            self.step(running)
+
+    def snapshot(self):
+        """(count, SNAPSHOT_SIZE) array in the layout of Machine.snapshot"""
+        def points(x, f, e):
+            return np.concatenate([x, f[..., None], e[..., None]], axis=-1)
+        count = len(self)
+        return np.concatenate([
+            self.facc[:, None], self.flag[:, None], self.cpr[:, None],
+            self.nsteps[:, None], self.ncalls[:, None],
+            points(self.vacc_x, self.vacc_f, self.vacc_evaluated),
+            points(self.vreg_x, self.vreg_f, self.vreg_evaluated).reshape(count, -1),
+            self.vreg_changed, self.freg], axis=1).astype(np.float64)
+
+def _check_commands():
+    implemented = set("""nop label vload vstore vmerge vswap vless fload fload_value fstore
+    fadd fadd_value fmul fmul_value fswap fless fless_value""".split())
+    for cmd in machinedef.commands:
+        if cmd.enabled and cmd.jumpdir is None and cmd.name not in implemented:
+            raise NotImplementedError(f"Command {cmd.name} of the command system is not implemented")
+_check_commands()
+
+def evaluate_population(genomes, func, target, maxsteps, maxevals, tol, attempts):
+    """Fitness of the genomes, like machine.evaluate_population. func is vectorized function,
+    or index in the function table. Returns list of fitness tuples"""
+    if isinstance(func, int): func = table_function(func)
+    machines = NumpyMachines(genomes, func)
+    target = np.asarray(target, dtype=np.float64)
+    norms = np.zeros(len(genomes))
+    evals = np.zeros(len(genomes))
+    steps = np.zeros(len(genomes))
+    for _ in range(attempts):
+        machines.reset()
+        reached = machines.runto(maxsteps, maxevals, target, tol)
+        dist = np.abs(machines.vreg_x[:, 0] - target).sum(axis=1)
+        dist[np.isnan(dist)] = 1e100
+        main = np.where(reached, 0.0, -dist)
+        main -= np.where(machines.ncalls < 10, 10.0*(10-machines.ncalls), 0.0)
+        norms += main
+        evals += machines.ncalls
+        steps += machines.nsteps
+    return [(n/attempts, -e/attempts, -s/attempts, -len(g))
+            for n, e, s, g in zip(norms, evals, steps, genomes)]
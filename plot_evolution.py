@@ -1,8 +1,11 @@
 #!/usr/bin/env python
+import os
 import numpy as np
 import json
 import argparse
 import machinedef
+from binlog import is_binlog, BinaryLogReader
+from utils import load_index, load_json_line
 
 class SkipLine(Exception):pass
 
@@ -20,7 +23,23 @@ def parseline_legacy(line):
     ((dist, neval, steps, size),code) = eval(srest)
     return -dist, -neval, code, None
     
+class BinaryLogCodes:
+    """Sequence of (code, hash) pairs of the binary log, codes are read on demand"""
+    def __init__(self, log):
+        self.log = log
+    def __len__(self):
+        return len(self.log)
+    def __getitem__(self, i):
+        return self.log.genome(i), self.log.meta.get('command_system_hash')
+
+def parsebinlog(logfile):
+    log = BinaryLogReader(logfile)
+    fitness = log.fitness()
+    return -fitness['dist'], -fitness['evals'], BinaryLogCodes(log)
+
 def parselog(logfile):
+    if is_binlog(logfile):
+        return parsebinlog(logfile)
     dists = []
     evals = []
     codes = []
@@ -37,43 +56,205 @@ def parselog(logfile):
                 print("Error reading line:", err)
     return dists, evals, codes
 
-if __name__=="__main__":
-    import sys
-    parser = argparse.ArgumentParser()
-    parser.add_argument("logfile",
-                        help="Log file for parsing")
-    args = parser.parse_args()
-    
-    dists, evals, codes = parselog(args.logfile)
-    print(f"Loaded {len(codes)} log points")
-    if not codes:
-        print("Nothing to show")
-        exit(0)
-        
-    from matplotlib import pyplot as pp
+class MinMaxSeries:
+    """Downsampled series with bounded memory.
+    Points are grouped into buckets of equal width, each bucket keeps minimum and maximum.
+    When there are too many buckets, neighbour buckets are merged and the width is doubled"""
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self.width = 1
+        self.starts = []
+        self.mins = []
+        self.maxs = []
+    def add(self, x, value):
+        if self.starts and self.starts[-1]//self.width == x//self.width:
+            self.mins[-1] = min(self.mins[-1], value)
+            self.maxs[-1] = max(self.maxs[-1], value)
+        else:
+            self.starts.append(x//self.width*self.width)
+            self.mins.append(value)
+            self.maxs.append(value)
+            if len(self.starts) > self.max_buckets:
+                self._merge()
+    def _merge(self):
+        self.width *= 2
+        starts, mins, maxs = [], [], []
+        for x, vmin, vmax in zip(self.starts, self.mins, self.maxs):
+            if starts and starts[-1] == x//self.width*self.width:
+                mins[-1] = min(mins[-1], vmin)
+                maxs[-1] = max(maxs[-1], vmax)
+            else:
+                starts.append(x//self.width*self.width)
+                mins.append(vmin)
+                maxs.append(vmax)
+        self.starts, self.mins, self.maxs = starts, mins, maxs
+    def clear(self):
+        self.width = 1
+        self.starts, self.mins, self.maxs = [], [], []
 
-    fig, (ax1, ax2) = pp.subplots(nrows=2, ncols=1, sharex=True)
+def parsefitness(line):
+    """Like parseline, but does not decode the code"""
+    if line[0] != "{":
+        dist, neval, _, _ = parseline_legacy(line)
+        return dist, neval
+    data = json.loads(line)
+    if 'hexcode' not in data: raise SkipLine()
+    (dist, neval, steps, size) = data['fitness']
+    return -dist, -neval
+
+class LogFollower:
+    """Reads only new records of the growing log, JSON or binary, keeps downsampled fitness series.
+    X coordinate of the points is the line number in the JSON log, or the record number in the binary one.
+    If the log is truncated or replaced by another file, it is read from the start"""
+    def __init__(self, logfile, max_points=10000):
+        self.logfile = logfile
+        self.nlines = 0
+        self.dists = MinMaxSeries(max_points)
+        self.evals = MinMaxSeries(max_points)
+        #device and inode of the log (of its meta.json, if log is binary)
+        #and its size (number of records, if log is binary) at the last update
+        self.identity = None
+        self.size = 0
+    def reset(self):
+        self.nlines = 0
+        self.dists.clear()
+        self.evals.clear()
+        #index of the old file may look valid for the new one
+        indexfile = self.logfile+".index"
+        if os.path.exists(indexfile):
+            os.remove(indexfile)
+    def update(self):
+        """Read new records, return True if there were any, or if the log was reset"""
+        binary = is_binlog(self.logfile)
+        if binary:
+            st = os.stat(os.path.join(self.logfile, "meta.json"))
+            log = BinaryLogReader(self.logfile)
+            size = len(log)
+        else:
+            st = os.stat(self.logfile)
+            size = st.st_size
+        identity = (st.st_dev, st.st_ino)
+        was_reset = False
+        if self.identity is not None and (identity != self.identity or size < self.size):
+            self.reset()
+            was_reset = True
+        self.identity, self.size = identity, size
+        if binary:
+            return self._read_binary(log) or was_reset
+        offsets = load_index(self.logfile, verbose=False)['offsets']
+        if len(offsets) <= self.nlines: return was_reset
+        with open(self.logfile, "rb") as h:
+            h.seek(offsets[self.nlines])
+            for nline in range(self.nlines, len(offsets)):
+                line = h.readline().decode("utf-8")
+                try:
+                    dist, neval = parsefitness(line)
+                    self.dists.add(nline, dist)
+                    self.evals.add(nline, neval)
+                except SkipLine:
+                    pass
+                except Exception as err:
+                    print("Error reading line:", err)
+        self.nlines = len(offsets)
+        return True
 
+    def _read_binary(self, log):
+        if len(log) <= self.nlines: return False
+        dists = -log.columns['dist'][self.nlines:]
+        evals = -log.columns['evals'][self.nlines:]
+        for nrecord, dist, neval in zip(range(self.nlines, len(log)), dists.tolist(), evals.tolist()):
+            self.dists.add(nrecord, dist)
+            self.evals.add(nrecord, neval)
+        self.nlines = len(log)
+        return True
+
+def onclick_handler(code_at):
+    """Handler of the clicks on the plot.
+    code_at(x) returns reference to the code, the code and its command system hash"""
     def onclick(event):
         print('%s click: button=%d, x=%d, y=%d, xdata=%f, ydata=%f' %
               ('double' if event.dblclick else 'single', event.button,
                event.x, event.y, event.xdata, event.ydata))
         x = int(round(event.xdata))
         if x < 0: x = 0
+        try:
+            ref, code, cshash = code_at(x)
+        except (IndexError, ValueError, SkipLine) as err:
+            print(f"No code at {x}: {err}")
+            return
         if event.button == 1:
             import subprocess
-            subprocess.call(["./plot_track.py", f"{args.logfile}:{x}","nmead.json"])
+            subprocess.call(["./plot_track.py", ref,"nmead.json"])
         elif event.button == 3:
             from analyser import show_cleaned_structure
-            code, cshash = codes[x]
-            print(f"{args.logfile}:{x}")
+            print(ref)
             if cshash is None:
                 print("Warning: no code system specified")
             else:
                 if cshash!=machinedef.command_system_hash():
                     print(f"Warning! command system does not match, expected {machinedef.command_system_hash()}, got {cshash}")
             show_cleaned_structure(code,wait=False)
-    cid = fig.canvas.mpl_connect('button_press_event', onclick)
+    return onclick
+
+def follow(logfile, interval, max_points):
+    from matplotlib import pyplot as pp
+    follower = LogFollower(logfile, max_points)
+    fig, (ax1, ax2) = pp.subplots(nrows=2, ncols=1, sharex=True)
+
+    def code_at(nline):
+        data = load_json_line(logfile, nline)
+        if 'hexcode' not in data: raise SkipLine()
+        return f"{logfile}:{nline}", bytes.fromhex(data['hexcode']), data.get('command_system_hash')
+    fig.canvas.mpl_connect('button_press_event', onclick_handler(code_at))
+
+    plots = []
+    for ax, series in ((ax1, follower.dists), (ax2, follower.evals)):
+        ax.set_yscale('log')
+        lmin, = ax.plot([], [], drawstyle='steps-post')
+        lmax, = ax.plot([], [], drawstyle='steps-post', color=lmin.get_color())
+        plots.append((ax, series, lmin, lmax))
+    ax2.set_xlabel("Log record" if is_binlog(logfile) else "Log line")
+
+    while pp.fignum_exists(fig.number):
+        if follower.update():
+            for ax, series, lmin, lmax in plots:
+                lmin.set_data(series.starts, series.mins)
+                lmax.set_data(series.starts, series.maxs)
+                ax.relim()
+                ax.autoscale_view()
+            fig.canvas.draw_idle()
+        pp.pause(interval)
+
+if __name__=="__main__":
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logfile",
+                        help="Log file for parsing")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="Follow the growing log, JSON or binary, reading only new records")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="Update interval in follow mode, seconds")
+    parser.add_argument("--max-points", type=int, default=10000,
+                        help="Maximal number of points per plot in follow mode")
+    args = parser.parse_args()
+
+    if args.follow:
+        follow(args.logfile, args.interval, args.max_points)
+        exit(0)
+    
+    dists, evals, codes = parselog(args.logfile)
+    print(f"Loaded {len(codes)} log points")
+    if not len(codes):
+        print("Nothing to show")
+        exit(0)
+        
+    from matplotlib import pyplot as pp
+
+    fig, (ax1, ax2) = pp.subplots(nrows=2, ncols=1, sharex=True)
+
+    def code_at(x):
+        return (f"{args.logfile}:{x}",)+tuple(codes[x])
+    cid = fig.canvas.mpl_connect('button_press_event', onclick_handler(code_at))
     
     ax1.semilogy(dists)
     ax2.semilogy(evals)
@@ -1,39 +1,30 @@
 #!/usr/bin/env python
-from machine import randomize, Machine, FunctionTable, command_system_hash, wrapfunc
+from machine import randomize, Machine, FunctionTable, command_system_hash, wrapfunc, TRACE_RECORD_SIZE, DIMENSION
 from matplotlib import pyplot
 import numpy as np
 import argparse
 from utils import load_code
 
-def get_tracks(code, funcindex, steps):
+def get_tracks(code, funcindex, steps, every=1):
+    """Numbers of calls, tracks of the vector registers (16, N, 2) and of the float registers (16, N),
+    recorded before every `every`-th step"""
     m = Machine()
     m.set_function(funcindex)
     m.load_code(code)
 
-    ncalls = []
-    registers_with_time=[[] for _ in range(16)]
-    fregisters_with_time=[[] for _ in range(16)]
-    
-    def check_changes(t):
-        ncalls.append(m.ncalls)
-        for idx, track in enumerate(registers_with_time):
-            value = m.get_vec_reg(idx)
-            track.append(value)
-            
-        for idx, track in enumerate(fregisters_with_time):
-            value = m.get_float_reg(idx)
-            track.append(value)
-
-    for t in range(steps):
-        check_changes(t)
-        m.step()
+    trace = np.frombuffer(m.record_trace(steps, every)).reshape(-1, TRACE_RECORD_SIZE)
+    ncalls = trace[:, 0]
+    vec_start = 3 + DIMENSION
+    vec_end = vec_start + 16*DIMENSION
+    registers_with_time = trace[:, vec_start:vec_end].reshape(-1, 16, DIMENSION).transpose(1, 0, 2)
+    fregisters_with_time = trace[:, vec_end:].T
     return ncalls, registers_with_time, fregisters_with_time
 
 def plot_tracks(calls, vecs, floats, x0, y0, style=""):
     #pyplot.subplot('121')
     for idx, track in enumerate(vecs):
-        xs = [x for (x,_) in track]
-        ys = [y for (_,y) in track]
+        xs = track[:, 0]
+        ys = track[:, 1]
         
         _,r = logtfm(x0,y0,xs,ys)
         pyplot.plot(calls,r,style)
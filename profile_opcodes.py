@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Opcode profile of the evolved genomes: most frequent sequences of commands in the live code.
+Writes the superinstructions file, used by generate_machine.py"""
+import json
+import argparse
+from collections import Counter
+import machinedef
+from binlog import is_binlog, BinaryLogReader
+from disassembler import canonicalize, map_live_code
+
+def log_genomes(logfile):
+    """Distinct genomes of the log records"""
+    genomes = set()
+    if is_binlog(logfile):
+        log = BinaryLogReader(logfile)
+        for i in range(len(log)):
+            genomes.add(log.genome(i))
+        return genomes
+    with open(logfile) as hfile:
+        for line in hfile:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if 'hexcode' in data:
+                genomes.add(bytes.fromhex(data['hexcode']))
+    return genomes
+
+def fusable(cmds):
+    """Sequence can be a superinstruction: commands are enabled, only the last one jumps"""
+    return (all(c.enabled for c in cmds) and
+            not any('j' in c.changes for c in cmds[:-1]) and
+            not any(c.name in ('nop', 'label') for c in cmds))
+
+def profile(genomes, lengths=(2, 3), live_only=True):
+    """Counter of command name sequences"""
+    counts = Counter()
+    for genome in genomes:
+        code = canonicalize(genome)
+        cmds = [machinedef.commands[op % len(machinedef.commands)] for op in code[0::2]]
+        live = map_live_code(code) if live_only else [True]*len(cmds)
+        for n in lengths:
+            for i in range(len(cmds)-n+1):
+                if not all(live[i:i+n]): continue
+                seq = cmds[i:i+n]
+                if fusable(seq):
+                    counts[tuple(c.name for c in seq)] += 1
+    return counts
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("logfile", nargs="+",
+                        help="Evolution logs, JSON or binary")
+    parser.add_argument("-n", "--count", type=int, default=8,
+                        help="Number of superinstructions")
+    parser.add_argument("--all-code", action="store_true",
+                        help="Count dead code too")
+    parser.add_argument("-o", "--output", default="superinstructions.json")
+    args = parser.parse_args()
+
+    genomes = set()
+    for logfile in args.logfile:
+        genomes.update(log_genomes(logfile))
+    print(f"Profiling {len(genomes)} genomes")
+    counts = profile(genomes, live_only=not args.all_code)
+    top = counts.most_common(args.count)
+    for seq, count in top:
+        print(f"{count:8d}  {' '.join(seq)}")
+    with open(args.output, "w") as hfile:
+        json.dump({'command_system_hash': machinedef.command_system_hash(),
+                   'superinstructions': [list(seq) for seq, count in top],
+                   'counts': [count for seq, count in top]},
+                  hfile, indent=1)
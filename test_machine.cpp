@@ -1,5 +1,6 @@
 #include "acutest.h"
 #include "machine.hpp"
+#include <stdexcept>
 
 
 void test_machine()
@@ -11,8 +12,370 @@ void test_machine()
   TEST_CHECK_(m.cpr==1, "Actual is %d", m.cpr); 
 }
 
+void test_jump_table()
+{
+  //jumps go to the label with the nearest byte, then to the nearest one in the jump direction
+  i8 code[]={ (i8)cmd_label, 5, (i8)cmd_nop, 0, (i8)cmd_jump_up, 5,
+	      (i8)cmd_label, 4, (i8)cmd_jump_down, 5, (i8)cmd_jump_down, 6 };
+  Machine m;
+  m.load_code(code, 12);
+  long long table[6];
+  m.jump_table(table, 6);
+  TEST_CHECK(table[0] == -1 && table[1] == -1 && table[3] == -1);
+  TEST_CHECK(table[2] == 0);
+  TEST_CHECK_(table[4] == 0, "Actual is %lld", table[4]);
+  //6 differs from 4 by 1 bit, from 5 by 2 bits
+  TEST_CHECK_(table[5] == 3, "Actual is %lld", table[5]);
+  //reloading clears the labels
+  i8 nolabels[]={ (i8)cmd_nop, 0, (i8)cmd_jump_down, 5 };
+  m.load_code(nolabels, 4);
+  TEST_CHECK(m.get_jump_index(1) == 1);
+}
+
+void test_evaluate_population()
+{
+  //two programs of nops: never evaluate the function, run all steps
+  i8 code[]={ (i8)cmd_nop, 0, (i8)cmd_nop, 0, (i8)cmd_nop, 0 };
+  size_t offsets[]={ 0, 2, 6 };
+  double result[8];
+  FunctionTable f(0);
+  vec target;
+  target.coord[0] = target.coord[1] = 1.0;
+  evaluate_population(code, 6, offsets, 3, f, target, 100, 10, 1e-5, 3, 2, result, 8);
+  for(size_t i=0; i!=2; ++i){
+    TEST_CHECK(result[4*i] < -100.0);
+    TEST_CHECK(result[4*i+1] == 0.0);
+    TEST_CHECK_(result[4*i+2] == -100.0, "Actual is %f", result[4*i+2]);
+  }
+  TEST_CHECK(result[3] == -2.0);
+  TEST_CHECK(result[7] == -4.0);
+
+  //given initial states are used instead of random ones: register 0 is at distance 1 from the target
+  double states[INITIAL_STATE_SIZE];
+  for(size_t i=0; i!=INITIAL_STATE_SIZE; ++i) states[i] = 0.5;
+  evaluate_population(code, 6, offsets, 3, f, target, 100, 10, 1e-5, 3, 2, result, 8,
+		      states, INITIAL_STATE_SIZE);
+  for(size_t i=0; i!=2; ++i)
+    TEST_CHECK_(result[4*i] == -101.0, "Actual is %f", result[4*i]);
+}
+
+void test_race_population()
+{
+  //nop programs are far below the threshold, they are raced out after the first increment
+  i8 code[]={ (i8)cmd_nop, 0, (i8)cmd_nop, 0, (i8)cmd_nop, 0 };
+  size_t offsets[]={ 0, 2, 6 };
+  double result[8];
+  size_t used[2];
+  FunctionTable f(0);
+  vec target;
+  target.coord[0] = target.coord[1] = 1.0;
+  race_population(code, 6, offsets, 3, f, target, 100, 10, 1e-5, 100, -50.0, 5, 2.0, 2, result, 8, used, 2);
+  TEST_CHECK_(used[0] == 5 && used[1] == 5, "Actual are %zu %zu", used[0], used[1]);
+  TEST_CHECK(result[0] < -100.0);
+  //with low threshold all attempts are made
+  race_population(code, 6, offsets, 3, f, target, 100, 10, 1e-5, 100, -1e10, 5, 2.0, 2, result, 8, used, 2);
+  TEST_CHECK(used[0] == 100 && used[1] == 100);
+}
+
+//table function, that asks for batched evaluation
+class BatchedFunction: public FunctionTable{
+public:
+  mutable size_t batches;
+  BatchedFunction():FunctionTable(0),batches(0){};
+  virtual void evaluate_many(const double *points, size_t n, double *values)const{
+    batches += 1;
+    FunctionTable::evaluate_many(points, n, values);
+  };
+  virtual bool prefers_batches()const{ return true; };
+};
+
+void test_run_lockstep()
+{
+  //machines, running in lockstep, must do the same as when running alone
+  const size_t count=20, size=200;
+  BatchedFunction f;
+  vec target;
+  target.coord[0] = target.coord[1] = 1.0;
+  random_engine rng(1);
+  std::vector<Machine> alone(count), together(count);
+  Machine* pointers[count];
+  bool reached[count];
+  i8 code[size];
+  for(size_t i=0; i!=count; ++i){
+    for(size_t j=0; j!=size; ++j) code[j] = static_cast<i8>(rng());
+    alone[i].rng = &rng;
+    alone[i].set_function(f);
+    alone[i].load_code(code, size);
+    alone[i].reset();
+    together[i] = alone[i];
+    pointers[i] = &together[i];
+  }
+  run_lockstep(pointers, count, 1000, 100, target, 1e-5, f, reached);
+  for(size_t i=0; i!=count; ++i){
+    bool r = alone[i].runto(1000, 100, target, 1e-5);
+    TEST_CHECK(r == reached[i]);
+    TEST_CHECK_(alone[i].nsteps == together[i].nsteps, "%zu: %zu != %zu", i, alone[i].nsteps, together[i].nsteps);
+    TEST_CHECK(alone[i].ncalls == together[i].ncalls);
+  }
+  TEST_CHECK(f.batches > 0);
+}
+
+void test_population_threads()
+{
+  //results of a seeded run do not depend on the number of threads
+  const size_t count=16, size=100;
+  std::vector<i8> code(count*size);
+  size_t offsets[count+1];
+  random_engine rng(1);
+  for(size_t i=0; i!=code.size(); ++i) code[i] = static_cast<i8>(rng());
+  for(size_t i=0; i<=count; ++i) offsets[i] = i*size;
+  vec target;
+  target.coord[0] = target.coord[1] = 1.0;
+  FunctionTable table(0);
+  BatchedFunction batched;
+  AbstractFunction *functions[] = { &table, &batched };
+  for(AbstractFunction *f: functions){
+    double single[4*count], parallel[4*count];
+    seed_random(42);
+    evaluate_population(&code[0], code.size(), offsets, count+1, *f, target, 1000, 100, 1e-5, 5, 1, single, 4*count);
+    seed_random(42);
+    evaluate_population(&code[0], code.size(), offsets, count+1, *f, target, 1000, 100, 1e-5, 5, 4, parallel, 4*count);
+    for(size_t i=0; i!=4*count; ++i)
+      TEST_CHECK_(single[i] == parallel[i], "%zu: %f != %f", i, single[i], parallel[i]);
+  }
+}
+
+void test_expression_function()
+{
+  vec v;
+  v.coord[0] = 2.0;
+  v.coord[1] = 1.0;
+  TEST_CHECK(ExpressionFunction("(x-10)**2 + (y-20)**2").evaluate(v) == 64.0+361.0);
+  TEST_CHECK(ExpressionFunction("-x**2").evaluate(v) == -4.0);
+  TEST_CHECK(ExpressionFunction("2**3**2").evaluate(v) == 512.0);
+  TEST_CHECK(ExpressionFunction("x*y/4-1").evaluate(v) == -0.5);
+  TEST_CHECK(fabs(ExpressionFunction("sin(pi/2) + abs(-3)*2").evaluate(v) - 7.0) < 1e-12);
+  const char *bad[] = { "x+", "(x", "x y", "z", "foo(x)" };
+  for(const char *expression: bad){
+    bool thrown = false;
+    try{
+      ExpressionFunction f(expression);
+    }catch(std::invalid_argument &){
+      thrown = true;
+    }
+    TEST_CHECK_(thrown, "%s", expression);
+  }
+  //deep nesting is an error, not a stack overflow
+  const std::string deep[] = { std::string(200000, '(') + "x" + std::string(200000, ')'),
+			       std::string(200000, '-') + "x" };
+  for(const std::string &expression: deep){
+    bool thrown = false;
+    try{
+      ExpressionFunction f(expression);
+    }catch(std::invalid_argument &){
+      thrown = true;
+    }
+    TEST_CHECK(thrown);
+  }
+  TEST_CHECK(ExpressionFunction(std::string(50, '(') + "x" + std::string(50, ')')).evaluate(v) == 2.0);
+}
+
+static double sum_of_squares(const double *x, size_t n)
+{
+  double s = 0.0;
+  for(size_t i=0; i!=n; ++i) s += x[i]*x[i];
+  return s;
+}
+
+void test_native_function()
+{
+  NativeFunction f(reinterpret_cast<size_t>(&sum_of_squares));
+  vec v;
+  v.coord[0] = 3.0;
+  v.coord[1] = 4.0;
+  TEST_CHECK(f.evaluate(v) == 25.0);
+  double points[] = { 1.0, 2.0, 0.0, 0.0 }, values[2];
+  f.evaluate_many(points, 2, values);
+  TEST_CHECK(values[0] == 5.0 && values[1] == 0.0);
+}
+
+void test_snapshot()
+{
+  const size_t size=200;
+  random_engine rng(2);
+  i8 code[size];
+  for(size_t j=0; j!=size; ++j) code[j] = static_cast<i8>(rng());
+  FunctionTable f(0);
+  Machine m;
+  m.set_function(f);
+  m.load_code(code, size);
+  m.steps(50);
+  double saved[SNAPSHOT_SIZE], first[SNAPSHOT_SIZE], second[SNAPSHOT_SIZE];
+  m.snapshot(saved, SNAPSHOT_SIZE);
+  m.steps(500);
+  m.snapshot(first, SNAPSHOT_SIZE);
+  m.restore(saved, SNAPSHOT_SIZE);
+  m.steps(500);
+  m.snapshot(second, SNAPSHOT_SIZE);
+  for(size_t i=0; i!=SNAPSHOT_SIZE; ++i)
+    TEST_CHECK_(first[i] == second[i] || (first[i] != first[i] && second[i] != second[i]), "value %zu", i);
+
+  //initial states are used cyclically
+  double states[2*INITIAL_STATE_SIZE];
+  random_initial_states(states, 2*INITIAL_STATE_SIZE);
+  m.set_initial_states(states, 2*INITIAL_STATE_SIZE);
+  m.reset();
+  TEST_CHECK(m.vec_accum.x.coord[0] == states[0]);
+  m.reset();
+  TEST_CHECK(m.vec_registers[0].x.coord[1] == states[INITIAL_STATE_SIZE+DIMENSION+1]);
+  m.reset();
+  TEST_CHECK(m.vec_accum.x.coord[1] == states[1]);
+
+  //register state round trip
+  double state[STATE_SIZE], copy[STATE_SIZE];
+  for(size_t i=0; i!=STATE_SIZE; ++i) state[i] = i;
+  m.set_state(state, STATE_SIZE);
+  TEST_CHECK(m.float_accum == 0.0);
+  TEST_CHECK(m.vec_registers[0].x.coord[0] == 1 + DIMENSION);
+  TEST_CHECK(!m.vec_registers[0].evaluated);
+  TEST_CHECK(m.float_registers[NFLOATREG-1] == STATE_SIZE-1);
+  m.get_state(copy, STATE_SIZE);
+  for(size_t i=0; i!=STATE_SIZE; ++i) TEST_CHECK_(copy[i] == state[i], "state value %zu", i);
+}
+
+void test_record_trace()
+{
+  const size_t size=200, steps=1000, every=7;
+  random_engine rng(3);
+  i8 code[size];
+  for(size_t j=0; j!=size; ++j) code[j] = static_cast<i8>(rng());
+  FunctionTable f(0);
+  Machine m, reference;
+  m.set_function(f);
+  reference.set_function(f);
+  m.load_code(code, size);
+  reference.load_code(code, size);
+  double states[INITIAL_STATE_SIZE];
+  random_initial_states(states, INITIAL_STATE_SIZE);
+  m.set_initial_states(states, INITIAL_STATE_SIZE);
+  reference.set_initial_states(states, INITIAL_STATE_SIZE);
+  m.reset();
+  reference.reset();
+
+  const size_t nrecords = (steps+every-1)/every;
+  std::vector<double> trace(nrecords*TRACE_RECORD_SIZE);
+  TEST_CHECK(m.record_trace(steps, every, &trace[0], trace.size()) == nrecords);
+  TEST_CHECK(m.nsteps == steps);
+  for(size_t r=0; r!=nrecords; ++r){
+    const double *record = &trace[r*TRACE_RECORD_SIZE];
+    TEST_CHECK_(record[0] == reference.ncalls, "ncalls of record %zu", r);
+    TEST_CHECK_(record[1] == reference.cpr, "cpr of record %zu", r);
+    const double *vregs = record + 3 + DIMENSION;
+    TEST_CHECK_(vregs[0] == reference.vec_registers[0].x.coord[0] || vregs[0] != vregs[0],
+		"register of record %zu", r);
+    const double *fregs = vregs + NVECREG*DIMENSION;
+    TEST_CHECK_(fregs[NFLOATREG-1] == reference.float_registers[NFLOATREG-1] || fregs[NFLOATREG-1] != fregs[NFLOATREG-1],
+		"float register of record %zu", r);
+    reference.steps(every);
+  }
+  //buffer too small
+  bool raised = false;
+  try{
+    m.record_trace(steps, every, &trace[0], trace.size()-1);
+  }catch(std::invalid_argument &){
+    raised = true;
+  }
+  TEST_CHECK(raised);
+}
+
+void test_live_mask()
+{
+  //live mask must match the live code of the traced runs with the same initial states
+  const size_t size=300, attempts=3, steps=2000;
+  random_engine rng(4);
+  i8 code[size];
+  for(size_t j=0; j!=size; ++j) code[j] = static_cast<i8>(rng());
+  double states[attempts*INITIAL_STATE_SIZE];
+  random_initial_states(states, attempts*INITIAL_STATE_SIZE);
+  FunctionTable f(0);
+  Machine m, reference;
+  m.set_function(f);
+  reference.set_function(f);
+  m.load_code(code, size);
+  reference.load_code(code, size);
+  m.set_initial_states(states, attempts*INITIAL_STATE_SIZE);
+  reference.set_initial_states(states, attempts*INITIAL_STATE_SIZE);
+  reference.set_trace_live_code(true);
+  for(size_t i=0; i!=attempts; ++i){
+    reference.reset();
+    reference.steps(steps);
+  }
+  std::vector<i8> mask(m.code_size());
+  m.live_mask(attempts, steps, &mask[0], mask.size());
+  TEST_CHECK(!m.get_trace_live_code());
+  size_t live = 0;
+  for(size_t i=0; i!=mask.size(); ++i){
+    TEST_CHECK_(mask[i] == reference.is_instruction_live(i), "instruction %zu", i);
+    live += mask[i];
+  }
+  TEST_CHECK(live > 0);
+}
+
+void test_superinstructions()
+{
+  //runto with superinstructions must do the same steps as runto with plain steps.
+  //Tracing of the live code disables superinstructions
+  command ops[] = { cmd_vload, cmd_vless, cmd_iftrue_up, cmd_iffalse_down, cmd_fload,
+		    cmd_fless_value, cmd_vstore, cmd_label, cmd_fadd_value };
+  const size_t nops = sizeof(ops)/sizeof(ops[0]);
+  FunctionTable f(0);
+  vec target;
+  target.coord[0] = target.coord[1] = 1.0;
+  random_engine rng(3);
+  for(size_t k=0; k!=200; ++k){
+    const size_t size=60;
+    i8 code[size];
+    for(size_t j=0; j!=size; j+=2){
+      code[j] = static_cast<i8>(ops[rng()%nops]);
+      code[j+1] = static_cast<i8>(rng());
+    }
+    Machine fused, plain;
+    fused.set_function(f);
+    fused.load_code(code, size);
+    fused.rng = &rng;
+    fused.reset();
+    plain = fused;
+    plain.set_trace_live_code(true);
+    size_t maxsteps = 1+rng()%1000, maxevals = 1+rng()%100;
+    bool r1 = fused.runto(maxsteps, maxevals, target, 1e-2);
+    bool r2 = plain.runto(maxsteps, maxevals, target, 1e-2);
+    TEST_CHECK(r1 == r2);
+    TEST_CHECK_(fused.nsteps == plain.nsteps, "%zu != %zu", fused.nsteps, plain.nsteps);
+    TEST_CHECK(fused.ncalls == plain.ncalls);
+    TEST_CHECK(fused.cpr == plain.cpr);
+    TEST_CHECK(fused.flag == plain.flag);
+    //steps() runs without target: changes of the register 0 do not interrupt superinstructions
+    size_t nsteps = rng()%1000;
+    fused.steps(nsteps);
+    plain.steps(nsteps);
+    TEST_CHECK(fused.nsteps == plain.nsteps);
+    TEST_CHECK(fused.cpr == plain.cpr);
+    TEST_CHECK(fused.ncalls == plain.ncalls);
+  }
+}
 
 TEST_LIST = {
     { "test_machine", test_machine },
+    { "test_jump_table", test_jump_table },
+    { "test_evaluate_population", test_evaluate_population },
+    { "test_race_population", test_race_population },
+    { "test_run_lockstep", test_run_lockstep },
+    { "test_population_threads", test_population_threads },
+    { "test_expression_function", test_expression_function },
+    { "test_native_function", test_native_function },
+    { "test_snapshot", test_snapshot },
+    { "test_record_trace", test_record_trace },
+    { "test_live_mask", test_live_mask },
+    { "test_superinstructions", test_superinstructions },
     { NULL, NULL }
 };
@@ -0,0 +1,61 @@
+#Test of the line index of JSON logs: it must follow appends, truncation and rewrites of the log
+import os
+import sys
+import json
+import tempfile
+import utils
+
+failed = 0
+def check(name, log, records):
+    global failed
+    idx = utils.load_index(log, verbose=False)
+    loaded = [utils.load_json_line(log, i) for i in range(len(records))]
+    ok = len(idx['offsets']) == len(records) and loaded == records
+    print(f"{name}: {'ok' if ok else 'FAILED'}")
+    if not ok: failed += 1
+
+def write(log, records, mode="w"):
+    with open(log, mode) as hfile:
+        for record in records:
+            hfile.write(json.dumps(record)+"\n")
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    log = os.path.join(tmpdir, "log.jsons")
+    records = [{'generation': i, 'hexcode': "00"*i} for i in range(10)]
+    write(log, records)
+    check("new", log, records)
+
+    #appended records are indexed incrementally, incomplete last line is not indexed
+    more = [{'generation': i, 'hexcode': "01"*i} for i in range(10, 15)]
+    write(log, more, "a")
+    with open(log, "a") as hfile:
+        hfile.write('{"generation": 15')
+    check("append", log, records+more)
+    with open(log, "a") as hfile:
+        hfile.write('}\n')
+    check("complete line", log, records+more+[{'generation': 15}])
+
+    #truncated log
+    write(log, records[:5])
+    check("truncate", log, records[:5])
+
+    #rewritten log of the same size, lines have other lengths
+    same = [{'generation': i, 'hexcode': "ff"*(4-i)} for i in range(5)]
+    write(log, same)
+    check("same length rewrite", log, same)
+
+    #rewritten log of larger size, with a line end at the end of the indexed part
+    longer = [{'generation': i, 'hexcode': "ee"*i} for i in range(5)] + records[:3]
+    write(log, longer)
+    check("longer rewrite", log, longer)
+
+    #leftover offsets of an interrupted update are ignored
+    with open(log+".index", "ab") as hidx:
+        hidx.write(b"\xff"*80)
+    write(log, more, "a")
+    check("interrupted update", log, longer + more)
+
+if failed:
+    print("FAILED")
+    sys.exit(1)
+print("OK")
@@ -0,0 +1,80 @@
+#Differential test of the NumPy interpreter against the native machine
+import sys
+import random
+import numpy as np
+import machine
+import machinedef
+import nmead
+from numpy_machine import NumpyMachines, table_function, INITIAL_STATE_SIZE, SNAPSHOT_SIZE
+
+assert INITIAL_STATE_SIZE == machine.INITIAL_STATE_SIZE
+assert SNAPSHOT_SIZE == machine.SNAPSHOT_SIZE
+
+def random_genome(size, ops=None):
+    genome = bytearray()
+    for _ in range(size):
+        genome.append(random.choice(ops) if ops else random.randrange(256))
+        genome.append(random.randrange(256))
+    return bytes(genome)
+
+def native_snapshots(genomes, states, func, run):
+    snapshots = []
+    results = []
+    m = machine.Machine()
+    m.set_function(func)
+    for genome, state in zip(genomes, states):
+        m.load_code(genome)
+        m.set_initial_states(np.ascontiguousarray(state))
+        m.reset()
+        results.append(run(m))
+        snapshots.append(np.frombuffer(m.snapshot(), dtype=np.float64))
+    return np.array(results), np.array(snapshots)
+
+def comparable(snapshots):
+    """Values of unevaluated points are undefined, and NaNs are equal"""
+    s = snapshots.copy()
+    for k in range(machinedef.NVECREG+1):
+        f, evaluated = 7+4*k, 8+4*k
+        s[s[:, evaluated] == 0, f] = 0.0
+    s[np.isnan(s)] = 0.0
+    return s
+
+random.seed(1)
+np.random.seed(1)
+frequent = [machinedef.name2cmd[n].code for n in
+            "vload vstore vswap vmerge vless fload fload_value fstore fadd fadd_value fswap fless fless_value label iftrue_up iffalse_down jump_up".split()]
+genomes = ([random_genome(random.choice([0, 1, 5, 30, 200])) for _ in range(200)] +
+           [random_genome(random.choice([5, 30, 200]), frequent) for _ in range(200)] +
+           #optimizer, that reaches the target
+           [nmead.nmead_code]*20)
+states = np.random.uniform(-1, 1, size=(len(genomes), INITIAL_STATE_SIZE))
+#minima of the table functions
+targets = [(1.0, 1.0), (0.0, 0.0), (1.0, 2.0), (0.0, 0.0)]
+failed = 0
+for func_index in range(4):
+    func = machine.FunctionTable(func_index)
+    for nsteps in (1, 17, 500):
+        _, expected = native_snapshots(genomes, states, func, lambda m: m.steps(nsteps))
+        machines = NumpyMachines(genomes, table_function(func_index))
+        machines.reset(states)
+        machines.steps(nsteps)
+        bad = np.nonzero((comparable(expected) != comparable(machines.snapshot())).any(axis=1))[0]
+        print(f"function {func_index}, steps({nsteps}): {len(bad)} mismatches")
+        failed += len(bad)
+
+    maxsteps, maxevals, tol = 2000, 100, 1e-2
+    target = targets[func_index]
+    reached, expected = native_snapshots(genomes, states, func,
+                                         lambda m: m.runto(maxsteps, maxevals, target, tol))
+    machines = NumpyMachines(genomes, table_function(func_index))
+    machines.reset(states)
+    np_reached = machines.runto(maxsteps, maxevals, target, tol)
+    bad = np.nonzero((comparable(expected) != comparable(machines.snapshot())).any(axis=1) |
+                     (reached != np_reached))[0]
+    print(f"function {func_index}, runto: {len(bad)} mismatches, {reached.sum()} reached")
+    failed += len(bad)
+
+if failed:
+    print("FAILED")
+    sys.exit(1)
+print("OK")
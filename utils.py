@@ -2,8 +2,13 @@ import json
 import sys
 import re
 import os
+import mmap
+import struct
+import hashlib
+import numpy as np
 
 from hash_mappings import hashes_compatible
+from binlog import is_binlog, BinaryLogReader
 
 def load_json(jsonfile):
     """file may be either a path or a reference to a line"""
@@ -29,10 +34,15 @@ def get_code(jsonfile, data, check_hash=None):
     raise ValueError(f"File {jsonfile} has no 'hexcode' field")
     
 def load_json_line(jsonfile, nline):
+    if is_binlog(jsonfile):
+        try:
+            return BinaryLogReader(jsonfile).record(nline)
+        except IndexError:
+            raise ValueError(f"Record {nline} not found in {jsonfile}")
     try:
         idx = load_index(jsonfile)
         offset=idx['offsets'][nline]            
-        with open(jsonfile,"r") as hfile:
+        with open(jsonfile,"rb") as hfile:
             hfile.seek(offset)
             line = hfile.readline()
         return json.loads(line)
@@ -46,30 +56,97 @@ def load_line(jsonfile, nline, check_hash=None):
                     check_hash)
 
 
-def load_index(jsonsfile):
+#Index file: magic, length of the indexed part of the log, number of the indexed lines (uint64),
+#digest of the last indexed line, offsets of the lines (uint64).
+#Offsets after the indexed lines are leftovers of an interrupted update, they are ignored and overwritten.
+#Digest detects a log, rewritten in place: its size alone does not tell it from an appended one
+_index_magic = b"JLINDEX3"
+_index_header = struct.Struct("<8sQQ16s")
+
+def load_index(jsonsfile, verbose=True):
+    """Index of the line offsets of the log file.
+    If log has grown, only its new part is indexed; if it was truncated or rewritten, index is rebuilt.
+    Only complete lines (ending with newline) are indexed.
+    """
     indexfile = jsonsfile+".index"
-    if os.path.exists(indexfile):
-        if os.path.getmtime(indexfile) < os.path.getmtime(jsonsfile):
-            print("Updating index")
-            idx = _create_index(jsonsfile, indexfile)
-        else:
-            with open(indexfile,"r")as h:
-                idx = json.load(h)
+    log_size = os.path.getsize(jsonsfile)
+    indexed = _indexed_length(jsonsfile, indexfile, log_size)
+    if indexed is None:
+        if verbose: print("Creating index")
+        _write_index_header(indexfile, 0, 0, _line_digest(b""), create=True)
+        indexed = (0, 0)
+    indexed_length, count = indexed
+    if indexed_length < log_size:
+        count = _update_index(jsonsfile, indexfile, indexed_length, count, verbose=verbose)
+    with open(indexfile, "rb") as hidx:
+        mm = mmap.mmap(hidx.fileno(), 0, access=mmap.ACCESS_READ)
+    start = _index_header.size
+    return {'offsets': memoryview(mm)[start:start+count*8].cast('Q')}
+
+def _indexed_length(jsonsfile, indexfile, log_size):
+    """Pair (length of the log, covered by the index, number of the indexed lines),
+    or None if index must be rebuilt"""
+    if not os.path.exists(indexfile): return None
+    with open(indexfile, "rb") as hidx:
+        header = hidx.read(_index_header.size)
+    if len(header) != _index_header.size: return None
+    magic, indexed_length, count, digest = _index_header.unpack(header)
+    #old index format, or log was truncated
+    if magic != _index_magic or indexed_length > log_size: return None
+    if os.path.getsize(indexfile) < _index_header.size + count*8: return None
+    if count > 0:
+        with open(indexfile, "rb") as hidx:
+            hidx.seek(_index_header.size + (count-1)*8)
+            last_start, = struct.unpack("<Q", hidx.read(8))
+        if last_start >= indexed_length: return None
+        with open(jsonsfile, "rb") as hfile:
+            hfile.seek(last_start)
+            last_line = hfile.read(indexed_length-last_start)
     else:
-        print("Creating index")
-        idx = _create_index(jsonsfile, indexfile)
-    return idx
+        last_line = b""
+    if _line_digest(last_line) != digest:
+        #log was rewritten
+        return None
+    return indexed_length, count
 
-def _create_index(jsonsfile, indexfile):
-    offsets = []
-    with open(jsonsfile, "r") as hfile:
+def _line_digest(line):
+    return hashlib.blake2b(line, digest_size=16).digest()
+
+def _write_index_header(indexfile, indexed_length, count, digest, create=False):
+    with open(indexfile, "wb" if create else "r+b") as hidx:
+        hidx.write(_index_header.pack(_index_magic, indexed_length, count, digest))
+
+def _update_index(jsonsfile, indexfile, indexed_length, count, chunk_size=1<<24, verbose=True):
+    """Append offsets of the lines after indexed_length to the index, return total number of lines"""
+    old_count = count
+    with open(jsonsfile, "rb") as hfile, open(indexfile, "r+b") as hidx:
+        #drop offsets of an interrupted update
+        hidx.truncate(_index_header.size + count*8)
+        hidx.seek(0, os.SEEK_END)
+        line_start = indexed_length
+        last_start = None
+        hfile.seek(indexed_length)
+        pos = indexed_length
         while True:
-            pos = hfile.tell()
-            line = hfile.readline()
-            if not line: break
-            offsets.append(pos)
-    idx = {'offsets':offsets}
-    with open(indexfile,"w") as hidx:
-        json.dump(idx, hidx)
-    print(f"Created index file {indexfile} with {len(offsets)} entries")
-    return idx
+            chunk = hfile.read(chunk_size)
+            if not chunk: break
+            line_ends = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10) + pos
+            if len(line_ends):
+                starts = np.empty(len(line_ends), dtype=np.uint64)
+                starts[0] = line_start
+                starts[1:] = line_ends[:-1] + 1
+                hidx.write(starts.tobytes())
+                count += len(starts)
+                last_start = int(starts[-1])
+                line_start = int(line_ends[-1]) + 1
+            pos += len(chunk)
+        if last_start is None:
+            #no new complete lines
+            return count
+        hfile.seek(last_start)
+        digest = _line_digest(hfile.read(line_start-last_start))
+    #header is updated after the offsets are written
+    _write_index_header(indexfile, line_start, count, digest)
+    if count != old_count and verbose:
+        print(f"Indexed {count-old_count} new lines of {jsonsfile}")
+    return count